@@ -0,0 +1,228 @@
+#!/usr/bin/perl
+##########LICENCE ##########
+#Copyright (c) 2015 Genome Research Ltd.
+###
+#Author: Cancer Genome Project <cgpit@sanger.ac.uk>
+###
+#This file is part of cgpRna.
+###
+#cgpRna is free software: you can redistribute it and/or modify it under
+#the terms of the GNU Affero General Public License as published by the
+#Free Software Foundation; either version 3 of the License, or (at your
+#option) any later version.
+###
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+#General Public License for more details.
+###
+#You should have received a copy of the GNU Affero General Public
+#License along with this program. If not, see
+#<http://www.gnu.org/licenses/>.
+###
+#1. The usage of a range of years within a copyright statement contained
+#within this distribution should be interpreted as being equivalent to a
+#list of years including the first and last year specified and all
+#consecutive years between them. For example, a copyright statement that
+#reads ‘Copyright (c) 2005, 2007- 2009, 2011-2012’ should be interpreted
+#as being identical to a statement that reads ‘Copyright (c) 2005, 2007,
+#2008, 2009, 2011, 2012’ and a copyright statement that reads ‘Copyright
+#(c) 2005-2012’ should be interpreted as being identical to a statement
+#that reads ‘Copyright (c) 2005, 2006, 2007, 2008, 2009, 2010, 2011,
+#2012’."
+##########LICENCE ##########
+##########
+BEGIN {
+  use Cwd qw(abs_path);
+  use File::Basename;
+  unshift (@INC,dirname(abs_path($0)).'/../lib');
+};
+
+use strict;
+use warnings;
+
+use Const::Fast qw(const);
+use Getopt::Long;
+use Pod::Usage qw(pod2usage);
+use File::Spec;
+use File::Temp qw(tempdir);
+use File::Which qw(which);
+use Time::HiRes qw(time);
+use Sanger::CGP::CompareFusions::BreakpointOverlap;
+
+# Compares the in-process breakpoint overlap engine of compare_overlapping_fusions.pl with bedtools, sort and
+# join, on synthetic fusion lists of cohort size. Without bedtools in PATH only the in-process engine is timed.
+
+const my @CHROMS => map { "$_" } (1..22, 'X');
+const my $CHROM_LENGTH => 100_000_000;
+const my $SHARED_FRACTION => 0.3;
+const my $JITTER => 4;
+
+{
+  my %opts = ('fusions' => 20000, 'exons' => 200000, 'seed' => 1);
+  GetOptions('f|fusions=i' => \$opts{'fusions'},
+             'e|exons=i' => \$opts{'exons'},
+             's|seed=i' => \$opts{'seed'},
+             'o|outdir=s' => \$opts{'outdir'},
+             'h|help' => \$opts{'h'}) or pod2usage(2);
+  pod2usage(-verbose => 1) if(defined $opts{'h'});
+
+  srand($opts{'seed'});
+  my $dir = $opts{'outdir'} || tempdir('breakpoint_overlap_XXXX', TMPDIR => 1, CLEANUP => 1);
+  my @bedpe_files = write_bedpe_files($dir, $opts{'fusions'});
+  my ($bed_file, $exon_gtf) = write_annotation_files($dir, $opts{'fusions'}, $opts{'exons'});
+  my $bedtools = which('bedtools');
+
+  printf "%d fusions per caller, %d exons\n", $opts{'fusions'}, $opts{'exons'};
+
+  my %overlaps;
+  my $start = time;
+  my @records = map { Sanger::CGP::CompareFusions::BreakpointOverlap::read_records($_) } @bedpe_files;
+  for my $pair('1_2', '1_3', '2_3') {
+    my ($i, $j) = split '_', $pair;
+    $overlaps{$pair} = Sanger::CGP::CompareFusions::BreakpointOverlap::pair_to_pair($records[$i-1], $records[$j-1]);
+  }
+  $overlaps{'1_2_3'} = Sanger::CGP::CompareFusions::BreakpointOverlap::join_on_name($overlaps{'1_2'}, $overlaps{'1_3'});
+  report('overlaps', 'in process', time - $start, \%overlaps);
+
+  $start = time;
+  my $exon_index = Sanger::CGP::CompareFusions::BreakpointOverlap::exon_index($exon_gtf);
+  my $exons = Sanger::CGP::CompareFusions::BreakpointOverlap::overlapping_exons(Sanger::CGP::CompareFusions::BreakpointOverlap::read_records($bed_file), $exon_index);
+  report('exons', 'in process', time - $start, {'exons' => $exons});
+
+  unless(defined $bedtools) {
+    print "bedtools not found, not compared\n";
+    exit 0;
+  }
+
+  $start = time;
+  for my $pair('1_2', '1_3', '2_3') {
+    my ($i, $j) = split '_', $pair;
+    run("$bedtools pairtopair -a $bedpe_files[$i-1] -b $bedpe_files[$j-1] -slop 5 > $dir/$pair.bedpe_overlap");
+  }
+  run("sort -k8,8 $dir/1_2.bedpe_overlap > $dir/1_2.sorted");
+  run("sort -k8,8 $dir/1_3.bedpe_overlap > $dir/1_3.sorted");
+  run("join -1 8 -2 8 $dir/1_2.sorted $dir/1_3.sorted > $dir/1_2_3.bedpe_overlap");
+  my %tool_overlaps = map { $_ => read_lines("$dir/$_.bedpe_overlap") } keys %overlaps;
+  report('overlaps', 'bedtools', time - $start, \%tool_overlaps);
+  compare('overlaps', \%overlaps, \%tool_overlaps);
+
+  $start = time;
+  run("$bedtools closest -s -a $bed_file -b $exon_gtf | sort -k4,4 > $dir/breaks.ann");
+  # only the exons a breakpoint falls in are used for its annotation
+  my @tool_exons = grep { my @f = split "\t"; $f[12] ne '.' && $f[13] <= $f[2] && $f[2] <= $f[14] } @{read_lines("$dir/breaks.ann")};
+  report('exons', 'bedtools', time - $start, {'exons' => \@tool_exons});
+  compare('exons', {'exons' => $exons}, {'exons' => \@tool_exons});
+}
+
+sub random_pair {
+  my @pair;
+  for(1..2) {
+    my $pos = 1 + int(rand($CHROM_LENGTH));
+    push @pair, $CHROMS[int(rand(scalar @CHROMS))], $pos - 1, $pos, (rand() < 0.5 ? '+' : '-');
+  }
+  return \@pair;
+}
+
+sub write_bedpe_files {
+  # three callers, each sharing a fraction of its fusions with the others, with the breakpoints a few bases apart
+  my ($dir, $fusions) = @_;
+  my @shared = map { random_pair() } 1..int($fusions * $SHARED_FRACTION);
+  my @files;
+  for my $caller(1..3) {
+    my $file = File::Spec->catfile($dir, "$caller.bedpe");
+    open(my $ofh, '>', $file);
+    my @pairs = (@shared, map { random_pair() } 1..($fusions - scalar @shared));
+    for my $i(0..$#pairs) {
+      my ($chr1, $start1, $end1, $strand1, $chr2, $start2, $end2, $strand2) = @{$pairs[$i]};
+      my $shift1 = int(rand(2 * $JITTER + 1)) - $JITTER;
+      my $shift2 = int(rand(2 * $JITTER + 1)) - $JITTER;
+      $shift1 = 0 if($start1 + $shift1 < 0);
+      $shift2 = 0 if($start2 + $shift2 < 0);
+      print $ofh join("\t", $chr1, $start1 + $shift1, $end1 + $shift1, $chr2, $start2 + $shift2, $end2 + $shift2, "caller$caller", "c${caller}_$i", $strand1, $strand2)."\n";
+    }
+    close($ofh);
+    push @files, $file;
+  }
+  return @files;
+}
+
+sub write_annotation_files {
+  # breakpoints and exons, as query_vagrent and filter_gtf write them, each exon of its own gene
+  my ($dir, $fusions, $exons) = @_;
+  my $bed_file = File::Spec->catfile($dir, 'breaks.bed');
+  my $exon_gtf = File::Spec->catfile($dir, 'exons.gtf');
+  open(my $ofh, '>', $exon_gtf);
+  my @exon_rows;
+  for my $i(1..$exons) {
+    my $start = 1 + int(rand($CHROM_LENGTH));
+    push @exon_rows, [$CHROMS[int(rand(scalar @CHROMS))], $start, $start + 50 + int(rand(500)), (rand() < 0.5 ? '+' : '-'), "G$i"];
+  }
+  for my $exon(sort { $a->[0] cmp $b->[0] || $a->[1] <=> $b->[1] } @exon_rows) {
+    print $ofh join("\t", $exon->[0], 'bench', 'exon', $exon->[1], $exon->[2], '.', $exon->[3], '.', "gene_id $exon->[4]; gene_name $exon->[4]; exon_id E$exon->[4]")."\n";
+  }
+  close($ofh);
+
+  # half of the breakpoints in exons, in the gene of the exon
+  open($ofh, '>', $bed_file);
+  for my $i(1..$fusions) {
+    my ($chr, $pos, $strand, $gene);
+    if($i % 2) {
+      my $exon = $exon_rows[int(rand(scalar @exon_rows))];
+      ($chr, $pos, $strand, $gene) = ($exon->[0], $exon->[1] + int(rand($exon->[2] - $exon->[1] + 1)), $exon->[3], $exon->[4]);
+    }
+    else {
+      ($chr, $pos, $strand, $gene) = ($CHROMS[int(rand(scalar @CHROMS))], 1 + int(rand($CHROM_LENGTH)), '+', 'NA');
+    }
+    print $ofh join("\t", $chr, $pos - 1, $pos, "b$i", 'NA', $strand, $gene, $gene, 'NA', 'NA')."\n";
+  }
+  close($ofh);
+  return ($bed_file, $exon_gtf);
+}
+
+sub run {
+  my $command = shift;
+  system('/bin/bash', '-c', $command) == 0 or die "Failed: $command\n";
+}
+
+sub read_lines {
+  my $file = shift;
+  open(my $ifh, $file);
+  my @lines = <$ifh>;
+  close($ifh);
+  chomp @lines;
+  return \@lines;
+}
+
+sub report {
+  my ($what, $engine, $seconds, $results) = @_;
+  printf "%-9s %-11s %8.2fs  %s\n", $what, $engine, $seconds, join(', ', map { "$_: ".scalar(@{$results->{$_}}) } sort keys %$results);
+}
+
+sub compare {
+  # bedtools writes the hits of a pair in the order of its index, compare the lines regardless of order
+  my ($what, $native, $tool) = @_;
+  for my $key(sort keys %$native) {
+    my $native_lines = join("\n", sort map { s/ +/\t/gr } @{$native->{$key}});
+    my $tool_lines = join("\n", sort map { s/ +/\t/gr } @{$tool->{$key}});
+    printf "%-9s %-11s %s\n", $what, $key, $native_lines eq $tool_lines ? 'same' : 'DIFFERENT';
+  }
+}
+
+__END__
+
+=head1 NAME
+
+breakpoint_overlap.pl - benchmark the breakpoint overlap engine of compare_overlapping_fusions.pl
+
+=head1 SYNOPSIS
+
+breakpoint_overlap.pl [options]
+
+  Optional:
+    -fusions   -f   Number of fusions per caller [20000].
+    -exons     -e   Number of exons [200000].
+    -seed      -s   Seed of the synthetic data [1].
+    -outdir    -o   Folder to keep the synthetic data and tool outputs in [a temporary folder].
+
+=cut
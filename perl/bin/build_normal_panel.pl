@@ -0,0 +1,92 @@
+#!/usr/bin/perl
+##########LICENCE ##########
+#Copyright (c) 2015 Genome Research Ltd.
+###
+#Author: Cancer Genome Project <cgpit@sanger.ac.uk>
+###
+#This file is part of cgpRna.
+###
+#cgpRna is free software: you can redistribute it and/or modify it under
+#the terms of the GNU Affero General Public License as published by the
+#Free Software Foundation; either version 3 of the License, or (at your
+#option) any later version.
+###
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+#General Public License for more details.
+###
+#You should have received a copy of the GNU Affero General Public
+#License along with this program. If not, see
+#<http://www.gnu.org/licenses/>.
+###
+#1. The usage of a range of years within a copyright statement contained
+#within this distribution should be interpreted as being equivalent to a
+#list of years including the first and last year specified and all
+#consecutive years between them. For example, a copyright statement that
+#reads ‘Copyright (c) 2005, 2007- 2009, 2011-2012’ should be interpreted
+#as being identical to a statement that reads ‘Copyright (c) 2005, 2007,
+#2008, 2009, 2011, 2012’ and a copyright statement that reads ‘Copyright
+#(c) 2005-2012’ should be interpreted as being identical to a statement
+#that reads ‘Copyright (c) 2005, 2006, 2007, 2008, 2009, 2010, 2011,
+#2012’."
+##########LICENCE ##########
+##########
+BEGIN {
+  use Cwd qw(abs_path);
+  use File::Basename;
+  unshift (@INC,dirname(abs_path($0)).'/../lib');
+};
+
+use strict;
+use warnings;
+
+use autodie qw(:all);
+use Getopt::Long;
+use Pod::Usage qw(pod2usage);
+use PCAP::Cli;
+use Sanger::CGP::FusionFilter::NormalPanel;
+
+{
+	my $options = setup();
+
+	my $panel = Sanger::CGP::FusionFilter::NormalPanel::build_panel($options->{'normals'}, $options->{'window'});
+	printf "Compiled %d normal fusions into %s\n", scalar keys %{$panel->{'refs'}}, Sanger::CGP::FusionFilter::NormalPanel::panel_file($options->{'normals'});
+}
+
+sub setup {
+	my %opts;
+	pod2usage(-msg => "\nERROR: Options must be defined.\n", -verbose => 1, -output => \*STDERR) if(scalar @ARGV == 0);
+
+	GetOptions( 	'h|help' => \$opts{'h'},
+			'm|man' => \$opts{'m'},
+			'n|normals=s' => \$opts{'normals'},
+			'w|window=i' => \$opts{'window'},
+	) or pod2usage(2);
+
+	pod2usage(-verbose => 1) if(defined $opts{'h'});
+	pod2usage(-verbose => 2) if(defined $opts{'m'});
+
+	PCAP::Cli::file_for_reading('normals', $opts{'normals'});
+	die "ERROR: -window must be a positive number\n" if(defined $opts{'window'} && $opts{'window'} < 1);
+
+	return \%opts;
+}
+
+__END__
+
+=head1 build_normal_panel.pl
+
+Compiles a list of gene fusions detected in normal samples into <list>.cgprna.panel next to it. filter_fusions.pl reads the compiled panel, if it is up to date, rather than the list, so it is compiled once and reused by every sample and fusion caller.
+
+=head1 SYNOPSIS
+
+build_normal_panel.pl [options]
+
+  Required parameters:
+    -normals   		-n   	File containing list of gene fusions detected in normal samples (e.g. star-normal-fusions-b38)
+
+  Optional:
+    -window    		-w   	Size of the windows breakpoints are indexed in, for matches within a tolerance [1000]
+
+=cut
@@ -123,6 +123,9 @@ sub setup {
 		'p|process=s' => \$opts{'process'},
 		'i|index=i' => \$opts{'index'},
 		'c|cache=s' => \$opts{'cache'},
+		'b|bedtools' => \$opts{'bedtools'},
+		'am|annotation-memo=s' => \$opts{'annotation_memo'},
+		'ams|annotation-memo-size=i' => \$opts{'annotation_memo_size'},
   ) or pod2usage(2);
 
   pod2usage(-verbose => 1) if(defined $opts{'h'});
@@ -175,6 +178,9 @@ sub setup {
   $opts{'fusion_files'} = \%fusion_files;
   delete $opts{'process'} unless(defined $opts{'process'});
   delete $opts{'index'} unless(defined $opts{'index'});
+  delete $opts{'bedtools'} unless(defined $opts{'bedtools'});
+  delete $opts{'annotation_memo'} unless(defined $opts{'annotation_memo'});
+  delete $opts{'annotation_memo_size'} unless(defined $opts{'annotation_memo_size'});
 	
   $opts{'threads'} = 1 unless(defined $opts{'threads'});
 
@@ -217,6 +223,9 @@ compare_overlapping_fusions.pl [options] [file(s)...]
     
   Optional:
     -threads    	-t   	Number of threads (cpus) to use [1].
+    -bedtools    	-b   	Find breakpoint overlaps and exons with bedtools, sort and join rather than in process.
+    -annotation-memo	-am  	File of the VAGrENT annotation of breakpoints, shared by runs using the same cache [<cache>.cgprna.breakpoints].
+    -annotation-memo-size	-ams	Breakpoints kept in the annotation memo, the most recently used [500000].
     
   Targeted processing (further detail under OPTIONS):
     -process   		-p   	Only process this step then exit
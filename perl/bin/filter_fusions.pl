@@ -43,6 +43,7 @@ use File::Spec;
 use Pod::Usage qw(pod2usage);
 use Const::Fast qw(const);
 use PCAP::Cli;
+use Sanger::CGP::FusionFilter::NormalPanel;
 
 # Position of the columns in the tophat-fusion-post output file used to format fusion breakpoint references.
 const my $TOPHAT_SPLIT_CHAR => '\t';
@@ -84,17 +85,29 @@ sub normals_filter {
 	my $tmp = $options-> {'tmp'};
 	my $sample = $options-> {'sample'};
 	my $fusions_file = File::Spec->catfile($tmp,"$sample.fusions");
-	my $fusions_sorted = File::Spec->catfile($tmp,"$sample.fusions.sorted");
 	PCAP::Cli::file_for_reading('fusions.reformat', $fusions_file.'.reformat');
 
-	# Sort the fusions file prior to joining with the normals file
-	system("sort -k1,1 $fusions_file.reformat > $fusions_file.sorted");
+	# Look each fusion up in the compiled normals panel, rather than sort the fusions and join them with the normals file
+	my $panel = Sanger::CGP::FusionFilter::NormalPanel::load_panel($options->{'normals'});
+	my @fusions;
+	open (my $ifh, "$fusions_file.reformat") or die "Could not open file '$fusions_file.reformat' $!";
+	while (<$ifh>) {
+		chomp;
+		my $line = $_;
+		my @fields = split ' ', $line;
+		next unless(scalar @fields);
+		next if(Sanger::CGP::FusionFilter::NormalPanel::is_normal($panel, $fields[0], $options->{'tolerance'}));
+		push @fusions, [$fields[0], $line, join(' ', @fields)];
+	}
+	close ($ifh);
 
-	my $normal_file = $options-> {'normals'};
-	system("join -v 2 $normal_file $fusions_file.sorted > $fusions_file.filtered") && die "An error occurred: $!";
-	if(-s "$fusions_file.filtered" == 0) {
-		system("echo '##EOF##' > $fusions_file.filtered") && die "An error occurred: $!";
+	# In the order and format sort and join wrote them
+	open(my $ofh, '>', "$fusions_file.filtered") or die "Could not open file '$fusions_file.filtered' $!";
+	for my $fusion(sort { $a->[0] cmp $b->[0] || $a->[1] cmp $b->[1] } @fusions) {
+		print $ofh $fusion->[2]."\n";
 	}
+	print $ofh "##EOF##\n" unless(scalar @fusions);
+	close ($ofh);
 
 	return 1;
 }
@@ -220,6 +233,7 @@ sub setup {
 			'n|normals=s' => \$opts{'normals'},
 			's|sample=s' => \$opts{'sample'},
 			'p|program=s' => \$opts{'program'},
+			't|tolerance=i' => \$opts{'tolerance'},
 	) or pod2usage(2);
 
 	pod2usage(-verbose => 1) if(defined $opts{'h'});
@@ -227,6 +241,7 @@ sub setup {
 
 	PCAP::Cli::file_for_reading('input', $opts{'input'});
 	PCAP::Cli::file_for_reading('normals', $opts{'normals'});
+	$opts{'tolerance'} = 0 unless(defined $opts{'tolerance'});
 
 	# Setup details specific to each fusion detection program output file
 	process_program_params(\%opts);
@@ -289,7 +304,11 @@ filter_fusions.pl [options]
     -program   		-p   	Gene fusion detection program used, valid values are; tophat, star or defuse
     -input    		-i   	Input file of fusions generated by the program (e.g. for star; star-fusion.fusion_candidates.txt).
     -normals   		-n   	File containing list of gene fusions detected in normal samples using the relevant program (e.g. star-normal-fusions-b38)
-                    		 Expected format is one column pre-sorted using the Unix sort command <chr1:pos1-chr2:pos2> e.g.
+                    		 Expected format is one column <chr1:pos1-chr2:pos2> e.g.
                     		  10:100000026-12:93371978
                     		  10:100000026-X:84180396
                     		  ...
+                    		 If it has been compiled with build_normal_panel.pl, the compiled panel is used.
+
+  Optional:
+    -tolerance 		-t   	Also filter fusions with both breakpoints within this many bases of a normal fusion [0].
@@ -81,7 +81,8 @@ sub cleanup {
 	my $tmpdir = $options->{'tmp'};
 	my $star_outdir = File::Spec->catdir($options->{'tmp'}, 'star');
 	move(File::Spec->catdir($tmpdir, 'logs'), File::Spec->catdir($options->{'outdir'}, 'logs_star_map')) || die $!;
-	move(File::Spec->catfile($star_outdir, 'Aligned.sortedByCoord.out.bam'), File::Spec->catfile($options->{'outdir'}, $options->{'sample'}.'.star.Aligned.out.bam')) || die $!;
+	# when duplicates are marked in the stream, the genome BAM has been written to outdir already
+	move(File::Spec->catfile($star_outdir, 'Aligned.sortedByCoord.out.bam'), File::Spec->catfile($options->{'outdir'}, $options->{'sample'}.'.star.Aligned.out.bam')) || die $! unless(exists $options->{'markdup'});
   move(File::Spec->catfile($star_outdir, 'Aligned.toTranscriptome.sortedByCoord.out.bam'), File::Spec->catfile($options->{'outdir'}, $options->{'sample'}.'.star.AlignedtoTranscriptome.out.bam')) || die $!;
 	remove_tree $tmpdir if(-e $tmpdir);
 	return 0;
@@ -103,6 +104,7 @@ sub setup {
 			'r|refdataloc=s' => \$opts{'refdataloc'},
 			'g|gtffile=s' => \$opts{'gtffilename'},
 			't|threads=i' => \$opts{'threads'},
+			'mt|markdup-threads=i' => \$opts{'markdup_threads'},
 			'p|process=s' => \$opts{'process'},
 			'i|index=i' => \$opts{'index'},
 			'c|config=s' => \$opts{'config'},
@@ -113,6 +115,9 @@ sub setup {
 			'n|npg-run=s' => \$opts{'npg'},
       'a|lane-pos=i' => \$opts{'lane_pos'},
 			'si|staridx=s' => \$opts{'staridx'},
+			'md|markdup' => \$opts{'markdup'},
+			'ku|keep-unmarked' => \$opts{'keep_unmarked'},
+			'gl|genome-load=s' => \$opts{'genome_load'},
 
 	) or pod2usage(1);
 
@@ -174,6 +179,11 @@ sub setup {
 	delete $opts{'npg'} unless(defined $opts{'npg'});
 	delete $opts{'lane_pos'} unless(defined $opts{'lane_pos'});
 	delete $opts{'staridx'} unless(defined $opts{'staridx'});
+	delete $opts{'markdup'} unless(defined $opts{'markdup'});
+	delete $opts{'keep_unmarked'} unless(defined $opts{'keep_unmarked'});
+	delete $opts{'markdup_threads'} unless(defined $opts{'markdup_threads'});
+	delete $opts{'genome_load'} unless(defined $opts{'genome_load'});
+	PCAP::Cli::opt_requires_opts('keep_unmarked', \%opts, ['markdup']) if(exists $opts{'keep_unmarked'});
 
  	# Apply defaults
 	$opts{'threads'} = 1 unless(defined $opts{'threads'});
@@ -233,6 +243,12 @@ star_mapping.pl [options] [file(s)...]
     -npg-run       -n   NPG run id which will be used as the first part of the RG BAM header PU tag
     -lane-pos      -a   Sequencing lane - this will be used as the second part of the RG BAM header PU tag
     -staridx       -si  path to directory containing star index files [build from /refdataloc/species/refbuild/star - legacy]
+    -markdup       -md  Stream the genome BAM from STAR through sorting into bammarkduplicates2, writing <sample>.bam,
+                        .bam.bai, .bam.md5 and .bam.met to outdir rather than <sample>.star.Aligned.out.bam
+    -keep-unmarked -ku  With -markdup, also keep the BAM without duplicates marked as <sample>.star.Aligned.out.bam
+    -markdup-threads -mt  With -markdup, threads of each of the sorting and duplicate marking run alongside STAR [-threads]
+    -genome-load   -gl  STAR --genomeLoad mode, e.g. LoadAndKeep to use a genome shared between STAR runs [NoSharedMemory]
+                        The GTF is not inserted on the fly then, its junctions must be built into the STAR index.
 
   Targeted processing (further detail under OPTIONS):
     -process       -p     Only process this step then exit
@@ -0,0 +1,125 @@
+package Sanger::CGP::CompareFusions::AnnotationIndex;
+##########LICENCE ##########
+#Copyright (c) 2015-2026 Genome Research Ltd.
+###
+#Author: Cancer Genome Project <cgpit@sanger.ac.uk>
+###
+#This file is part of cgpRna.
+###
+#cgpRna is free software: you can redistribute it and/or modify it under
+#the terms of the GNU Affero General Public License as published by the
+#Free Software Foundation; either version 3 of the License, or (at your
+#option) any later version.
+###
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+#General Public License for more details.
+###
+#You should have received a copy of the GNU Affero General Public
+#License along with this program. If not, see
+#<http://www.gnu.org/licenses/>.
+###
+#1. The usage of a range of years within a copyright statement contained
+#within this distribution should be interpreted as being equivalent to a
+#list of years including the first and last year specified and all
+#consecutive years between them. For example, a copyright statement that
+#reads ‘Copyright (c) 2005, 2007- 2009, 2011-2012’ should be interpreted
+#as being identical to a statement that reads ‘Copyright (c) 2005, 2007,
+#2008, 2009, 2011, 2012’ and a copyright statement that reads ‘Copyright
+#(c) 2005-2012’ should be interpreted as being identical to a statement
+#that reads ‘Copyright (c) 2005, 2006, 2007, 2008, 2009, 2010, 2011,
+#2012’."
+##########LICENCE ##########
+##########
+# Reader of the annotation index run-cgprna compiles next to a GTF file (run-cgprna index-gtf), see
+# run_cgprna/annotation_index.py for the format. It saves parsing the GTF file as text for every sample.
+use strict;
+use warnings FATAL => 'all';
+use Const::Fast qw(const);
+
+use Sanger::CGP::CgpRna;
+our $VERSION = Sanger::CGP::CgpRna->VERSION;
+
+const my $INDEX_SUFFIX => '.cgprna.idx';
+const my $FILTERED_GTF_SUFFIX => '.cgprna.%s.gtf';
+const my $MAGIC => 'CGPRNAIX';
+const my $FORMAT_VERSION => 1;
+const my $HEADER_TEMPLATE => 'a8 V Q< Q< V8';
+const my $HEADER_SIZE => 60;
+const my $NONE => 0xffffffff;
+const my @GENE_COLUMNS => qw(chrom start end strand gene_id gene_name gene_biotype);
+const my $TRANSCRIPT_COLUMNS => 6;
+const my $EXON_COLUMNS => 7;
+
+# Returns the contents of the index of a GTF file, or only its header if header_only is set, or undef if it has
+# not been compiled or is older than the GTF file.
+sub _read_index {
+  my ($gtf, $header_only) = @_;
+  my $index_file = $gtf.$INDEX_SUFFIX;
+  return undef unless(-e $index_file);
+
+  open(my $ifh, '<:raw', $index_file) or die "Could not open file '$index_file' $!";
+  my $data;
+  if($header_only) {
+    read($ifh, $data, $HEADER_SIZE);
+  }
+  else {
+    $data = do { local $/; <$ifh> };
+  }
+  close($ifh);
+
+  my ($magic, $version, $gtf_size, $gtf_mtime) = unpack $HEADER_TEMPLATE, $data;
+  die "Not a cgpRna annotation index of version $FORMAT_VERSION: $index_file" if($magic ne $MAGIC || $version != $FORMAT_VERSION);
+  if($gtf_size != -s $gtf || $gtf_mtime != (stat $gtf)[9]) {
+    warn "Annotation index $index_file is stale, $gtf is used instead.\n";
+    return undef;
+  }
+  return $data;
+}
+
+# Returns a hash reference of the genes in the compiled index of a GTF file by gene name, each with its gene_id,
+# start and end. Where a name is given to more than one gene, it is the first of them in the GTF file. Returns
+# undef if the GTF file has no up to date index.
+sub gene_info {
+  my $gtf = shift;
+  my $data = _read_index($gtf, 0);
+  return undef unless(defined $data);
+
+  my (undef, undef, undef, undef, $n_strings, $data_size, $n_chroms, $n_genes, $n_transcripts, $n_exons, $n_names) = unpack $HEADER_TEMPLATE, $data;
+  my @strings = (split /\0/, substr($data, $HEADER_SIZE, $data_size), -1)[0..$n_strings-1];
+
+  # the columns follow the strings, chroms first, then genes, transcripts, exons and the gene names
+  my $genes_offset = $HEADER_SIZE + $data_size + 4 * $n_chroms;
+  my %genes;
+  for my $i(0..$#GENE_COLUMNS) {
+    $genes{$GENE_COLUMNS[$i]} = [unpack "V$n_genes", substr($data, $genes_offset + 4 * $n_genes * $i, 4 * $n_genes)];
+  }
+  my $names_offset = $genes_offset + 4 * ($n_genes * scalar(@GENE_COLUMNS) + $n_transcripts * $TRANSCRIPT_COLUMNS + $n_exons * $EXON_COLUMNS);
+  my @names_key = unpack "V$n_names", substr($data, $names_offset, 4 * $n_names);
+  my @names_gene = unpack "V$n_names", substr($data, $names_offset + 4 * $n_names, 4 * $n_names);
+
+  my %gene_info;
+  for my $i(0..$#names_key) {
+    my $gene = $names_gene[$i];
+    my $gene_id = $genes{'gene_id'}->[$gene];
+    $gene_info{$strings[$names_key[$i]]} = {
+      'gene_id' => $gene_id == $NONE ? undef : $strings[$gene_id],
+      'start' => $genes{'start'}->[$gene],
+      'end' => $genes{'end'}->[$gene],
+    };
+  }
+  return \%gene_info;
+}
+
+# Returns the path of the GTF file of one feature type, filtered the way
+# Sanger::CGP::CompareFusions::Implement::filter_gtf filters it, which is written along with the compiled
+# index of a GTF file. Returns undef if the GTF file has no up to date index.
+sub filtered_gtf {
+  my ($gtf, $feature) = @_;
+  my $filtered_gtf = $gtf.sprintf($FILTERED_GTF_SUFFIX, $feature);
+  return undef unless(-e $filtered_gtf && defined _read_index($gtf, 1));
+  return $filtered_gtf;
+}
+
+1;
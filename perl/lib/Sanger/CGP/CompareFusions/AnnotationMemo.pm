@@ -0,0 +1,215 @@
+package Sanger::CGP::CompareFusions::AnnotationMemo;
+##########LICENCE ##########
+#Copyright (c) 2015-2026 Genome Research Ltd.
+###
+#Author: Cancer Genome Project <cgpit@sanger.ac.uk>
+###
+#This file is part of cgpRna.
+###
+#cgpRna is free software: you can redistribute it and/or modify it under
+#the terms of the GNU Affero General Public License as published by the
+#Free Software Foundation; either version 3 of the License, or (at your
+#option) any later version.
+###
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+#General Public License for more details.
+###
+#You should have received a copy of the GNU Affero General Public
+#License along with this program. If not, see
+#<http://www.gnu.org/licenses/>.
+###
+#1. The usage of a range of years within a copyright statement contained
+#within this distribution should be interpreted as being equivalent to a
+#list of years including the first and last year specified and all
+#consecutive years between them. For example, a copyright statement that
+#reads ‘Copyright (c) 2005, 2007- 2009, 2011-2012’ should be interpreted
+#as being identical to a statement that reads ‘Copyright (c) 2005, 2007,
+#2008, 2009, 2011, 2012’ and a copyright statement that reads ‘Copyright
+#(c) 2005-2012’ should be interpreted as being identical to a statement
+#that reads ‘Copyright (c) 2005, 2006, 2007, 2008, 2009, 2010, 2011,
+#2012’."
+##########LICENCE ##########
+##########
+# Memo of the VAGrENT transcript annotation of fusion breakpoints, so a recurrent breakpoint is annotated once
+# rather than again by every caller, sample and rerun. It is kept in <VAGrENT cache>.cgprna.breakpoints next to the
+# cache it was made with, and holds the max_breakpoints most recently used breakpoints.
+#
+# A breakpoint is annotated with the transcripts spanning it, in the order of annotation_sort (CCDS transcripts
+# first, then by CDS and mRNA length): the first of them with an exon boundary at the breakpoint, otherwise the last
+# with an exon containing it. The exons of each transcript are indexed once, sorted by start, and searched with a
+# binary search.
+use strict;
+use warnings FATAL => 'all';
+use Const::Fast qw(const);
+use Fcntl qw(:flock);
+use Storable qw(nstore retrieve);
+use sort 'stable';
+
+use Sanger::CGP::CgpRna;
+use Sanger::CGP::Vagrent;
+our $VERSION = Sanger::CGP::CgpRna->VERSION;
+
+const my $MEMO_SUFFIX => '.cgprna.breakpoints';
+const my $FORMAT_VERSION => 1;
+const my $DEFAULT_MAX_BREAKPOINTS => 500000;
+const my @ANNOTATION_FIELDS => qw(transcript_id gene_biotype exon_start exon_end exon_number gene_name);
+
+sub memo_file {
+  my $vagrent_cache = shift;
+  return $vagrent_cache.$MEMO_SUFFIX;
+}
+
+# Returns the memo of the breakpoints annotated with a VAGrENT cache, read from memo_file, by default next to the
+# cache. Breakpoints annotated with another cache or version of VAGrENT are not used.
+sub new {
+  my ($class, $vagrent_cache, $memo_file, $max_breakpoints) = @_;
+  my ($cache_size, $cache_mtime) = (stat $vagrent_cache)[7, 9];
+  die "Could not find the VAGrENT cache '$vagrent_cache'" unless(defined $cache_size);
+  my $self = {'file' => defined $memo_file ? $memo_file : memo_file($vagrent_cache),
+              'max_breakpoints' => defined $max_breakpoints ? $max_breakpoints : $DEFAULT_MAX_BREAKPOINTS,
+              'source' => join("\t", $FORMAT_VERSION, Sanger::CGP::Vagrent->VERSION, $cache_size, $cache_mtime),
+              'stamp' => time,
+              'added' => 0,
+              'transcripts' => {}};
+  bless $self, $class;
+  my $stored = $self->_read;
+  $self->{'breakpoints'} = defined $stored ? $stored : {};
+  return $self;
+}
+
+# Returns the breakpoints of the memo file, or undef if it has none of the same source.
+sub _read {
+  my $self = shift;
+  return undef unless(-e $self->{'file'});
+  my $memo = eval { retrieve($self->{'file'}) };
+  return undef unless(defined $memo && $memo->{'source'} eq $self->{'source'});
+  return $memo->{'breakpoints'};
+}
+
+# Each breakpoint is stored as a tab separated string of the time it was last used and its ANNOTATION_FIELDS,
+# which are left out if it has no annotation.
+sub _stamp {
+  my $entry = shift;
+  return (split /\t/, $entry, 2)[0];
+}
+
+# Returns the annotation of the breakpoint at pos on chr, a hash reference of the ANNOTATION_FIELDS, or undef if
+# no transcript has an exon at it. transcripts is called for the transcripts around the breakpoint if it is not
+# in the memo yet.
+sub annotate {
+  my ($self, $chr, $pos, $transcripts) = @_;
+  my $key = "$chr:$pos";
+  my $entry = $self->{'breakpoints'}->{$key};
+  my @fields;
+  if(defined $entry) {
+    (undef, @fields) = split /\t/, $entry, -1;
+  }
+  else {
+    @fields = map { defined $_ ? $_ : '' } $self->_find_exon($pos, $transcripts->());
+    $self->{'added'}++;
+  }
+  $self->{'breakpoints'}->{$key} = join "\t", $self->{'stamp'}, @fields;
+  return undef unless(@fields);
+  my %annotation;
+  @annotation{@ANNOTATION_FIELDS} = map { $_ eq '' ? undef : $_ } @fields;
+  return \%annotation;
+}
+
+# Returns the ANNOTATION_FIELDS of the breakpoint at pos from the transcripts around it, or an empty list if none
+# of them has an exon at it.
+sub _find_exon {
+  my ($self, $pos, @transcripts) = @_;
+  my @spanning = grep { $pos >= $_->{'min'} && $pos <= $_->{'max'} } map { $self->_transcript_index($_) } @transcripts;
+  my @fields;
+  for my $index(sort { $b->{'rank'}->[0] <=> $a->{'rank'}->[0] || $b->{'rank'}->[1] <=> $a->{'rank'}->[1] || $b->{'rank'}->[2] <=> $a->{'rank'}->[2] } @spanning) {
+    my ($exon, $boundary) = _exon_at($index, $pos);
+    next unless(defined $exon);
+    @fields = ($index->{'transcript_id'}, $index->{'gene_biotype'}, $index->{'starts'}->[$exon],
+               $index->{'ends'}->[$exon], $index->{'numbers'}->[$exon], $index->{'gene_name'});
+    last if($boundary);
+  }
+  return @fields;
+}
+
+# Returns the index of a transcript, made once for each: its rank in annotation_sort and its exons sorted by
+# start, with their numbers in the transcript.
+sub _transcript_index {
+  my ($self, $transcript) = @_;
+  my $key = join ':', $transcript->getAccession, $transcript->getGenomicMinPos;
+  return $self->{'transcripts'}->{$key} if(exists $self->{'transcripts'}->{$key});
+
+  my @exons = $transcript->getExons;
+  my @order = sort { $exons[$a]->getMinPos <=> $exons[$b]->getMinPos } 0..$#exons;
+  my $ccds = $transcript->getCCDS;
+  my $index = {'transcript_id' => $transcript->getAccession,
+               'gene_name' => $transcript->{'_genename'},
+               'gene_biotype' => $transcript->{'_genetype'},
+               'min' => $transcript->getGenomicMinPos,
+               'max' => $transcript->getGenomicMaxPos,
+               'rank' => [(defined $ccds && $ccds ne '') ? 1 : 0, $transcript->getCdsLength, $transcript->getmRNALength],
+               'starts' => [map { $exons[$_]->getMinPos } @order],
+               'ends' => [map { $exons[$_]->getMaxPos } @order],
+               'numbers' => [map { $_ + 1 } @order]};
+  $self->{'transcripts'}->{$key} = $index;
+  return $index;
+}
+
+# Returns the exon of a transcript index which contains pos, found with a binary search of the exon starts, and
+# whether pos is at one of its boundaries. Returns an empty list if pos is not in an exon.
+sub _exon_at {
+  my ($index, $pos) = @_;
+  my $starts = $index->{'starts'};
+  # the first exon starting after pos
+  my ($low, $high) = (0, scalar @$starts);
+  while($low < $high) {
+    my $mid = int(($low + $high) / 2);
+    if($starts->[$mid] <= $pos) {
+      $low = $mid + 1;
+    }
+    else {
+      $high = $mid;
+    }
+  }
+  my $exon = $low - 1;
+  return () if($exon < 0 || $pos > $index->{'ends'}->[$exon]);
+  return ($exon, ($pos == $starts->[$exon] || $pos == $index->{'ends'}->[$exon]) ? 1 : 0);
+}
+
+# Writes the memo file, if breakpoints have been annotated, merged with the breakpoints other runs have written
+# meanwhile and bounded to the max_breakpoints most recently used. The memo is left as it is, with a warning, if
+# it cannot be written, e.g. next to a read only VAGrENT cache.
+sub save {
+  my $self = shift;
+  return 0 unless($self->{'added'});
+  my $file = $self->{'file'};
+  my $lfh;
+  unless(open($lfh, '>>', "$file.lock")) {
+    warn "Could not write the annotation memo $file, breakpoints are not memoised: $!\n";
+    return 0;
+  }
+  flock($lfh, LOCK_EX) or die "Could not lock file '$file.lock' $!";
+
+  my $breakpoints = $self->{'breakpoints'};
+  my $stored = $self->_read;
+  if(defined $stored) {
+    for my $key(keys %$stored) {
+      $breakpoints->{$key} = $stored->{$key} if(!exists $breakpoints->{$key} || _stamp($stored->{$key}) > _stamp($breakpoints->{$key}));
+    }
+  }
+  if(scalar keys %$breakpoints > $self->{'max_breakpoints'}) {
+    my %stamps = map { $_ => _stamp($breakpoints->{$_}) } keys %$breakpoints;
+    my @kept = (sort { $stamps{$b} <=> $stamps{$a} } keys %stamps)[0..$self->{'max_breakpoints'} - 1];
+    $breakpoints = {map { $_ => $breakpoints->{$_} } @kept};
+    $self->{'breakpoints'} = $breakpoints;
+  }
+  # written under another name first, so a run reading it meanwhile never reads a partial memo
+  nstore({'source' => $self->{'source'}, 'breakpoints' => $breakpoints}, "$file.tmp.$$") or die "Could not write file '$file.tmp.$$' $!";
+  rename("$file.tmp.$$", $file) or die "Could not rename file '$file.tmp.$$' $!";
+  close($lfh);
+  $self->{'added'} = 0;
+  return 1;
+}
+
+1;
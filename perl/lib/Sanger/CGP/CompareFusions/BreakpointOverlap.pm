@@ -0,0 +1,231 @@
+package Sanger::CGP::CompareFusions::BreakpointOverlap;
+##########LICENCE ##########
+#Copyright (c) 2015-2026 Genome Research Ltd.
+###
+#Author: Cancer Genome Project <cgpit@sanger.ac.uk>
+###
+#This file is part of cgpRna.
+###
+#cgpRna is free software: you can redistribute it and/or modify it under
+#the terms of the GNU Affero General Public License as published by the
+#Free Software Foundation; either version 3 of the License, or (at your
+#option) any later version.
+###
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+#General Public License for more details.
+###
+#You should have received a copy of the GNU Affero General Public
+#License along with this program. If not, see
+#<http://www.gnu.org/licenses/>.
+###
+#1. The usage of a range of years within a copyright statement contained
+#within this distribution should be interpreted as being equivalent to a
+#list of years including the first and last year specified and all
+#consecutive years between them. For example, a copyright statement that
+#reads ‘Copyright (c) 2005, 2007- 2009, 2011-2012’ should be interpreted
+#as being identical to a statement that reads ‘Copyright (c) 2005, 2007,
+#2008, 2009, 2011, 2012’ and a copyright statement that reads ‘Copyright
+#(c) 2005-2012’ should be interpreted as being identical to a statement
+#that reads ‘Copyright (c) 2005, 2006, 2007, 2008, 2009, 2010, 2011,
+#2012’."
+##########LICENCE ##########
+##########
+# In-process breakpoint overlap and exon annotation, in place of bedtools pairtopair, sort and join and of
+# bedtools closest and sort. Breakpoint pairs and exons are held in per chromosome arrays sorted by start, which
+# are searched with a binary search, so no intermediate files are written and no processes are started. The
+# results are the lines the external tools would write, in the order they would write them.
+use strict;
+use warnings FATAL => 'all';
+use autodie qw(:all);
+use Const::Fast qw(const);
+
+use Sanger::CGP::CgpRna;
+our $VERSION = Sanger::CGP::CgpRna->VERSION;
+
+# bedtools pairtopair -slop, added to both ends of the pairs of the first file
+const my $PAIRTOPAIR_SLOP => 5;
+# columns of the junction BEDPE files, see Sanger::CGP::CompareFusions::Implement::create_junction_bedpe
+const my $BEDPE_NAME => 7;
+const my $BEDPE_STRAND1 => 8;
+const my $BEDPE_STRAND2 => 9;
+const my $BED_CHR => 0;
+const my $BED_END => 2;
+const my $BED_BREAKPOINT => 3;
+const my $BED_STRAND => 5;
+
+# Returns the lines of a file as array references of their tab separated fields.
+sub read_records {
+  my $file = shift;
+  my @records;
+  open(my $ifh, $file) or die "Could not open file '$file' $!";
+  while(<$ifh>) {
+    chomp;
+    push @records, [split "\t", $_, -1];
+  }
+  close($ifh);
+  return \@records;
+}
+
+# Returns an index of intervals, array references of chromosome, 0 based start, end and a value, by chromosome
+# and sorted by start, along with the longest interval of each chromosome to bound searches.
+sub _interval_index {
+  my $intervals = shift;
+  my %index;
+  for my $interval(@$intervals) {
+    my $chr_index = $index{$interval->[0]} ||= {'intervals' => [], 'max_length' => 0};
+    push @{$chr_index->{'intervals'}}, $interval;
+    my $length = $interval->[2] - $interval->[1];
+    $chr_index->{'max_length'} = $length if($length > $chr_index->{'max_length'});
+  }
+  for my $chr_index(values %index) {
+    @{$chr_index->{'intervals'}} = sort { $a->[1] <=> $b->[1] } @{$chr_index->{'intervals'}};
+    $chr_index->{'starts'} = [map { $_->[1] } @{$chr_index->{'intervals'}}];
+  }
+  return \%index;
+}
+
+# Returns the intervals of an index overlapping the half open interval start to end, in the order of their start.
+sub _overlapping {
+  my ($index, $chr, $start, $end) = @_;
+  my $chr_index = $index->{$chr};
+  return () unless(defined $chr_index);
+  my $starts = $chr_index->{'starts'};
+
+  # first interval which may reach start
+  my $min_start = $start - $chr_index->{'max_length'};
+  my ($low, $high) = (0, scalar @$starts);
+  while($low < $high) {
+    my $mid = int(($low + $high) / 2);
+    if($starts->[$mid] <= $min_start) {
+      $low = $mid + 1;
+    }
+    else {
+      $high = $mid;
+    }
+  }
+
+  my @found;
+  for(my $i = $low; $i < @$starts && $starts->[$i] < $end; $i++) {
+    my $interval = $chr_index->{'intervals'}->[$i];
+    push @found, $interval if($interval->[2] > $start);
+  }
+  return @found;
+}
+
+# Returns the lines "bedtools pairtopair -a <a> -b <b> -slop 5" writes for two lists of BEDPE records: the
+# fields of a pair of the first list followed by those of each pair of the second list overlapping it. Both
+# ends have to overlap on the same strand, either end 1 with end 1 and end 2 with end 2, or the other way
+# around. The lines follow the order of the first list, and hits the order of the second.
+sub pair_to_pair {
+  my ($a_records, $b_records) = @_;
+
+  my (@ends1, @ends2);
+  for my $i(0..$#$b_records) {
+    my $b_pair = $b_records->[$i];
+    push @ends1, [$b_pair->[0], $b_pair->[1], $b_pair->[2], $i];
+    push @ends2, [$b_pair->[3], $b_pair->[4], $b_pair->[5], $i];
+  }
+  my $index1 = _interval_index(\@ends1);
+  my $index2 = _interval_index(\@ends2);
+
+  my @lines;
+  for my $a_pair(@$a_records) {
+    my @a_start = map { $_ < 0 ? 0 : $_ } ($a_pair->[1] - $PAIRTOPAIR_SLOP, $a_pair->[4] - $PAIRTOPAIR_SLOP);
+    my @a_end = ($a_pair->[2] + $PAIRTOPAIR_SLOP, $a_pair->[5] + $PAIRTOPAIR_SLOP);
+    my @a_strand = ($a_pair->[$BEDPE_STRAND1], $a_pair->[$BEDPE_STRAND2]);
+
+    # hits of each end of the pair on each end of the second list, on the same strand
+    my %hits;
+    for my $a_end(0, 1) {
+      my $chr = $a_end == 0 ? $a_pair->[0] : $a_pair->[3];
+      for my $b_end(0, 1) {
+        my $strand_col = $b_end == 0 ? $BEDPE_STRAND1 : $BEDPE_STRAND2;
+        $hits{$a_end.$b_end} = {
+          map { $_->[3] => 1 }
+          grep { $b_records->[$_->[3]]->[$strand_col] eq $a_strand[$a_end] }
+          _overlapping($b_end == 0 ? $index1 : $index2, $chr, $a_start[$a_end], $a_end[$a_end])
+        };
+      }
+    }
+    my %matches;
+    $matches{$_} = 1 for(grep { exists $hits{'11'}->{$_} } keys %{$hits{'00'}});
+    $matches{$_} = 1 for(grep { exists $hits{'10'}->{$_} } keys %{$hits{'01'}});
+    for my $i(sort { $a <=> $b } keys %matches) {
+      push @lines, join("\t", @$a_pair, @{$b_records->[$i]});
+    }
+  }
+  return \@lines;
+}
+
+# Returns the lines "join -1 8 -2 8" writes for two lists of pairtopair lines, each sorted with "sort -k8,8",
+# i.e. the pairs of the first BEDPE file found in both lists: the name, the other fields of the line of the
+# first list and the other fields of the line of the second list, space separated, for every combination of
+# them.
+sub join_on_name {
+  my ($lines1, $lines2) = @_;
+  my %by_name2;
+  for my $line(@$lines2) {
+    my @fields = split "\t", $line, -1;
+    push @{$by_name2{$fields[$BEDPE_NAME]}}, \@fields;
+  }
+  my %by_name1;
+  for my $line(@$lines1) {
+    my @fields = split "\t", $line, -1;
+    push @{$by_name1{$fields[$BEDPE_NAME]}}, \@fields;
+  }
+
+  my @joined;
+  for my $name(sort keys %by_name1) {
+    next unless(exists $by_name2{$name});
+    # sort falls back to comparing whole lines where the keys are the same
+    my @rows1 = sort { join("\t", @$a) cmp join("\t", @$b) } @{$by_name1{$name}};
+    my @rows2 = sort { join("\t", @$a) cmp join("\t", @$b) } @{$by_name2{$name}};
+    for my $row1(@rows1) {
+      my @fields1 = @$row1;
+      splice(@fields1, $BEDPE_NAME, 1);
+      for my $row2(@rows2) {
+        my @fields2 = @$row2;
+        splice(@fields2, $BEDPE_NAME, 1);
+        push @joined, join(' ', $name, @fields1, @fields2);
+      }
+    }
+  }
+  return \@joined;
+}
+
+# Returns the index of the exons of a GTF file, filtered as Sanger::CGP::CompareFusions::Implement::filter_gtf
+# filters it, by chromosome. Exons are half open intervals with their strand and GTF line.
+sub exon_index {
+  my $exon_gtf = shift;
+  my @exons;
+  open(my $ifh, $exon_gtf) or die "Could not open file '$exon_gtf' $!";
+  while(<$ifh>) {
+    chomp;
+    my @fields = split "\t", $_;
+    next if(scalar @fields < 9);
+    push @exons, [$fields[0], $fields[3] - 1, $fields[4], [$fields[6], $_]];
+  }
+  close($ifh);
+  return _interval_index(\@exons);
+}
+
+# Returns the lines "bedtools closest -s -a <bed> -b <exon gtf> | sort -k4,4" writes which overlap an exon: the
+# breakpoint BED line followed by the GTF line of each exon on the same strand it falls in. Breakpoints falling
+# in no exon are left out, as only the exons a breakpoint falls in are used for its annotation.
+sub overlapping_exons {
+  my ($bed_records, $exon_index) = @_;
+  my @lines;
+  for my $bed(@$bed_records) {
+    my $break_pos = $bed->[$BED_END];
+    for my $exon(_overlapping($exon_index, $bed->[$BED_CHR], $break_pos - 1, $break_pos)) {
+      next unless($exon->[3]->[0] eq $bed->[$BED_STRAND]);
+      push @lines, [$bed->[$BED_BREAKPOINT], join("\t", @$bed, $exon->[3]->[1])];
+    }
+  }
+  # sort falls back to comparing whole lines where the breakpoints are the same
+  return [map { $_->[1] } sort { $a->[0] cmp $b->[0] || $a->[1] cmp $b->[1] } @lines];
+}
+
+1;
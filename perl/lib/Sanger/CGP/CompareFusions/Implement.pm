@@ -43,6 +43,9 @@ use FindBin qw($Bin);
 use File::Spec;
 use PCAP::Cli;
 use PCAP::Threaded;
+use Sanger::CGP::CompareFusions::AnnotationIndex;
+use Sanger::CGP::CompareFusions::AnnotationMemo;
+use Sanger::CGP::CompareFusions::BreakpointOverlap;
 use Sanger::CGP::CompareFusions::FusionAnnotation;
 use Sanger::CGP::CgpRna;
 use Sanger::CGP::Vagrent::TranscriptSource::FileBasedTranscriptSource;
@@ -221,6 +224,8 @@ sub annotate_bed {
 
   my $tmp = $options->{'tmp'};
   return 1 if PCAP::Threaded::success_exists(File::Spec->catdir($tmp, 'progress'), 0);
+  # select_annotation finds the exons of the breakpoints in process, unless bedtools is to be used.
+  return 1 unless($options->{'bedtools'});
 
   my $sample = $options->{'sample'};
   my $exon_gtf = filter_gtf($options, 'exon');
@@ -253,30 +258,6 @@ sub annotate_bed {
   return 1;
 }
 
-sub annotation_sort {
-        my $a_ccds = 0;
-        my $b_ccds = 0;
-        if(defined($a->getCCDS) && $a->getCCDS ne ''){
-                $a_ccds = 1;
-        }
-        if(defined($b->getCCDS) && $b->getCCDS ne ''){
-                $b_ccds = 1;
-        }
-        my $ccds_cmp = $b_ccds <=> $a_ccds;
-        if($ccds_cmp == 0){
-                my $a_cds_len = $a->getCdsLength;
-                my $b_cds_len = $b->getCdsLength;
-                my $cds_len_cmp = $b_cds_len <=> $a_cds_len;
-                if($cds_len_cmp == 0){
-                        return $b->getmRNALength <=> $a->getmRNALength;
-                } else {
-                        return $cds_len_cmp;
-                }
-        } else {
-                return $ccds_cmp;
-        }
-}
-
 sub check_input {
   my $fusion_file = shift;
 
@@ -537,6 +518,15 @@ sub filter_gtf {
 
   my $filtered_gtf = File::Spec->catfile($tmp, "filtered_$feature.gtf");
 
+  # Link to the copy written along with the compiled annotation index of the GTF, if it has one.
+  unless (-e $filtered_gtf){
+    my $indexed_gtf = Sanger::CGP::CompareFusions::AnnotationIndex::filtered_gtf($gtf, $feature);
+    if(defined $indexed_gtf){
+      symlink $indexed_gtf, $filtered_gtf;
+      return $filtered_gtf;
+    }
+  }
+
   unless (-e $filtered_gtf){
   open (my $ifh, $gtf) or die "Could not open file '$gtf' $!";
   open(my $ofh, '>', $filtered_gtf) or die "Could not open file '$filtered_gtf' $!";
@@ -711,6 +701,39 @@ sub generate_output {
   return 1;
 }
 
+sub overlap_lines {
+  # Returns the lines of the overlaps between the junction BEDPE files of the algorithms in files, e.g. '1_2', or
+  # between all three for '1_2_3'. They are read from the files written by run_bed_pairtopair if bedtools is to
+  # be used, otherwise they are found in process, once for each files, and kept in overlaps.
+  my ($options, $files, $overlaps) = @_;
+
+  my $tmp = $options->{'tmp'};
+  my $sample = $options->{'sample'};
+
+  if($options->{'bedtools'}){
+    my @lines;
+    my $overlap_file = File::Spec->catfile($tmp, "$files.$sample.bedpe_overlap");
+    open (my $ifh, $overlap_file) or die "Could not open file '$overlap_file' $!";
+    while (<$ifh>) {
+      chomp;
+      push @lines, $_;
+    }
+    close($ifh);
+    return \@lines;
+  }
+
+  unless(exists $overlaps->{$files}){
+    if($files eq '1_2_3'){
+      $overlaps->{$files} = Sanger::CGP::CompareFusions::BreakpointOverlap::join_on_name(overlap_lines($options, '1_2', $overlaps), overlap_lines($options, '1_3', $overlaps));
+    }
+    else{
+      my @records = map { Sanger::CGP::CompareFusions::BreakpointOverlap::read_records(File::Spec->catfile($tmp, "$_.$sample.bedpe")) } split '_', $files;
+      $overlaps->{$files} = Sanger::CGP::CompareFusions::BreakpointOverlap::pair_to_pair(@records);
+    }
+  }
+  return $overlaps->{$files};
+}
+
 sub parse_annotation {
   my $line = shift;
   $line =~ s/"//g;
@@ -1025,71 +1048,22 @@ sub parse_tophat_file {
 }
 
 sub parse_transcript_data {
-  my ($fusion, $breaknum, $transcripts) = @_;
-  my @filteredTrans;
-  foreach my $t(@{$transcripts}){
-		push(@filteredTrans, $t) if ($fusion->{'pos'.$breaknum.'_end'} >= $t->getGenomicMinPos && $fusion->{'pos'.$breaknum.'_end'} <= $t->getGenomicMaxPos);
-	}
-	my @sortedTrans = sort{&annotation_sort} @filteredTrans;
-
-	if(defined $sortedTrans[0]){
-    my $vagrent_genename;
-	  my $exon_number;
-		my $exon_start;
-		my $exon_end;
-		my $transcript_id;
-		my $gene_biotype;
-		my $found_exon_boundary = 0;
-		my $found_exon = 0;
-		my $curr_distance = 10000000;
-		my $num_transcripts = scalar @sortedTrans;
-		for (my $x=0;$x<$num_transcripts; $x++){
-		  my @exons = $sortedTrans[$x]->getExons;
-		  my $num_exons = scalar @exons;
-		  for (my $y=0;$y<$num_exons; $y++){
-		    my $e = $exons[$y];
-		    if($fusion->{'pos'.$breaknum.'_end'} == $e->getMinPos || $fusion->{'pos'.$breaknum.'_end'} == $e->getMaxPos){
-		      $found_exon_boundary = 1;
-		      $transcript_id = $sortedTrans[$x]->getAccession;
-		      $gene_biotype = $sortedTrans[$x]->{'_genetype'};
-		      $exon_start = $e->getMinPos;
-		      $exon_end = $e->getMaxPos;
-		      $exon_number = $y+1;
-					$vagrent_genename = $sortedTrans[$x]->{'_genename'};
-		      last;
-		    }elsif($fusion->{'pos'.$breaknum.'_end'} > $e->getMinPos && $fusion->{'pos'.$breaknum.'_end'} < $e->getMaxPos){
-		       my $distance = find_closest_boundary($fusion->{'pos'.$breaknum.'_end'}, $e->getMinPos, $e->getMaxPos);
-		       if ($distance < $curr_distance){
-		         $found_exon = 1;
-		         $transcript_id = $sortedTrans[$x]->getAccession;
-		         $gene_biotype = $sortedTrans[$x]->{'_genetype'};
-		         $exon_start = $e->getMinPos;
-		         $exon_end = $e->getMaxPos;
-		         $exon_number = $y+1;
-		  			 $vagrent_genename = $sortedTrans[$x]->{'_genename'};
-		       }
-		    }
-		  }
-		  last if($found_exon_boundary);
-		}
-
-  if(defined $vagrent_genename){
-    if($vagrent_genename eq $fusion->{'gene'.$breaknum} && ($found_exon_boundary || $found_exon)){
-		    if($breaknum == 1){
-		      $fusion->transcript1_id($transcript_id);
-		      $fusion->gene1_biotype($gene_biotype);
-		      $fusion->exon1_num($exon_number);
-		      $fusion->feature1_start($exon_start);
-		      $fusion->feature1_end($exon_end);
-		    }
-		    else{
-			    $fusion->transcript2_id($transcript_id);
-		      $fusion->gene2_biotype($gene_biotype);
-		      $fusion->exon2_num($exon_number);
-		      $fusion->feature2_start($exon_start);
-		      $fusion->feature2_end($exon_end);
-        }
-	    }
+  # The annotation of the breakpoint, found by Sanger::CGP::CompareFusions::AnnotationMemo, is only used if it is of the gene the fusion caller reported.
+  my ($fusion, $breaknum, $annotation) = @_;
+  if(defined $annotation && defined $annotation->{'gene_name'} && $annotation->{'gene_name'} eq $fusion->{'gene'.$breaknum}){
+    if($breaknum == 1){
+      $fusion->transcript1_id($annotation->{'transcript_id'});
+      $fusion->gene1_biotype($annotation->{'gene_biotype'});
+      $fusion->exon1_num($annotation->{'exon_number'});
+      $fusion->feature1_start($annotation->{'exon_start'});
+      $fusion->feature1_end($annotation->{'exon_end'});
+    }
+    else{
+      $fusion->transcript2_id($annotation->{'transcript_id'});
+      $fusion->gene2_biotype($annotation->{'gene_biotype'});
+      $fusion->exon2_num($annotation->{'exon_number'});
+      $fusion->feature2_start($annotation->{'exon_start'});
+      $fusion->feature2_end($annotation->{'exon_end'});
     }
   }
   return $fusion;
@@ -1120,12 +1094,24 @@ sub parse_vagrent_query_file {
 sub process_annotation_file {
   my ($input) = @_;
 
-  my %exon_annotation;
+  my @lines;
 
   open (my $ifh1, $input) or die "Could not open file '$input' $!";
   while (<$ifh1>){
     chomp;
-    my $line = $_;
+    push @lines, $_;
+  }
+  close ($ifh1);
+
+  return process_annotation_lines(\@lines);
+}
+
+sub process_annotation_lines {
+  my ($lines) = @_;
+
+  my %exon_annotation;
+
+  for my $line(@$lines){
     my $annotation = parse_annotation($line);
     if($annotation->{'gene_name'} eq $annotation->{'genename'}){
       my $break = $annotation->{'breakpoint'};
@@ -1133,7 +1119,6 @@ sub process_annotation_file {
       $exon_annotation{$break}{$exon} = $annotation;
     }
   }
-  close ($ifh1);
 
   return \%exon_annotation;
 }
@@ -1153,16 +1138,13 @@ sub process_overlap_files {
 
   my $output_file = File::Spec->catfile($tmp, "$sample.vagrent.query.list");
   my %all_fusions;
+  my %overlaps;
   my $cols;
 
   if($options->{'num'} == 3){
     my $source3 = $options->{'fusion_files'}->{'3'}->{'format'};
     $source_comb = uc(substr($source1,0,1).substr($source2,0,1).substr($source3,0,1));
-    my $overlap_file1_2_3 = File::Spec->catfile($tmp, "1_2_3.$sample.bedpe_overlap");
-    open (my $ifh1, $overlap_file1_2_3) or die "Could not open file '$overlap_file1_2_3' $!";
-    while (<$ifh1>) {
-      chomp;
-      my $line = $_;
+    for my $line(@{overlap_lines($options, '1_2_3', \%overlaps)}) {
       my $fusion = parse_intersection($line);
       my $breakpoint = $fusion->breakpoint();
 
@@ -1171,14 +1153,9 @@ sub process_overlap_files {
         $all_fusions{$breakpoint}{'source'} = $source_comb;
       }
     }
-    close($ifh1);
 
     $source_comb = uc(substr($source1,0,1).substr($source3,0,1));
-    my $overlap_file1_3 = File::Spec->catfile($tmp, "1_3.$sample.bedpe_overlap");
-    open (my $ifh2, $overlap_file1_3) or die "Could not open file '$overlap_file1_3' $!";
-    while (<$ifh2>) {
-      chomp;
-      my $line = $_;
+    for my $line(@{overlap_lines($options, '1_3', \%overlaps)}) {
       my $fusion = parse_overlap($line);
       my $breakpoint = $fusion->breakpoint();
 
@@ -1187,14 +1164,9 @@ sub process_overlap_files {
         $all_fusions{$breakpoint}{'source'} = $source_comb;
       }
     }
-    close($ifh2);
 
     $source_comb = uc(substr($source2,0,1).substr($source3,0,1));
-    my $overlap_file2_3 = File::Spec->catfile($tmp, "2_3.$sample.bedpe_overlap");
-    open (my $ifh3, $overlap_file2_3) or die "Could not open file '$overlap_file2_3' $!";
-    while (<$ifh3>) {
-      chomp;
-      my $line = $_;
+    for my $line(@{overlap_lines($options, '2_3', \%overlaps)}) {
       my $fusion = parse_overlap($line);
       my $breakpoint = $fusion->breakpoint();
 
@@ -1203,15 +1175,10 @@ sub process_overlap_files {
         $all_fusions{$breakpoint}{'source'} = $source_comb;
       }
     }
-    close($ifh3);
   }
 
-  my $overlap_file1_2 = File::Spec->catfile($tmp, "1_2.$sample.bedpe_overlap");
   $source_comb = uc(substr($source1,0,1).substr($source2,0,1));
-  open (my $ifh4, $overlap_file1_2) or die "Could not open file '$overlap_file1_2' $!";
-  while (<$ifh4>) {
-    chomp;
-    my $line = $_;
+  for my $line(@{overlap_lines($options, '1_2', \%overlaps)}) {
     my $fusion = parse_overlap($line);
     my $breakpoint = $fusion->breakpoint();
 
@@ -1220,7 +1187,6 @@ sub process_overlap_files {
       $all_fusions{$breakpoint}{'source'} = $source_comb;
     }
   }
-  close($ifh4);
 
   open(my $ofh1, '>', $output_file) or die "Could not open file '$output_file' $!";
   for my $brk (keys %all_fusions){
@@ -1398,19 +1364,25 @@ sub query_vagrent {
   my $defuse_file = $options->{'fusion_files'}->{'3'}->{'name'};
 
   my $gene_list = parse_star_file($star_file);
-  my $gene_gtf = filter_gtf($options, 'gene');
 
   my %gene_info;
-  open (my $ifh1, $gene_gtf) or die "Could not open file '$gene_gtf' $!";
-  while (<$ifh1>) {
-    chomp;
-    my $line = $_;
-    my $gene_annot = parse_gene_info($line);
-    if(!exists $gene_info{$gene_annot->{'gene_name'}}){
-      $gene_info{$gene_annot->{'gene_name'}} = $gene_annot->{'gene_id'};
+  my $indexed_genes = Sanger::CGP::CompareFusions::AnnotationIndex::gene_info($options->{'gtf'});
+  if(defined $indexed_genes){
+    %gene_info = map { $_ => $indexed_genes->{$_}->{'gene_id'} } keys %$indexed_genes;
+  }
+  else{
+    my $gene_gtf = filter_gtf($options, 'gene');
+    open (my $ifh1, $gene_gtf) or die "Could not open file '$gene_gtf' $!";
+    while (<$ifh1>) {
+      chomp;
+      my $line = $_;
+      my $gene_annot = parse_gene_info($line);
+      if(!exists $gene_info{$gene_annot->{'gene_name'}}){
+        $gene_info{$gene_annot->{'gene_name'}} = $gene_annot->{'gene_id'};
+      }
     }
+    close ($ifh1);
   }
-  close ($ifh1);
 
   my %rev_gene_info = reverse %gene_info;
 
@@ -1463,6 +1435,8 @@ sub query_vagrent {
 	my $vagrent_version = "VAGrENT_".Sanger::CGP::Vagrent->VERSION;
 
 	my $ts = Sanger::CGP::Vagrent::TranscriptSource::FileBasedTranscriptSource->new('cache' => $options->{'cache'});
+	# breakpoints annotated before, by any caller, sample or run, are not queried again
+	my $memo = Sanger::CGP::CompareFusions::AnnotationMemo->new($options->{'cache'}, $options->{'annotation_memo'}, $options->{'annotation_memo_size'});
 	my %breaklist;
 
 	my $vagrent_query_file = File::Spec->catfile($tmp, "$sample.vagrent.query.list");
@@ -1482,16 +1456,17 @@ sub query_vagrent {
 
 	  unless($genomic_pos1->{'_chr'} eq 'GL000219.1' || $genomic_pos2->{'_chr'} eq 'GL000219.1' || $genomic_pos1->{'_chr'} eq 'KI270726.1' || $genomic_pos2->{'_chr'} eq 'KI270726.1'){
 
-      my @trans1 = $ts->getTranscripts($genomic_pos1);
-      my @trans2 = $ts->getTranscripts($genomic_pos2);
+      my $annotation1 = $memo->annotate($fusion->{'chr1'}, $fusion->{'pos1_end'}, sub { return $ts->getTranscripts($genomic_pos1) });
+      my $annotation2 = $memo->annotate($fusion->{'chr2'}, $fusion->{'pos2_end'}, sub { return $ts->getTranscripts($genomic_pos2) });
 
-      $fusion = parse_transcript_data($fusion, 1, \@trans1);
-      $fusion = parse_transcript_data($fusion, 2, \@trans2);
+      $fusion = parse_transcript_data($fusion, 1, $annotation1);
+      $fusion = parse_transcript_data($fusion, 2, $annotation2);
     }
 
 		$breaklist{$fusion->{'breakpoint'}} = $fusion if(!exists $breaklist{$fusion->{'breakpoint'}});
   }
   close ($ifh2);
+  $memo->save;
 
 	my $final_annot_file1 = File::Spec->catfile($tmp, "$sample.1.ann_final");
 	my $final_annot_file2 = File::Spec->catfile($tmp, "$sample.2.ann_final");
@@ -1543,6 +1518,8 @@ sub run_bed_pairtopair {
 
   my $tmp = $options->{'tmp'};
   return 1 if PCAP::Threaded::success_exists(File::Spec->catdir($tmp, 'progress'), 0);
+  # process_overlap_files finds the overlaps in process, unless bedtools is to be used.
+  return 1 unless($options->{'bedtools'});
 
   my $sample = $options->{'sample'};
 
@@ -1604,27 +1581,47 @@ sub select_annotation {
   my $exon_annotation1;
   my $exon_annotation2;
 
-	if(-s $annot_file1){
-    $exon_annotation1 = process_annotation_file($annot_file1);
-	}
-	if(-s $annot_file2){
-    $exon_annotation2 = process_annotation_file($annot_file2);
-	}
+  if($options->{'bedtools'}){
+	  if(-s $annot_file1){
+      $exon_annotation1 = process_annotation_file($annot_file1);
+	  }
+	  if(-s $annot_file2){
+      $exon_annotation2 = process_annotation_file($annot_file2);
+	  }
+  }
+  else{
+    # The lines bedtools closest would have written to the annotation files, found in process.
+    my $exon_index = Sanger::CGP::CompareFusions::BreakpointOverlap::exon_index(filter_gtf($options, 'exon'));
+    if(-s $bed_file1){
+      $exon_annotation1 = process_annotation_lines(Sanger::CGP::CompareFusions::BreakpointOverlap::overlapping_exons(Sanger::CGP::CompareFusions::BreakpointOverlap::read_records($bed_file1), $exon_index));
+    }
+    if(-s $bed_file2){
+      $exon_annotation2 = process_annotation_lines(Sanger::CGP::CompareFusions::BreakpointOverlap::overlapping_exons(Sanger::CGP::CompareFusions::BreakpointOverlap::read_records($bed_file2), $exon_index));
+    }
+  }
 
-	my $gene_gtf = File::Spec->catfile($tmp, "filtered_gene.gtf");
   my %gene_info;
-
-  open (my $ifh1, $gene_gtf) or die "Could not open file '$gene_gtf' $!";
-  while (<$ifh1>) {
-    chomp;
-    my $line = $_;
-    my $gene_annot = parse_gene_info($line);
-    if(!exists $gene_info{$gene_annot->{'gene_name'}}){
-      $gene_info{$gene_annot->{'gene_name'}}{'feature_start'} = $gene_annot->{'start'};
-      $gene_info{$gene_annot->{'gene_name'}}{'feature_end'} = $gene_annot->{'end'};
+  my $indexed_genes = Sanger::CGP::CompareFusions::AnnotationIndex::gene_info($options->{'gtf'});
+  if(defined $indexed_genes){
+    for my $gene_name(keys %$indexed_genes){
+      $gene_info{$gene_name}{'feature_start'} = $indexed_genes->{$gene_name}->{'start'};
+      $gene_info{$gene_name}{'feature_end'} = $indexed_genes->{$gene_name}->{'end'};
     }
   }
-  close ($ifh1);
+  else{
+    my $gene_gtf = filter_gtf($options, 'gene');
+    open (my $ifh1, $gene_gtf) or die "Could not open file '$gene_gtf' $!";
+    while (<$ifh1>) {
+      chomp;
+      my $line = $_;
+      my $gene_annot = parse_gene_info($line);
+      if(!exists $gene_info{$gene_annot->{'gene_name'}}){
+        $gene_info{$gene_annot->{'gene_name'}}{'feature_start'} = $gene_annot->{'start'};
+        $gene_info{$gene_annot->{'gene_name'}}{'feature_end'} = $gene_annot->{'end'};
+      }
+    }
+    close ($ifh1);
+  }
 
 	my $bed1;
   my $bed2;
@@ -0,0 +1,138 @@
+package Sanger::CGP::FusionFilter::NormalPanel;
+##########LICENCE ##########
+#Copyright (c) 2015-2026 Genome Research Ltd.
+###
+#Author: Cancer Genome Project <cgpit@sanger.ac.uk>
+###
+#This file is part of cgpRna.
+###
+#cgpRna is free software: you can redistribute it and/or modify it under
+#the terms of the GNU Affero General Public License as published by the
+#Free Software Foundation; either version 3 of the License, or (at your
+#option) any later version.
+###
+#This program is distributed in the hope that it will be useful, but
+#WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero
+#General Public License for more details.
+###
+#You should have received a copy of the GNU Affero General Public
+#License along with this program. If not, see
+#<http://www.gnu.org/licenses/>.
+###
+#1. The usage of a range of years within a copyright statement contained
+#within this distribution should be interpreted as being equivalent to a
+#list of years including the first and last year specified and all
+#consecutive years between them. For example, a copyright statement that
+#reads ‘Copyright (c) 2005, 2007- 2009, 2011-2012’ should be interpreted
+#as being identical to a statement that reads ‘Copyright (c) 2005, 2007,
+#2008, 2009, 2011, 2012’ and a copyright statement that reads ‘Copyright
+#(c) 2005-2012’ should be interpreted as being identical to a statement
+#that reads ‘Copyright (c) 2005, 2006, 2007, 2008, 2009, 2010, 2011,
+#2012’."
+##########LICENCE ##########
+##########
+# The panel of fusions called in normal samples, which fusion calls are filtered against. A normal fusions list,
+# whose first column holds breakpoint references (chr1:pos1-chr2:pos2), is compiled once with
+# build_normal_panel.pl into <list>.cgprna.panel next to it, so filter_fusions.pl does not parse the list for
+# every sample and caller. The compiled panel is a hash of the breakpoint references, for exact matches, and of
+# the breakpoints by chromosome pair and window of the first position, for matches within a tolerance.
+use strict;
+use warnings FATAL => 'all';
+use Const::Fast qw(const);
+use Storable qw(nstore retrieve);
+
+use Sanger::CGP::CgpRna;
+our $VERSION = Sanger::CGP::CgpRna->VERSION;
+
+const my $PANEL_SUFFIX => '.cgprna.panel';
+const my $FORMAT_VERSION => 1;
+const my $DEFAULT_WINDOW => 1000;
+
+sub panel_file {
+  my $list = shift;
+  return $list.$PANEL_SUFFIX;
+}
+
+# Splits a breakpoint reference into the chromosomes and positions of its two breakpoints, returns an empty list
+# if it is not one.
+sub _breakpoints {
+  my $breakpoint_ref = shift;
+  return $breakpoint_ref =~ m/^([^:]+):(\d+)-(.+):(\d+)$/ ? ($1, $2, $3, $4) : ();
+}
+
+# Returns the panel of a normal fusions list, with positions indexed in windows of window bases.
+sub compile_panel {
+  my ($list, $window) = @_;
+  $window = $DEFAULT_WINDOW unless(defined $window);
+  my %panel = ('version' => $FORMAT_VERSION,
+               'list_size' => -s $list,
+               'list_mtime' => (stat $list)[9],
+               'window' => $window,
+               'refs' => {},
+               'windows' => {});
+
+  open(my $ifh, $list) or die "Could not open file '$list' $!";
+  while(<$ifh>) {
+    my ($breakpoint_ref) = split ' ', $_;
+    next unless(defined $breakpoint_ref);
+    next if(exists $panel{'refs'}->{$breakpoint_ref});
+    $panel{'refs'}->{$breakpoint_ref} = 1;
+    my ($chr1, $pos1, $chr2, $pos2) = _breakpoints($breakpoint_ref);
+    next unless(defined $chr1);
+    push @{$panel{'windows'}->{"$chr1\t$chr2"}->{int($pos1 / $window)}}, $pos1, $pos2;
+  }
+  close($ifh);
+  return \%panel;
+}
+
+# Compiles a normal fusions list and writes the panel next to it.
+sub build_panel {
+  my ($list, $window) = @_;
+  my $panel = compile_panel($list, $window);
+  my $panel_file = panel_file($list);
+  # written under another name first, so a filter running meanwhile never reads a partial panel
+  nstore($panel, "$panel_file.tmp") or die "Could not write file '$panel_file.tmp' $!";
+  rename("$panel_file.tmp", $panel_file) or die "Could not rename file '$panel_file.tmp' $!";
+  return $panel;
+}
+
+# Returns the compiled panel of a normal fusions list, or compiles it from the list if it has not been built or
+# is older than the list.
+sub load_panel {
+  my $list = shift;
+  my $panel_file = panel_file($list);
+  if(-e $panel_file) {
+    my $panel = retrieve($panel_file);
+    if($panel->{'version'} == $FORMAT_VERSION && $panel->{'list_size'} == -s $list && $panel->{'list_mtime'} == (stat $list)[9]) {
+      return $panel;
+    }
+    warn "Normal fusions panel $panel_file is stale, $list is used instead.\n";
+  }
+  return compile_panel($list);
+}
+
+# Returns true if a breakpoint reference is in the panel, or, with a tolerance, if the panel has a fusion
+# between the same chromosomes with both positions within tolerance bases of it.
+sub is_normal {
+  my ($panel, $breakpoint_ref, $tolerance) = @_;
+  return 1 if(exists $panel->{'refs'}->{$breakpoint_ref});
+  return 0 unless($tolerance);
+
+  my ($chr1, $pos1, $chr2, $pos2) = _breakpoints($breakpoint_ref);
+  return 0 unless(defined $chr1);
+  my $windows = $panel->{'windows'}->{"$chr1\t$chr2"};
+  return 0 unless(defined $windows);
+  my $window = $panel->{'window'};
+  my $first = int(($pos1 < $tolerance ? 0 : $pos1 - $tolerance) / $window);
+  for my $i($first..int(($pos1 + $tolerance) / $window)) {
+    my $positions = $windows->{$i};
+    next unless(defined $positions);
+    for(my $j = 0; $j < @$positions; $j += 2) {
+      return 1 if(abs($positions->[$j] - $pos1) <= $tolerance && abs($positions->[$j + 1] - $pos2) <= $tolerance);
+    }
+  }
+  return 0;
+}
+
+1;
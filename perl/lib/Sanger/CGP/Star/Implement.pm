@@ -63,6 +63,9 @@ const my $STAR => q{ %s %s --readFilesIn %s };
 const my $STAR_FUSION => q{ %s --chimeric_out_sam %s --chimeric_junction %s --ref_GTF %s --min_novel_junction_support 10 --min_alt_pct_junction 10.0 --out_prefix %s };
 const my $SAMTOBAM => q{ view -bS %s > %s };
 const my $BAMSORT => q{ I=%s fixmate=1 inputformat=bam level=1 tmpfile=%s/tmp O=%s inputthreads=%s outputthreads=%s};
+const my $BAMSORT_STREAM => q{ fixmate=1 inputformat=bam level=1 tmpfile=%s/tmp inputthreads=%s outputthreads=%s};
+const my $TEE => q{ %s};
+const my $MARKDUP_STREAM => q{ O=%s md5=1 index=1 markthreads=%s md5filename=%s.md5 indexfilename=%s.bai M=%s tmpfile=%s/biormdup};
 const my $HD_LINE => '@HD	VN:1.4	SO:unsorted';
 
 sub check_input {
@@ -379,11 +382,18 @@ sub process_star_params {
 	}
 
 	$cfg->setval($STAR_DEFAULTS_SECTION, 'sjdbGTFfile', $gtf);
+	# STAR cannot insert junctions on the fly into a genome in shared memory, they have to be in the index.
+	if(exists $options->{'genome_load'}) {
+		$cfg->setval($STAR_DEFAULTS_SECTION, 'genomeLoad', $options->{'genome_load'});
+		$cfg->setval($STAR_DEFAULTS_SECTION, 'sjdbGTFfile', '') unless($options->{'genome_load'} eq 'NoSharedMemory');
+	}
 	$cfg->setval($STAR_DEFAULTS_SECTION, 'genomeDir', $star_index);
 	$cfg->setval($STAR_DEFAULTS_SECTION, 'outSAMattrRGline', $options->{'rgline'}) if(defined $options->{'rgline'});
 	$cfg->setval($STAR_DEFAULTS_SECTION, 'outSAMheaderCommentFile', $options->{'commentfile'}) if(defined $options->{'commentfile'});
 	$cfg->setval($STAR_DEFAULTS_SECTION, 'quantMode', 'TranscriptomeSAM') unless(defined $fusion_mode);
 	$cfg->setval($STAR_DEFAULTS_SECTION, 'outSAMheaderHD', $HD_LINE);
+	# When streaming, the unsorted genome BAM goes to stdout, to be sorted and duplicate marked through a pipe.
+	$cfg->setval($STAR_DEFAULTS_SECTION, 'outStd', 'BAM_Unsorted') if($options->{'markdup'} && !defined $fusion_mode);
 
 	my @star_command;
 	my @star_defaults = $cfg->Parameters($STAR_DEFAULTS_SECTION);
@@ -551,13 +561,30 @@ sub star {
 
 	$star_command .= "--readFilesCommand zcat" if($infiles1 =~ m/\.gz$/);
 
-	PCAP::Threaded::external_process_handler(File::Spec->catdir($tmp, 'logs'), $star_command, 1);
-	PCAP::Threaded::touch_success(File::Spec->catdir($tmp, 'progress'), 1);
+	my $stardir = File::Spec->catdir($options->{'tmp'},'star');
+	my $bamsort_path = which('bamsort') || die "Unable to find 'bamsort' in path\n";
 
+	my $fusion_mode;
 
+	if(exists $options->{'fusion_mode'}){
+	  $fusion_mode = $options->{'fusion_mode'};
+	}
+
+	# Stream the genome BAM from STAR through sorting into duplicate marking, which writes the final BAM, its
+	# index and md5 in the output directory. The sorted BAM without duplicates marked is only kept on request.
+	my $stream = $options->{'markdup'} && !defined $fusion_mode;
+	if($stream){
+		my $final_bam = File::Spec->catfile($options->{'outdir'}, $sample.'.bam');
+		# sorting and duplicate marking run alongside STAR, they may be given threads of their own
+		my $markdup_threads = exists $options->{'markdup_threads'} ? $options->{'markdup_threads'} : $threads;
+		$star_command .= ' | '.$bamsort_path.sprintf $BAMSORT_STREAM, $stardir, $markdup_threads, $markdup_threads;
+		$star_command .= ' | '._which('tee').sprintf $TEE, File::Spec->catfile($options->{'outdir'}, $sample.'.star.Aligned.out.bam') if($options->{'keep_unmarked'});
+		$star_command .= ' | '._which('bammarkduplicates2').sprintf $MARKDUP_STREAM, $final_bam, $markdup_threads, $final_bam, $final_bam, $final_bam.'.met', $stardir;
+	}
+
+	PCAP::Threaded::external_process_handler(File::Spec->catdir($tmp, 'logs'), $star_command, 1);
+	PCAP::Threaded::touch_success(File::Spec->catdir($tmp, 'progress'), 1);
 
-	my $stardir = File::Spec->catdir($options->{'tmp'},'star');
-	my $bamsort_path = which('bamsort') || die "Unable to find 'bamsort' in path\n";
 
 	my $bamsort_command1 = $bamsort_path.sprintf $BAMSORT, File::Spec->catfile($stardir, 'Aligned.out.bam'),
 														$stardir,
@@ -571,14 +598,8 @@ sub star {
 														$threads,
 														$threads;
 
-	my $fusion_mode;
-
-	if(exists $options->{'fusion_mode'}){
-	  $fusion_mode = $options->{'fusion_mode'};
-	}
-
 	my @commands;
-	push @commands, $bamsort_command1;
+	push @commands, $bamsort_command1 unless($stream);
 	push @commands, $bamsort_command2 unless(defined $fusion_mode);
 
 	PCAP::Threaded::external_process_handler(File::Spec->catdir($tmp, 'logs'), \@commands, 0);
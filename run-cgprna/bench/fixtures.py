@@ -0,0 +1,228 @@
+'''
+Generators of synthetic inputs for the run-cgprna benchmarks: gzipped FastQ pairs, BAM-like files, GTF files,
+a reference bundle with the members every subcommand extracts, the stats files of stats and the count files of
+count.
+
+Only the size and layout of the files matter to run-cgprna and the stand-in tools, so the "BAM" files are gzip
+streams of packed read records rather than valid BAM files.
+'''
+import os
+import io
+import gzip
+import random
+import struct
+import tarfile
+
+BASES = 'ACGT'
+READ_LENGTH = 100
+# read sequences are drawn from a pool, which keeps generating large files fast
+SEQUENCE_POOL_SIZE = 4096
+CHROMS = [('chr%s' % name, 50000000) for name in list(range(1, 23)) + ['X', 'Y']]
+GENE_BUILD = 'ensembl'
+GTF_NAME = 'ensembl.gtf'
+FASTA_NAME = 'genome.fa'
+NORMAL_FUSIONS = 'normal_fusions.txt'
+BAS_COLUMNS = [
+    'bam_filename', 'sample', 'platform', 'platform_unit', 'library', 'readgroup', 'read_length_r1', 'read_length_r2',
+    '#_mapped_bases', '#_mapped_bases_r1', '#_mapped_bases_r2', '#_divergent_bases', '#_divergent_bases_r1',
+    '#_divergent_bases_r2', '#_total_reads', '#_total_reads_r1', '#_total_reads_r2', '#_mapped_reads',
+    '#_mapped_reads_r1', '#_mapped_reads_r2', '#_mapped_reads_properly_paired', '#_gc_bases_r1', '#_gc_bases_r2',
+    'mean_insert_size', 'insert_size_sd', 'median_insert_size', '#_duplicate_reads', '#_mapped_pairs',
+    '#_inter_chr_pairs']
+# the sample level stats of process_qcstats.pl
+SAMPLE_STATS = [
+    ('insert.bas', ['transcriptome_mean_insert_size', 'transcriptome_insert_size_sd', 'transcriptome_median_insert_size']),
+    ('read.dist.bas', ['#_total_read_dist_reads', '#_exonic_reads', '#_intronic_reads', '#_intergenic_within10kb_reads']),
+    ('rrna.bas', ['#_total_rrna_reads', '#_subset_rrna_reads']),
+    ('gene.cov.bas', ['gene_cov_stat', 'gene_cov_pval'])]
+
+
+def _sequence_pool(rng, read_length):
+    return [''.join(rng.choice(BASES) for _ in range(read_length)) for _ in range(SEQUENCE_POOL_SIZE)]
+
+
+def write_fastq_pair(prefix, pairs, read_length=READ_LENGTH, seed=1, gz=True):
+    '''
+    Write pairs read pairs into <prefix>_1.fq.gz and <prefix>_2.fq.gz (or .fq if not gz). Returns the two file names.
+    '''
+    rng = random.Random(seed)
+    pool = _sequence_pool(rng, read_length)
+    quality = 'I' * read_length
+    suffix = 'fq.gz' if gz else 'fq'
+    file_names = ['%s_%d.%s' % (prefix, mate, suffix) for mate in (1, 2)]
+    opener = (lambda name: gzip.open(name, 'wt', compresslevel=1)) if gz else (lambda name: open(name, 'w'))
+    with opener(file_names[0]) as fq1, opener(file_names[1]) as fq2:
+        for pair in range(pairs):
+            for mate, fq in ((1, fq1), (2, fq2)):
+                fq.write('@read%d/%d\n%s\n+\n%s\n' % (pair, mate, pool[rng.randrange(SEQUENCE_POOL_SIZE)], quality))
+    return file_names
+
+
+def write_bam(bam_file, pairs, read_length=READ_LENGTH, seed=1):
+    '''
+    Write a BAM-like file of pairs read pairs, a gzip stream of packed read records about as large as a BAM file
+    of the same reads, and an index file next to it. Returns the file name.
+    '''
+    rng = random.Random(seed)
+    pool = [sequence.encode() for sequence in _sequence_pool(rng, read_length)]
+    quality = b'I' * read_length
+    with gzip.open(bam_file, 'wb', compresslevel=1) as bam:
+        bam.write(b'BAM\1')
+        buffer = io.BytesIO()
+        for pair in range(pairs):
+            chrom = rng.randrange(len(CHROMS))
+            pos = rng.randrange(CHROMS[chrom][1] - 1000)
+            for mate in (1, 2):
+                name = b'read%d' % pair
+                buffer.write(struct.pack('<iiiH', chrom, pos, pos + 200, mate) + name + pool[rng.randrange(SEQUENCE_POOL_SIZE)] + quality)
+            if buffer.tell() > 1 << 20:
+                bam.write(buffer.getvalue())
+                buffer = io.BytesIO()
+        bam.write(buffer.getvalue())
+    with open(bam_file + '.bai', 'wb') as bai:
+        bai.write(b'BAI\1' + os.urandom(1024))
+    return bam_file
+
+
+def write_stats_files(stats_dir, sample, read_groups, seed=1):
+    '''
+    Write the stats files of stats for a sample: <sample>.bam.bas with a row per read group and the sample level
+    .insert.bas, .read.dist.bas, .rrna.bas and .gene.cov.bas files.
+    '''
+    rng = random.Random(seed)
+    with open(os.path.join(stats_dir, sample + '.bam.bas'), 'w') as bas:
+        bas.write('\t'.join(BAS_COLUMNS) + '\n')
+        for read_group in range(read_groups):
+            reads = rng.randrange(10000000, 100000000)
+            values = [sample + '.bam', sample, 'ILLUMINA', 'unit%d' % read_group, 'lib1', str(read_group), '100', '100']
+            values.extend(str(rng.randrange(reads)) for _ in range(15))
+            values.extend(['%.3f' % rng.uniform(150, 300), '%.3f' % rng.uniform(20, 80), str(rng.randrange(150, 300))])
+            values.extend(str(rng.randrange(reads)) for _ in range(3))
+            bas.write('\t'.join(values) + '\n')
+    for ext, names in SAMPLE_STATS:
+        with open(os.path.join(stats_dir, '%s.%s' % (sample, ext)), 'w') as bas:
+            if ext == 'insert.bas':
+                values = ['%.3f' % rng.uniform(150, 300), '%.3f' % rng.uniform(20, 80), str(rng.randrange(150, 300))]
+            elif ext == 'gene.cov.bas':
+                values = ['%.4g' % rng.uniform(0, 1) for _ in names]
+            else:
+                values = [str(rng.randrange(1000000)) for _ in names]
+            bas.write('\t'.join(names) + '\n' + '\t'.join(values) + '\n')
+
+
+def write_count_file(count_file, genes, seed=1):
+    '''
+    Write the gzipped counts, as count writes them, of the genes of a GTF file of genes genes written by write_gtf.
+    '''
+    rng = random.Random(seed)
+    with gzip.open(count_file, 'wt', compresslevel=1) as f:
+        for gene in range(genes):
+            f.write('ENSG%011d\t%d\n' % (gene, rng.randrange(1000) if rng.random() < 0.6 else 0))
+        for counter in ('__no_feature', '__ambiguous', '__too_low_aQual', '__not_aligned', '__alignment_not_unique'):
+            f.write('%s\t%d\n' % (counter, rng.randrange(100000)))
+    return count_file
+
+
+def write_gtf(gtf_file, genes, exons_per_gene=8, seed=1):
+    '''
+    Write a GTF file of genes with one transcript of exons_per_gene exons each, spread over the chromosomes.
+    '''
+    rng = random.Random(seed)
+    with open(gtf_file, 'w') as gtf:
+        for gene in range(genes):
+            chrom, length = CHROMS[gene % len(CHROMS)]
+            start = rng.randrange(1, length - exons_per_gene * 2000)
+            strand = rng.choice('+-')
+            gene_id, transcript_id = 'ENSG%011d' % gene, 'ENST%011d' % gene
+            end = start + exons_per_gene * 2000 - 1
+            attributes = 'gene_id "%s"; gene_name "GENE%d"; gene_biotype "protein_coding";' % (gene_id, gene)
+            gtf.write('%s\tensembl\tgene\t%d\t%d\t.\t%s\t.\t%s\n' % (chrom, start, end, strand, attributes))
+            attributes += ' transcript_id "%s";' % transcript_id
+            gtf.write('%s\tensembl\ttranscript\t%d\t%d\t.\t%s\t.\t%s\n' % (chrom, start, end, strand, attributes))
+            for exon in range(exons_per_gene):
+                exon_start = start + exon * 2000
+                gtf.write('%s\tensembl\texon\t%d\t%d\t.\t%s\t.\t%s exon_number "%d";\n' % (
+                    chrom, exon_start, exon_start + rng.randrange(100, 1000), strand, attributes, exon + 1))
+    return gtf_file
+
+
+def _fasta(line_length=60):
+    # a short sequence per chromosome, with a samtools faidx index of the full chromosome lengths
+    fasta, fai, offset = [], [], 0
+    for chrom, length in CHROMS:
+        offset += len(chrom) + 2
+        fasta.append('>%s\n%s\n' % (chrom, 'ACGT' * (line_length // 4)))
+        fai.append('%s\t%d\t%d\t%d\t%d\n' % (chrom, length, offset, line_length, line_length + 1))
+        offset += line_length + 1
+    return ''.join(fasta).encode(), ''.join(fai).encode()
+
+
+def write_fasta(fasta_file):
+    '''
+    Write a FASTA file of the chromosomes and its index.
+    '''
+    fasta, fai = _fasta()
+    for file_name, data in ((fasta_file, fasta), (fasta_file + '.fai', fai)):
+        with open(file_name, 'wb') as f:
+            f.write(data)
+    return fasta_file
+
+
+def _bed_lines(genes, rng):
+    for gene in range(genes):
+        chrom, length = CHROMS[gene % len(CHROMS)]
+        start = rng.randrange(length - 10000)
+        yield '%s\t%d\t%d\tGENE%d\t0\t%s\n' % (chrom, start, start + rng.randrange(1000, 10000), gene, rng.choice('+-'))
+
+
+def _add_file(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+
+
+class _RepeatedBlock(object):
+    # a file-like object of size bytes, made of a block of random data repeated
+    def __init__(self, size):
+        self.left = size
+        self.block = os.urandom(min(size, 1 << 20)) or b'\0'
+
+    def read(self, length=-1):
+        length = self.left if length < 0 else min(length, self.left)
+        self.left -= length
+        return (self.block * (length // len(self.block) + 1))[:length]
+
+
+def _add_random_file(tar, name, size):
+    # the STAR index is mostly incompressible, so it is filled with random data
+    info = tarfile.TarInfo(name)
+    info.size = size
+    tar.addfile(info, _RepeatedBlock(size))
+
+
+def write_reference_bundle(bundle_file, genes, star_index_size, seed=1):
+    '''
+    Write a reference bundle tar.gz holding the members every run-cgprna subcommand extracts: a STAR index of
+    star_index_size bytes with a GTF of genes genes, the FASTA index and BED files of stats, the tophat and defuse
+    directories and the normal fusions list of the fusion callers.
+    '''
+    rng = random.Random(seed)
+    gtf = write_gtf(bundle_file + '.gtf', genes, seed=seed)
+    with open(gtf, 'rb') as f:
+        gtf_data = f.read()
+    os.remove(gtf)
+    fasta, fai = _fasta()
+    with tarfile.open(bundle_file, 'w:gz', compresslevel=1) as tar:
+        _add_random_file(tar, 'star/Genome', star_index_size // 4)
+        _add_random_file(tar, 'star/SA', star_index_size // 2)
+        _add_random_file(tar, 'star/SAindex', star_index_size - star_index_size // 4 - star_index_size // 2)
+        _add_file(tar, 'star/chrName.txt', ''.join('%s\n' % chrom for chrom, _ in CHROMS).encode())
+        _add_file(tar, 'star/%s/%s' % (GENE_BUILD, GTF_NAME), gtf_data)
+        _add_file(tar, FASTA_NAME, fasta)
+        _add_file(tar, FASTA_NAME + '.fai', fai)
+        for bed_file, bed_genes in (('rRNA.bed', genes // 100), ('HouseKeepingGenes.bed', genes // 50), ('RefSeq.bed', genes)):
+            _add_file(tar, bed_file, ''.join(_bed_lines(bed_genes, rng)).encode())
+        _add_file(tar, 'tophat/%s/%s' % (GENE_BUILD, GTF_NAME), gtf_data)
+        _add_file(tar, 'defuse/%s/%s' % (GENE_BUILD, GTF_NAME), gtf_data)
+        _add_file(tar, 'cgpRna/%s' % NORMAL_FUSIONS, b'')
+    return bundle_file
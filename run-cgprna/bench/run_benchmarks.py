@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+'''
+Benchmarks of the orchestration of run-cgprna: the reference bundle extraction, input validation, decompression,
+the BAM to FastQ conversions of the fusion subcommands, the forwarding of command output, the QC store and the count
+matrix, plus whole
+subcommands run against stand-ins of the external tools (see standins.py) on synthetic inputs (see fixtures.py).
+The startup benchmark guards the startup time of run-cgprna: it fails if "run-cgprna --version" takes more than
+--max-startup-ms or imports pkg_resources or the module of a subcommand.
+
+Every benchmark runs in a process of its own, and its wall time, CPU time and peak RSS, which includes the commands
+it waited for, are reported. For subcommands, the number of commands they ran and the time spent in them are taken
+from their run report.
+
+    python3 bench/run_benchmarks.py -o /tmp/cgprna-bench --pairs 200000 --threads 4
+
+The run_cgprna of this tree is benchmarked, it still has to be installed (e.g. "pip install -e .") for its version.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+from collections import OrderedDict
+from subprocess import Popen, DEVNULL, PIPE, check_output
+
+import fixtures
+import standins
+
+SAMPLE = 'bench'
+# benchmarks of functions, run in a process of this script
+FUNCTION_BENCHMARKS = ['untar', 'untar_members', 'validate_input_seq_files', 'gunzip', 'bam_to_fastq', 'run_shell_command', 'startup', 'qc_store', 'count_matrix']
+SUBCOMMAND_BENCHMARKS = ['map', 'map-lanes', 'stats', 'count', 'bigwig', 'star-fusion', 'defuse', 'defuse-bam']
+# FastQ pairs validated by validate_input_seq_files
+VALIDATED_PAIRS = 2000
+FORWARDED_LINES = 1000000
+# run-cgprna, as its console script runs it
+CLI_COMMAND = 'import sys; from run_cgprna.command_line import main; sys.argv[0] = "run-cgprna"; main()'
+# the modules imported by a run are listed on stderr when it exits
+CLI_MODULES_COMMAND = 'import sys, atexit; atexit.register(lambda: print(" ".join(sys.modules), file=sys.stderr)); ' + CLI_COMMAND
+STARTUP_RUNS = 20
+# samples of stats files added to a QC store, and the read groups of each
+QC_SAMPLES = 5000
+QC_READ_GROUPS = 3
+# samples of count files added to a count matrix
+COUNT_SAMPLES = 500
+
+
+def prepare_fixtures(args):
+    '''
+    Write the synthetic inputs into <out_dir>/fixtures, unless they are there from a previous run of the same size.
+    '''
+    fixtures_dir = os.path.join(args.out_dir, 'fixtures')
+    sizes = {'pairs': args.pairs, 'lanes': args.lanes, 'genes': args.genes, 'star_index_mb': args.star_index_mb, 'qc_samples': QC_SAMPLES, 'count_samples': COUNT_SAMPLES}
+    sizes_file = os.path.join(fixtures_dir, 'sizes.json')
+    if os.path.exists(sizes_file):
+        with open(sizes_file) as f:
+            if json.load(f) == sizes:
+                return fixtures_dir
+        shutil.rmtree(fixtures_dir)
+    os.makedirs(fixtures_dir)
+    print('writing fixtures to %s ...' % fixtures_dir, flush=True)
+    fixtures.write_reference_bundle(os.path.join(fixtures_dir, 'ref.tar.gz'), args.genes, args.star_index_mb << 20)
+    fixtures.write_gtf(os.path.join(fixtures_dir, fixtures.GTF_NAME), args.genes)
+    fixtures.write_fasta(os.path.join(fixtures_dir, fixtures.FASTA_NAME))
+    for lane in range(1, args.lanes + 1):
+        fixtures.write_bam(os.path.join(fixtures_dir, 'lane%d.bam' % lane), args.pairs // args.lanes, seed=lane)
+        fixtures.write_fastq_pair(os.path.join(fixtures_dir, 'lane%d' % lane), args.pairs // args.lanes, seed=lane)
+    fixtures.write_bam(os.path.join(fixtures_dir, SAMPLE + '.bam'), args.pairs)
+    validate_dir = os.path.join(fixtures_dir, 'validate')
+    os.makedirs(validate_dir)
+    for pair in range(VALIDATED_PAIRS):
+        for mate in (1, 2):
+            open(os.path.join(validate_dir, 'lane%d_%d.fq.gz' % (pair, mate)), 'w').close()
+    qc_dir = os.path.join(fixtures_dir, 'qc')
+    os.makedirs(qc_dir)
+    for sample in range(QC_SAMPLES):
+        fixtures.write_stats_files(qc_dir, 'sample%d' % sample, sample % QC_READ_GROUPS + 1, seed=sample)
+    for sample in range(COUNT_SAMPLES):
+        count_dir = os.path.join(fixtures_dir, 'counts', 'sample%d' % sample)
+        os.makedirs(count_dir)
+        fixtures.write_count_file(os.path.join(count_dir, 'rna_htseqcount.gz'), args.genes, seed=sample)
+    with open(sizes_file, 'w') as f:
+        json.dump(sizes, f)
+    return fixtures_dir
+
+
+def _lanes(fixtures_dir, args, ext):
+    return [os.path.join(fixtures_dir, 'lane%d%s' % (lane, ext)) for lane in range(1, args.lanes + 1)]
+
+
+def subcommand_arguments(name, fixtures_dir, out_dir, args):
+    '''
+    Return the arguments of a subcommand benchmark.
+    '''
+    ref = os.path.join(fixtures_dir, 'ref.tar.gz')
+    bam = os.path.join(fixtures_dir, SAMPLE + '.bam')
+    common = ['-od', out_dir, '-t', str(args.threads)]
+    if name == 'map':
+        fastqs = [fq for lane in _lanes(fixtures_dir, args, '') for fq in (lane + '_1.fq.gz', lane + '_2.fq.gz')]
+        return ['map', '-s', SAMPLE, '-r', ref, '-i'] + fastqs + common
+    if name == 'map-lanes':
+        # each lane a read group of its own, mapped separately and merged
+        lanes_file = os.path.join(out_dir, 'lanes.tsv')
+        with open(lanes_file, 'w') as f:
+            f.write('ID\tinput_1\tinput_2\tPU\n')
+            for lane_number, lane in enumerate(_lanes(fixtures_dir, args, ''), 1):
+                f.write('%d\t%s_1.fq.gz\t%s_2.fq.gz\trun_%d\n' % (lane_number, lane, lane, lane_number))
+        return ['map', '-s', SAMPLE, '-r', ref, '-l', lanes_file] + common
+    if name == 'stats':
+        return ['stats', '-i', bam, '-tb', bam, '-r', ref] + common
+    if name == 'count':
+        return ['count', '-i', bam, '-r', os.path.join(fixtures_dir, fixtures.GTF_NAME)] + common
+    if name == 'bigwig':
+        return ['bigwig', '-i', bam, '-r', os.path.join(fixtures_dir, fixtures.FASTA_NAME)] + common
+    if name == 'star-fusion':
+        # BAM inputs, converted to FastQ first
+        return ['star-fusion', '-s', SAMPLE, '-r', ref, '-i'] + _lanes(fixtures_dir, args, '.bam') + common
+    if name == 'defuse':
+        # gzipped FastQ inputs, decompressed first
+        fastqs = [fq for lane in _lanes(fixtures_dir, args, '') for fq in (lane + '_1.fq.gz', lane + '_2.fq.gz')]
+        return ['defuse', '-s', SAMPLE, '-r', ref, '-i'] + fastqs + common
+    if name == 'defuse-bam':
+        # BAM inputs, converted to uncompressed FastQ first
+        return ['defuse', '-s', SAMPLE, '-r', ref, '-i'] + _lanes(fixtures_dir, args, '.bam') + common
+    raise ValueError(name)
+
+
+def run_function(name, fixtures_dir, out_dir, args):
+    '''
+    Run a function benchmark, in a process of this script.
+    '''
+    from run_cgprna import untar, run_shell_command
+    from run_cgprna import fusion_tools
+    from run_cgprna.scheduler import run_steps
+    ref = os.path.join(fixtures_dir, 'ref.tar.gz')
+    if name == 'untar':
+        untar(ref, out_dir, threads=args.threads)
+    elif name == 'untar_members':
+        untar(ref, out_dir, ['genome.fa.fai', 'rRNA.bed', 'HouseKeepingGenes.bed', 'RefSeq.bed'], args.threads)
+    elif name == 'validate_input_seq_files':
+        validate_dir = os.path.join(fixtures_dir, 'validate')
+        fusion_tools.validate_input_seq_files([os.path.join(validate_dir, name) for name in sorted(os.listdir(validate_dir))])
+    elif name == 'gunzip':
+        for fq in _lanes(fixtures_dir, args, '_1.fq.gz'):
+            run_shell_command(fusion_tools.GUNZIP.substitute(
+                decompressor=shutil.which('pigz') or 'gzip', source_file=fq, dest_file=os.path.join(out_dir, os.path.basename(fq)[:-3])))
+    elif name == 'bam_to_fastq':
+        steps = []
+        for lane, bam in enumerate(_lanes(fixtures_dir, args, '.bam'), 1):
+            params = {
+                'bam2fq_tmp': os.path.join(out_dir, 'lane%d' % lane),
+                'bam2fq_tmp_single_end': os.devnull,
+                'bam2fq_tmp_unmatched': os.devnull,
+                'bam2fq_tmp_unmatched2': os.devnull,
+                'bam2fq_tmp_matched': os.path.join(out_dir, 'lane%d_1.fq.gz' % lane),
+                'bam2fq_tmp_matched_2': os.path.join(out_dir, 'lane%d_2.fq.gz' % lane),
+                'in_bam': bam
+            }
+            command = fusion_tools.BAM_TO_FASTQ.substitute(params)
+            steps.append(('bamtofastq.%d' % lane, lambda command=command: run_shell_command(command), []))
+        run_steps(steps, min(args.threads, len(steps)))
+    elif name == 'run_shell_command':
+        run_shell_command('yes "%s" | head -n %d' % ('x' * 100, FORWARDED_LINES))
+    elif name == 'startup':
+        check_startup(args.max_startup_ms)
+    elif name == 'qc_store':
+        scan_qc_store(os.path.join(fixtures_dir, 'qc'), os.path.join(out_dir, 'qc_store'))
+    elif name == 'count_matrix':
+        slice_count_matrix(
+            os.path.join(fixtures_dir, 'counts'), os.path.join(fixtures_dir, fixtures.GTF_NAME), os.path.join(out_dir, 'count_matrix'))
+    else:
+        raise ValueError(name)
+
+
+def check_startup(max_startup_ms):
+    '''
+    Time "run-cgprna --version", and exit with an error if its median time is above max_startup_ms or if it imports
+    pkg_resources or the module of any subcommand.
+    '''
+    from run_cgprna.command_line import SUBCOMMANDS
+    times = []
+    for _ in range(STARTUP_RUNS):
+        started = time.time()
+        check_output([sys.executable, '-c', CLI_COMMAND, '--version'])
+        times.append((time.time() - started) * 1000)
+    median = sorted(times)[len(times) // 2]
+    print('run-cgprna --version: median %.1fms of %d runs' % (median, STARTUP_RUNS), flush=True)
+
+    p = Popen([sys.executable, '-c', CLI_MODULES_COMMAND, '--version'], stdout=DEVNULL, stderr=PIPE, universal_newlines=True)
+    _, modules = p.communicate()
+    excluded = set(['pkg_resources'] + ['run_cgprna.' + entry_point.split(':')[0] for _, entry_point, _ in SUBCOMMANDS.values()])
+    imported = sorted(excluded & set(modules.split()))
+    if imported:
+        sys.exit('Error: run-cgprna --version imports %s' % ', '.join(imported))
+    if median > max_startup_ms:
+        sys.exit('Error: run-cgprna --version takes %.1fms, more than %dms' % (median, max_startup_ms))
+
+
+def scan_qc_store(stats_dir, store_dir):
+    '''
+    Add the stats files in stats_dir to a new QC store, and time a scan of a metric of all samples in it.
+    '''
+    from run_cgprna import qc_store
+    qc_store.add_samples(store_dir, qc_store.find_samples([stats_dir]))
+    started = time.time()
+    with qc_store.QcStore(store_dir) as store:
+        values = store.column('mean_insert_size')
+    print('scan of mean_insert_size of %d samples, %d rows: %.1fms' % (
+        len(store.samples), len(values), (time.time() - started) * 1000), flush=True)
+
+
+def slice_count_matrix(counts_dir, gtf_file, matrix_dir):
+    '''
+    Add the count files in counts_dir to a new count matrix, and time reading a gene of all samples and a sample.
+    '''
+    from run_cgprna import count_matrix
+    count_matrix.add_to_matrix(matrix_dir, count_matrix.find_count_files([counts_dir]), gtf_file)
+    with count_matrix.CountMatrix(matrix_dir) as matrix:
+        started = time.time()
+        matrix.gene_counts(matrix.genes[len(matrix.genes) // 2])
+        gene_ms = (time.time() - started) * 1000
+        started = time.time()
+        matrix.sample_counts(list(matrix.samples)[-1])
+        sample_ms = (time.time() - started) * 1000
+    print('counts of a gene in %d samples: %.1fms, of a sample: %.1fms' % (len(matrix.samples), gene_ms, sample_ms), flush=True)
+
+
+def measure(command, log_file, env):
+    '''
+    Run a command, returns its wall time, CPU times and peak RSS, including those of the commands it waited for.
+    '''
+    started = time.time()
+    with open(log_file, 'w') as log:
+        p = Popen(command, stdout=log, stderr=log, stdin=DEVNULL, env=env)
+        _, status, usage = os.wait4(p.pid, 0)
+    p.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    return OrderedDict([
+        ('exit_code', p.returncode),
+        ('wall_time_s', round(time.time() - started, 3)),
+        ('user_cpu_s', round(usage.ru_utime, 3)),
+        ('system_cpu_s', round(usage.ru_stime, 3)),
+        ('max_rss_kb', usage.ru_maxrss)
+    ])
+
+
+def _report_summary(out_dir, subcommand):
+    # time spent in the commands a subcommand ran, from its run report
+    report_file = os.path.join(out_dir, 'run-cgprna.%s.report.json' % subcommand)
+    if not os.path.exists(report_file):
+        return OrderedDict()
+    with open(report_file) as f:
+        steps = json.load(f)['steps']
+    return OrderedDict([
+        ('commands', len(steps)),
+        ('commands_wall_time_s', round(sum(step['wall_time_s'] for step in steps), 3))
+    ])
+
+
+def run_benchmarks(args):
+    fixtures_dir = prepare_fixtures(args)
+    bin_dir = standins.install(os.path.join(args.out_dir, 'bin'))
+    env = dict(os.environ)
+    env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+    # benchmark the run_cgprna of this tree rather than an installed one
+    python_path = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+    if env.get('PYTHONPATH'):
+        python_path.append(env['PYTHONPATH'])
+    env['PYTHONPATH'] = os.pathsep.join(python_path)
+    env[standins.LOG_SCALE_ENV] = str(args.log_scale)
+    results = OrderedDict()
+    for name in args.benchmarks:
+        for repeat in range(args.repeat):
+            out_dir = os.path.join(args.out_dir, 'runs', '%s.%d' % (name, repeat))
+            if os.path.exists(out_dir):
+                shutil.rmtree(out_dir)
+            os.makedirs(out_dir)
+            if name in SUBCOMMAND_BENCHMARKS:
+                arguments = subcommand_arguments(name, fixtures_dir, out_dir, args)
+                command = [sys.executable, '-c', CLI_COMMAND] + arguments
+            else:
+                command = [sys.executable, os.path.abspath(__file__), '--run-function', name, '--run-directory', out_dir] + sys.argv[1:]
+            print('%s (%d/%d) ...' % (name, repeat + 1, args.repeat), end='', flush=True)
+            result = measure(command, out_dir + '.log', env)
+            if name in SUBCOMMAND_BENCHMARKS:
+                result.update(_report_summary(out_dir, arguments[0]))
+            print(' %.3fs' % result['wall_time_s'] if result['exit_code'] == 0 else ' failed, see %s.log' % out_dir, flush=True)
+            results.setdefault(name, []).append(result)
+            if not args.keep_outputs:
+                shutil.rmtree(out_dir)
+    return results
+
+
+def print_results(results):
+    columns = ['wall_time_s', 'user_cpu_s', 'system_cpu_s', 'max_rss_kb', 'commands', 'commands_wall_time_s']
+    print('\n%-26s %s' % ('benchmark', ' '.join('%20s' % column for column in columns)))
+    for name, runs in results.items():
+        # the fastest run of each benchmark
+        best = min(runs, key=lambda run: run['wall_time_s'])
+        print('%-26s %s' % (name, ' '.join('%20s' % best.get(column, '') for column in columns)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark run-cgprna with stand-ins of the external tools on synthetic inputs.')
+    parser.add_argument('-o', '--output-directory', dest='out_dir', metavar='DIR', required=True, help='Directory for fixtures, outputs and results.')
+    parser.add_argument('-b', '--benchmarks', dest='benchmarks', nargs='+', metavar='NAME', default=FUNCTION_BENCHMARKS + SUBCOMMAND_BENCHMARKS,
+                        choices=FUNCTION_BENCHMARKS + SUBCOMMAND_BENCHMARKS, help='Benchmarks to run. Default: all.')
+    parser.add_argument('-p', '--pairs', dest='pairs', metavar='INT', type=int, default=200000, help='Read pairs of the sample. Default: 200000.')
+    parser.add_argument('-l', '--lanes', dest='lanes', metavar='INT', type=int, default=4, help='Lanes the reads are split into. Default: 4.')
+    parser.add_argument('-g', '--genes', dest='genes', metavar='INT', type=int, default=20000, help='Genes of the GTF files. Default: 20000.')
+    parser.add_argument('-s', '--star-index-mb', dest='star_index_mb', metavar='INT', type=int, default=256, help='Size of the STAR index of the reference bundle. Default: 256.')
+    parser.add_argument('-t', '--threads', dest='threads', metavar='INT', type=int, default=4, help='Threads given to run-cgprna. Default: 4.')
+    parser.add_argument('-n', '--repeat', dest='repeat', metavar='INT', type=int, default=3, help='Runs of each benchmark, the fastest is reported. Default: 3.')
+    parser.add_argument('--max-startup-ms', dest='max_startup_ms', metavar='INT', type=int, default=250,
+                        help='Time "run-cgprna --version" may take at most, the startup benchmark fails above it. Default: 250.')
+    parser.add_argument('--log-scale', dest='log_scale', metavar='FLOAT', type=float, default=1, help='Multiplier of the log lines the stand-in tools print. Default: 1.')
+    parser.add_argument('--keep-outputs', dest='keep_outputs', action='store_true', default=False, help='Keep the outputs of the benchmarks.')
+    parser.add_argument('--run-function', dest='run_function', choices=FUNCTION_BENCHMARKS, help=argparse.SUPPRESS)
+    parser.add_argument('--run-directory', dest='run_dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.out_dir = os.path.abspath(args.out_dir)
+
+    if args.run_function:
+        run_function(args.run_function, os.path.join(args.out_dir, 'fixtures'), args.run_dir, args)
+        return
+
+    results = run_benchmarks(args)
+    print_results(results)
+    results_file = os.path.join(args.out_dir, 'results.json')
+    with open(results_file, 'w') as f:
+        json.dump(OrderedDict([('arguments', vars(args)), ('results', results)]), f, indent=2)
+    print('\nresults written to %s' % results_file)
+    if any(run['exit_code'] != 0 for runs in results.values() for run in runs):
+        sys.exit('Error: some benchmarks failed.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+'''
+Stand-ins for the external tools run-cgprna runs, so its orchestration can be benchmarked without STAR, biobambam,
+RSeQC, HTSeq or the cgpRna Perl wrappers installed.
+
+install(bin_dir) writes an executable for each tool into bin_dir, to be put first in PATH. Each stand-in reads its
+inputs in full, writes the output files the real tool would, of sizes in proportion to its inputs, and prints log
+lines to stdout and stderr, so run-cgprna has the same files to check and output to forward as with the real tools.
+The number of log lines of each tool is multiplied by $CGPRNA_STANDIN_LOG_SCALE (default 1).
+'''
+import os
+import sys
+import gzip
+
+import fixtures
+
+LOG_SCALE_ENV = 'CGPRNA_STANDIN_LOG_SCALE'
+BLOCK_SIZE = 1 << 20
+# output size relative to the input size and log lines of the tools writing files in proportion to their input
+BAM_TO_FASTQ_RATIO = 0.6
+STAR_GENOME_BAM_RATIO = 0.9
+STAR_TRANSCRIPTOME_BAM_RATIO = 0.5
+COLLATE_RATIO = 1.0
+BIGWIG_RATIO = 0.05
+SPLIT_BAM_RATIOS = {'in': 0.05, 'ex': 0.9, 'junk': 0.05}
+FUSIONS = 50
+COUNTED_GENES = 60000
+
+
+def _log(lines, message, stream=sys.stdout):
+    scale = float(os.environ.get(LOG_SCALE_ENV, 1))
+    for line in range(int(lines * scale)):
+        stream.write('%s %s [%d]\n' % (os.path.basename(sys.argv[0]), message, line))
+    stream.flush()
+
+
+def _read(file_names):
+    # read the inputs as the real tool would, returns their total size
+    total = 0
+    for file_name in file_names:
+        with (sys.stdin.buffer if file_name == '-' else open(file_name, 'rb')) as f:
+            while True:
+                block = f.read(BLOCK_SIZE)
+                if not block:
+                    break
+                total += len(block)
+    return total
+
+
+def _write(file_name, size, compress=False):
+    if file_name == os.devnull:
+        return
+    size = int(size)
+    block = os.urandom(min(max(size, 1), BLOCK_SIZE))
+    with (gzip.open(file_name, 'wb', compresslevel=1) if compress else open(file_name, 'wb')) as f:
+        left = size
+        while left > 0:
+            f.write(block[:left])
+            left -= len(block)
+
+
+def _options(argv, flags=()):
+    # -name value options and positional arguments, flags take no value
+    options, positional = {}, []
+    args = iter(argv)
+    for arg in args:
+        if arg.startswith('-') and len(arg) > 1:
+            options[arg.lstrip('-')] = True if arg.lstrip('-') in flags else next(args, None)
+        else:
+            positional.append(arg)
+    return options, positional
+
+
+def _key_values(argv):
+    # biobambam options: key=value
+    return dict(arg.split('=', 1) for arg in argv if '=' in arg)
+
+
+def star(argv):
+    options, _ = _options(argv)
+    _log(5, 'genome %s: %s' % (options.get('genomeLoad'), options.get('genomeDir')))
+    _write(options['outFileNamePrefix'] + 'Log.out', 4096)
+
+
+def star_mapping(argv):
+    options, inputs = _options(argv, flags=('markdup', 'keep-unmarked'))
+    size = _read(inputs)
+    prefix = os.path.join(options['o'], options['s'])
+    _log(200, 'mapping %d bytes' % size)
+    if 'markdup' in options:
+        _write(prefix + '.bam', size * STAR_GENOME_BAM_RATIO)
+        _write(prefix + '.bam.bai', 1 << 16)
+        _write(prefix + '.bam.md5', 33)
+        _write(prefix + '.bam.met', 2048)
+    _write(prefix + '.star.AlignedtoTranscriptome.out.bam', size * STAR_TRANSCRIPTOME_BAM_RATIO)
+    if 'keep-unmarked' in options or 'markdup' not in options:
+        _write(prefix + '.star.Aligned.out.bam', size * STAR_GENOME_BAM_RATIO)
+
+
+def bammerge(argv):
+    # merges the I= inputs to stdout
+    size = _read([arg[2:] for arg in argv if arg.startswith('I=')])
+    _log(50, 'merged %d bytes' % size, sys.stderr)
+    block = os.urandom(BLOCK_SIZE)
+    for start in range(0, size, BLOCK_SIZE):
+        sys.stdout.buffer.write(block[:size - start])
+    sys.stdout.buffer.flush()
+
+
+def bammarkduplicates2(argv):
+    options = _key_values(argv)
+    size = _read([options.get('I', '-')])
+    _log(50, 'marked duplicates of %d bytes' % size, sys.stderr)
+    _write(options['O'], size)
+    _write(options['indexfilename'], 1 << 16)
+    _write(options['md5filename'], 33)
+    _write(options['M'], 2048)
+
+
+def bamindex(argv):
+    _read(['-'])
+    sys.stdout.buffer.write(os.urandom(1 << 16))
+
+
+def bamtofastq(argv):
+    options = _key_values(argv)
+    size = _read([options['filename']])
+    _log(100, 'converted %d bytes' % size, sys.stderr)
+    compress = options.get('gz') == '1'
+    for key in ('F', 'F2'):
+        _write(options[key], size * BAM_TO_FASTQ_RATIO / 2, compress)
+
+
+def bamcollate2(argv):
+    options = _key_values(argv)
+    size = _read([options['filename']])
+    _log(50, 'collated %d bytes' % size, sys.stderr)
+    _write(options['O'], size * COLLATE_RATIO)
+
+
+def fusion_caller(suffix):
+    def run(argv):
+        options, inputs = _options(argv)
+        size = _read(inputs)
+        _log(500, 'calling fusions in %d bytes' % size)
+        with open(os.path.join(options['o'], options['s'] + suffix), 'w') as f:
+            for fusion in range(FUSIONS):
+                f.write('GENE%d\tGENE%d\tchr1\t%d\tchr2\t%d\n' % (fusion, fusion + 1, fusion * 1000, fusion * 2000))
+    return run
+
+
+def defuse_filters(argv):
+    options, _ = _options(argv)
+    _read([options['i']])
+    _log(20, 'filtering')
+    _write(os.path.join(options['o'], options['s'] + '.defuse-fusion.normals.ext.filtered.txt'), 4096)
+
+
+def bam_stats(argv):
+    options, _ = _options(argv)
+    size = _read([options['i']])
+    _log(10, 'stats', sys.stderr)
+    # a row of the .bas columns, read by the QC store
+    with open(options['o'], 'w') as f:
+        f.write('\t'.join(fixtures.BAS_COLUMNS) + '\n')
+        f.write('\t'.join([os.path.basename(options['i']), 'sample', 'ILLUMINA', 'unit', 'lib', '1'] + [str(size // 100)] * (len(fixtures.BAS_COLUMNS) - 6)) + '\n')
+
+
+def split_bam(argv):
+    options, _ = _options(argv)
+    size = _read([options['i']] + [options['r']])
+    for name, ratio in SPLIT_BAM_RATIOS.items():
+        _write('%s.%s.bam' % (options['o'], name), size * ratio)
+    print('Total records:\t%d' % (size // 100))
+    for name in SPLIT_BAM_RATIOS:
+        print('%s.%s.bam:\t%d' % (options['o'], name, size // 100 * SPLIT_BAM_RATIOS[name]))
+
+
+def gene_body_coverage(argv):
+    options, _ = _options(argv)
+    _read([options['i'], options['r']])
+    _log(100, 'reading', sys.stderr)
+    for ext, size in (('.geneBodyCoverage.r', 4096), ('.geneBodyCoverage.txt', 2048), ('.geneBodyCoverage.curves.png', 1 << 15)):
+        _write(options['o'] + ext, size)
+
+
+def read_distribution(argv):
+    options, _ = _options(argv)
+    size = _read([options['i'], options['r']])
+    _log(100, 'reading', sys.stderr)
+    print('Total Reads\t%d' % (size // 100))
+    for group in ('CDS_Exons', "5'UTR_Exons", "3'UTR_Exons", 'Introns', 'TSS_up_1kb', 'TES_down_1kb'):
+        print('%s\t%d\t%d\t%.2f' % (group, size, size // 1000, 1.0))
+
+
+def process_qcstats(argv):
+    options, _ = _options(argv)
+    prefix = os.path.join(options['o'], options['s'])
+    for ext, names in fixtures.SAMPLE_STATS:
+        with open('%s.%s' % (prefix, ext), 'w') as f:
+            f.write('\t'.join(names) + '\n' + '\t'.join(['1'] * len(names)) + '\n')
+
+
+def htseq_count(argv):
+    _, inputs = _options(argv)
+    _read(inputs)
+    for gene in range(COUNTED_GENES):
+        sys.stdout.write('ENSG%011d\t%d\n' % (gene, gene % 1000))
+    for counter in ('__no_feature', '__ambiguous', '__too_low_aQual', '__not_aligned', '__alignment_not_unique'):
+        sys.stdout.write('%s\t0\n' % counter)
+
+
+def bgzip(argv):
+    with gzip.open(sys.stdout.buffer, 'wb', compresslevel=1) as out:
+        while True:
+            block = sys.stdin.buffer.read(BLOCK_SIZE)
+            if not block:
+                break
+            out.write(block)
+
+
+def bam_to_bw(argv):
+    options, _ = _options(argv)
+    size = _read([options['b']])
+    _log(50, 'coverage of %d bytes' % size, sys.stderr)
+    base = os.path.basename(options['b'])
+    _write(os.path.join(options['o'], (base[:-4] if base.endswith('.bam') else base) + '.bw'), size * BIGWIG_RATIO)
+
+
+TOOLS = {
+    'STAR': star,
+    'star_mapping.pl': star_mapping,
+    'bamindex': bamindex,
+    'bamtofastq': bamtofastq,
+    'bamcollate2': bamcollate2,
+    'bammerge': bammerge,
+    'bammarkduplicates2': bammarkduplicates2,
+    'tophat_fusion.pl': fusion_caller('.tophat-fusion.normals.filtered.txt'),
+    'star_fusion.pl': fusion_caller('.star-fusion.normals.filtered.txt'),
+    'defuse_fusion.pl': fusion_caller('.defuse-fusion.normals.filtered.txt'),
+    'defuse_filters.pl': defuse_filters,
+    'bam_stats': bam_stats,
+    'split_bam.py': split_bam,
+    'geneBody_coverage.py': gene_body_coverage,
+    'read_distribution.py': read_distribution,
+    'process_qcstats.pl': process_qcstats,
+    'htseq-count': htseq_count,
+    'bgzip': bgzip,
+    'bamToBw.pl': bam_to_bw
+}
+
+
+def install(bin_dir):
+    '''
+    Write an executable for each stand-in tool into bin_dir.
+    '''
+    os.makedirs(bin_dir, exist_ok=True)
+    here = os.path.dirname(os.path.abspath(__file__))
+    for tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, 'w') as f:
+            f.write('#!%s\nimport sys\nsys.path.insert(0, %r)\nimport standins\nstandins.main(%r)\n' % (sys.executable, here, tool))
+        os.chmod(path, 0o755)
+    return bin_dir
+
+
+def main(tool):
+    TOOLS[tool](sys.argv[1:])
@@ -1,34 +1,133 @@
-from subprocess import Popen, PIPE, STDOUT
+from subprocess import Popen, PIPE
 import sys
 import os
+import shutil
+import shlex
+import fnmatch
 import tarfile
+from string import Template
 
+# shell running pipelines which fail when any of their commands fails
+PIPEFAIL_SHELL = 'bash -o pipefail -c '
+LOG_DIR_NAME = 'logs'
 
-def run_shell_command(command):
-    print('+' + command, flush=True)
-    with Popen(
-        command, shell=True, universal_newlines=True, bufsize=1, stdout=PIPE, stderr=STDOUT
-    ) as p:
-        for out in p.stdout:
-            print(out, end='')
-    if p.returncode != 0:
-        sys.exit('Exit code: %d' % p.returncode)
+# log directory of the commands of the run
+_log_dir = None
 
 
-def untar(tar_file, untar_to):
+def _executor():
+    # the executor once a command has run, it is only imported then as asyncio adds to the startup time
+    return sys.modules.get(__name__ + '.executor')
+
+
+def set_log_dir(log_dir):
+    '''
+    Write the output of each command into a log file of its own in log_dir. Log files are numbered in the order
+    the commands started, after the logs of earlier runs in the same directory.
+    '''
+    global _log_dir
+    _log_dir = log_dir
+
+
+def command_log_dir():
+    '''
+    Return the log directory of the commands, None if their output goes to stdout.
+    '''
+    return _log_dir
+
+
+def run_shell_command(command, name=None):
+    '''
+    Run a shell command with the executor, its output going into a log named name, by default after the program
+    it runs. Exits with an error if the command fails.
+    '''
+    from . import executor
+    executor.run_commands([(name or executor.command_name(command), command)])
+
+
+def terminate_running_processes():
+    '''
+    Kill the running commands and stop any further ones from starting.
+    '''
+    executor = _executor()
+    if executor:
+        executor.terminate_running_processes()
+
+
+def allow_new_processes():
+    '''
+    Allow commands to be started again after terminate_running_processes was called.
+    '''
+    executor = _executor()
+    if executor:
+        executor.allow_new_processes()
+
+
+def _wanted_member(name, members):
+    # a member is wanted if it matches one of the patterns or sits in a wanted directory
+    return any(fnmatch.fnmatch(name, pattern) or name.startswith(pattern + '/') for pattern in members)
+
+
+def untar(tar_file, untar_to, members=None, threads=1):
+    '''
+    Extract a gzipped tar file. If members is given, only files matching these names or glob patterns, or files
+    in directories of these names, are extracted. The gzip stream is decompressed with pigz if it is available.
+    '''
     print('untar files to %s ...' % untar_to, flush=True, end='')
-    # extract files from tar ball
+    pigz = shutil.which('pigz') if threads > 1 else None
+    found = set()
+    # plain file names, which can be ticked off once extracted
+    complete = set()
+    stopped_early = False
     try:
-        with tarfile.open(tar_file, 'r:gz') as tar:
-            tar.extractall(path=untar_to)
+        if pigz:
+            decompress = Popen([pigz, '-dc', '-p', str(threads), tar_file], stdout=PIPE)
+            tar = tarfile.open(fileobj=decompress.stdout, mode='r|')
+        else:
+            decompress = None
+            tar = tarfile.open(tar_file, 'r|gz')
+        with tar:
+            for member in tar:
+                if members is None:
+                    tar.extract(member, path=untar_to)
+                    continue
+                name = os.path.normpath(member.name)
+                matched = [pattern for pattern in members if _wanted_member(name, [pattern])]
+                if not matched:
+                    continue
+                tar.extract(member, path=untar_to)
+                found.update(matched)
+                if member.isfile() and name in members:
+                    complete.add(name)
+                # no need to read the rest of the stream once all wanted files are out
+                if len(complete) == len(members):
+                    stopped_early = True
+                    break
+        if decompress:
+            if stopped_early:
+                decompress.kill()
+            decompress.stdout.close()
+            if decompress.wait() != 0 and not stopped_early:
+                raise RuntimeError('pigz exit code: %d' % decompress.returncode)
         print('Done.')
     except Exception as e:
         sys.exit('Error: unexpected exception. When extracting files: %s' % str(e))
+    missing = [pattern for pattern in members or [] if pattern not in found]
+    if missing:
+        sys.exit('Error: could not find %s in reference bundle: %s' % (', '.join(missing), tar_file))
+
+
+def pipefail(template):
+    '''
+    Return a template running the pipeline of template with bash and pipefail set. /bin/sh gives a pipeline the
+    exit code of its last command, so a pipeline whose first commands fail could still succeed.
+    '''
+    return Template(PIPEFAIL_SHELL + shlex.quote(template.template))
 
 
-def run_templates_in_shell(list_of_templates, mapping):
+def run_templates_in_shell(list_of_templates, mapping, name=None):
     for template in list_of_templates:
-        run_shell_command(template.substitute(mapping))
+        run_shell_command(template.substitute(mapping), name)
 
 
 def mkdir(dir_path):
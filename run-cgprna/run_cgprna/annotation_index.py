@@ -0,0 +1,206 @@
+'''
+A compiled annotation index of a GTF file, written once next to the GTF file, so that a run does not need to
+parse the GTF file as text.
+
+<gtf>.cgprna.idx is a binary file of little endian uint32 columns, which are used in place with mmap:
+
+* a header with the size and mtime of the GTF file it was compiled from, an index not matching them is stale
+* a string table, every other column refers to strings by their index in it, NONE if a feature has no value
+* genes, transcripts and exons, as chrom, start, end, strand and id columns, sorted by chrom, start and end
+* gene name to gene and gene id to gene maps, sorted by name or id, with the first gene in the GTF file for
+  names and ids given to more than one gene
+
+The exon and gene features are also written to <gtf>.cgprna.exon.gtf and <gtf>.cgprna.gene.gtf, filtered the
+same way the fusion comparison filters them for bedtools, so it can use them rather than write its own copies
+for every sample.
+
+Start positions are 1 based as they are in the GTF file.
+'''
+import os
+import re
+import sys
+import mmap
+import struct
+from collections import OrderedDict
+
+INDEX_SUFFIX = '.cgprna.idx'
+FILTERED_GTF_SUFFIX = '.cgprna.%s.gtf'
+MAGIC = b'CGPRNAIX'
+FORMAT_VERSION = 1
+# magic, format version, GTF size, GTF mtime, number of strings, size of string data, of chroms, genes,
+# transcripts, exons and of gene names and ids
+HEADER = struct.Struct('<8sIQQIIIIIIII')
+NONE = 0xffffffff
+STRANDS = ['+', '-', '.']
+GENE_COLUMNS = ['chrom', 'start', 'end', 'strand', 'gene_id', 'gene_name', 'gene_biotype']
+TRANSCRIPT_COLUMNS = ['chrom', 'start', 'end', 'strand', 'transcript_id', 'gene_id']
+EXON_COLUMNS = ['chrom', 'start', 'end', 'strand', 'gene_id', 'transcript_id', 'exon_number']
+MAP_COLUMNS = ['key', 'gene']
+FILTERED_FEATURES = ['exon', 'gene']
+
+
+def index_file(gtf_file):
+    return gtf_file + INDEX_SUFFIX
+
+
+def filtered_gtf_file(gtf_file, feature):
+    return gtf_file + FILTERED_GTF_SUFFIX % feature
+
+
+def _gtf_state(gtf_file):
+    stat = os.stat(gtf_file)
+    return stat.st_size, int(stat.st_mtime)
+
+
+def _attributes(column):
+    # the way the fusion comparison reads them, the first word of each '; ' separated key and value pair
+    attributes = {}
+    for item in re.sub(';$', '', column.replace('"', '')).split('; '):
+        words = item.split(' ')
+        if len(words) > 1:
+            attributes[words[0]] = words[1]
+    return attributes
+
+
+def _filtered_line(line):
+    # a GTF line as filter_gtf in Sanger::CGP::CompareFusions::Implement writes it
+    return re.sub('^chr', '', re.sub(';$', '', line.replace('"', '')))
+
+
+def compile_index(gtf_file):
+    '''
+    Compile the annotation index of gtf_file and the filtered GTF files next to it.
+    '''
+    strings = OrderedDict()
+
+    def string(value):
+        if value is None:
+            return NONE
+        return strings.setdefault(value, len(strings))
+
+    chroms = OrderedDict()
+    genes, transcripts, exons = [], [], []
+    gtf_size, gtf_mtime = _gtf_state(gtf_file)
+    filtered_files = {feature: filtered_gtf_file(gtf_file, feature) for feature in FILTERED_FEATURES}
+    filtered = {feature: open(path + '.tmp', 'w') for feature, path in filtered_files.items()}
+    try:
+        with open(gtf_file) as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if line.startswith('#'):
+                    continue
+                fields = line.split('\t')
+                if len(fields) > 2 and fields[2] in filtered:
+                    filtered[fields[2]].write(_filtered_line(line) + '\n')
+                if len(fields) < 9 or fields[2] not in ('gene', 'transcript', 'exon'):
+                    continue
+                feature = fields[2]
+                attributes = _attributes(fields[8])
+                chrom = chroms.setdefault(fields[0], string(fields[0]))
+                location = [chrom, int(fields[3]), int(fields[4]), STRANDS.index(fields[6]) if fields[6] in STRANDS else 2]
+                if feature == 'gene':
+                    genes.append(location + [string(attributes.get(key)) for key in ('gene_id', 'gene_name', 'gene_biotype')])
+                elif feature == 'transcript':
+                    transcripts.append(location + [string(attributes.get(key)) for key in ('transcript_id', 'gene_id')])
+                else:
+                    exon_number = attributes.get('exon_number', '')
+                    exons.append(
+                        location + [string(attributes.get(key)) for key in ('gene_id', 'transcript_id')] +
+                        [int(exon_number) if exon_number.isdigit() else NONE])
+    finally:
+        for f in filtered.values():
+            f.close()
+
+    # names and ids of genes in the order of the GTF file, before sorting them by position
+    gene_maps = []
+    for column in (GENE_COLUMNS.index('gene_name'), GENE_COLUMNS.index('gene_id')):
+        first = OrderedDict()
+        for i, gene in enumerate(genes):
+            if gene[column] != NONE:
+                first.setdefault(gene[column], i)
+        gene_maps.append(first)
+    order = sorted(range(len(genes)), key=lambda i: genes[i][:3])
+    position = {old: new for new, old in enumerate(order)}
+    genes = [genes[i] for i in order]
+    transcripts.sort(key=lambda transcript: transcript[:3])
+    exons.sort(key=lambda exon: exon[:3])
+    maps = []
+    texts = list(strings)
+    for first in gene_maps:
+        maps.append(sorted(([key, position[i]] for key, i in first.items()), key=lambda row: texts[row[0]]))
+
+    data = '\0'.join(strings).encode() + b'\0'
+    data += b'\0' * (-len(data) % 4)
+    temp_file = index_file(gtf_file) + '.tmp'
+    with open(temp_file, 'wb') as f:
+        f.write(HEADER.pack(
+            MAGIC, FORMAT_VERSION, gtf_size, gtf_mtime, len(strings), len(data), len(chroms),
+            len(genes), len(transcripts), len(exons), len(maps[0]), len(maps[1])))
+        f.write(data)
+        f.write(struct.pack('<%dI' % len(chroms), *chroms.values()))
+        for rows, width in ((genes, len(GENE_COLUMNS)), (transcripts, len(TRANSCRIPT_COLUMNS)), (exons, len(EXON_COLUMNS))) + tuple((rows, len(MAP_COLUMNS)) for rows in maps):
+            for i in range(width):
+                f.write(struct.pack('<%dI' % len(rows), *[row[i] for row in rows]))
+    for feature, path in filtered_files.items():
+        os.rename(path + '.tmp', path)
+    # the index goes last, so its presence means the filtered GTF files are complete too
+    os.rename(temp_file, index_file(gtf_file))
+
+
+class AnnotationIndex(object):
+    '''
+    A compiled annotation index, mapped into memory. Columns are memoryviews of uint32, e.g.
+    index.exons['start'][i], and string columns hold indexes of index.string().
+    '''
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = HEADER.unpack_from(self._mmap)
+        if header[0] != MAGIC or header[1] != FORMAT_VERSION:
+            raise ValueError('not a cgpRna annotation index of version %d: %s' % (FORMAT_VERSION, path))
+        (self.gtf_size, self.gtf_mtime, n_strings, data_size, n_chroms, n_genes, n_transcripts, n_exons,
+            n_names, n_ids) = header[2:]
+        view = memoryview(self._mmap)
+        offset = HEADER.size
+        self._strings = bytes(view[offset:offset + data_size]).split(b'\0')[:n_strings]
+        offset += data_size
+        columns = view[offset:].cast('I')
+        self.chroms = columns[:n_chroms]
+        offset = n_chroms
+        tables = []
+        for names, size in ((GENE_COLUMNS, n_genes), (TRANSCRIPT_COLUMNS, n_transcripts), (EXON_COLUMNS, n_exons), (MAP_COLUMNS, n_names), (MAP_COLUMNS, n_ids)):
+            table = {}
+            for name in names:
+                table[name] = columns[offset:offset + size]
+                offset += size
+            tables.append(table)
+        self.genes, self.transcripts, self.exons, self.gene_names, self.gene_ids = tables
+
+    def string(self, i):
+        return None if i == NONE else self._strings[i].decode()
+
+
+def load_index(gtf_file):
+    '''
+    Return the annotation index of gtf_file, or None if it has not been compiled or is older than gtf_file.
+    '''
+    path = index_file(gtf_file)
+    if not os.path.exists(path):
+        return None
+    index = AnnotationIndex(path)
+    if (index.gtf_size, index.gtf_mtime) != _gtf_state(gtf_file):
+        print('Warning: annotation index %s is stale, %s is used instead.' % (path, gtf_file), file=sys.stderr, flush=True)
+        return None
+    return index
+
+
+def index_annotation(args):
+    '''
+    Top level entry point for compiling the annotation index of a GTF file.
+    '''
+    gtf_file = os.path.abspath(args.ref)
+    if not os.access(os.path.dirname(gtf_file), os.W_OK):
+        sys.exit('Error: the annotation index is written next to the GTF file, %s is not writable.' % os.path.dirname(gtf_file))
+    print('compiling the annotation index of %s ...' % gtf_file, flush=True)
+    compile_index(gtf_file)
+    print('written %s' % index_file(gtf_file), flush=True)
@@ -1,8 +1,11 @@
 import os
+import sys
+import importlib.util
 from string import Template
 from . import run_templates_in_shell, mkdir
 
 BIGWIG_TEMPLATE = Template('bamToBw.pl -o $out_dir -t $threads -r $ref -b $input')
+NATIVE_BIGWIG_TEMPLATE = Template('$python -m run_cgprna.bigwig_engine -i $input -r $ref -o $out_dir -t $threads --stranded $stranded $filter_options')
 
 
 # NOTE: Require secondary input: the BAM index file
@@ -10,6 +13,12 @@ def generate_bigwig(args):
     '''
     Top level entry point for generating bigwig coverage files from mapped RNA-Seq sequence files.
     '''
+    native_bigwig = getattr(args, 'bigwig_engine', 'bamtobw') == 'native'
+    if native_bigwig:
+        missing = [module for module in ('pysam', 'pyBigWig') if importlib.util.find_spec(module) is None]
+        if missing:
+            sys.exit('Error: "--bigwig-engine native" requires %s, please install it or use "--bigwig-engine bamtobw".' % ' and '.join(missing))
+
     # prepare the output dir
     mkdir(args.out_dir)
     
@@ -21,6 +30,20 @@ def generate_bigwig(args):
         'ref': os.path.abspath(args.ref),
     }
 
+    if native_bigwig:
+        filter_options = []
+        if getattr(args, 'skip_duplicates', False):
+            filter_options.append('--skip-duplicates')
+        if getattr(args, 'skip_secondary', False):
+            filter_options.append('--skip-secondary')
+        params.update({
+            'python': sys.executable,
+            'stranded': getattr(args, 'stranded', 'no'),
+            'filter_options': ' '.join(filter_options)
+        })
+        run_templates_in_shell([NATIVE_BIGWIG_TEMPLATE], params)
+        return
+
     run_templates_in_shell(
         [
             BIGWIG_TEMPLATE
@@ -0,0 +1,217 @@
+'''
+Native bigWig coverage engine, an alternative to bamToBw.pl.
+
+The indexed BAM is read in regions by worker processes. Each worker collects the starts and ends of the aligned
+blocks of the reads in its region into compact arrays, sorts them and sweeps them into runs of equal depth, so
+the memory used depends on the reads of one region rather than on the length of the genome. The runs are
+written to the bigWig file region by region, in the order of the reference, as the workers finish them.
+
+Depth is counted from the aligned bases (cigar M, = and X) of each read, so deletions and skipped regions
+(introns) are not covered. Unmapped reads are never counted, duplicates and secondary or supplementary
+alignments are counted unless they are to be skipped.
+
+With a stranded library, separate <prefix>.forward.bw and <prefix>.reverse.bw tracks are written, by the strand
+of the fragment: the strand read 1 is aligned to for "yes", or the opposite one for "reverse", as htseq-count
+calls them.
+
+It requires pysam and pyBigWig.
+'''
+import os
+import sys
+import argparse
+import multiprocessing
+from array import array
+
+# BAM cigar operations of aligned bases, as listed by pysam: M, = and X
+ALIGNED_CIGAR_OPS = (0, 7, 8)
+REFERENCE_CIGAR_OPS = (2, 3)
+# contigs are covered in regions of this size, so long contigs are shared between workers
+REGION_SIZE = 10000000
+STRANDS = ['forward', 'reverse']
+STRANDED_CHOICES = ['no', 'yes', 'reverse']
+
+# BAM file and read filters for the worker processes, set by _init_worker
+_worker_data = None
+
+
+def _import_module(name):
+    try:
+        return __import__(name)
+    except ImportError:
+        sys.exit('Error: the native bigwig engine requires %s, please install it or use "--bigwig-engine bamtobw".' % name)
+
+
+def read_fai(ref_file):
+    '''
+    Return the (name, length) of the sequences of a FASTA file, from its samtools faidx index.
+    '''
+    fai_file = ref_file + '.fai'
+    if not os.path.exists(fai_file):
+        sys.exit('Error: the native bigwig engine requires the FASTA index %s, please create it with "samtools faidx".' % fai_file)
+    chroms = []
+    with open(fai_file) as f:
+        for line in f:
+            fields = line.split('\t')
+            if len(fields) > 1:
+                chroms.append((fields[0], int(fields[1])))
+    return chroms
+
+
+def _init_worker(bam_file, stranded, skip_duplicates, skip_secondary):
+    global _worker_data
+    _worker_data = (bam_file, stranded, skip_duplicates, skip_secondary)
+
+
+def _is_reverse(read, stranded):
+    # the strand of the fragment the read is from
+    reverse = read.is_reverse
+    if read.is_paired and read.is_read2:
+        reverse = not reverse
+    return reverse if stranded == 'yes' else not reverse
+
+
+def depth_runs(starts, ends):
+    '''
+    Sweep the starts and ends of covered blocks into runs of equal depth. Returns run starts, run ends and
+    depths as arrays, without runs of depth 0.
+    '''
+    starts = sorted(starts)
+    ends = sorted(ends)
+    run_starts, run_ends, depths = array('I'), array('I'), array('f')
+    i = j = depth = 0
+    pos = None
+    while j < len(ends):
+        next_pos = min(starts[i], ends[j]) if i < len(starts) else ends[j]
+        if depth > 0 and next_pos > pos:
+            if run_ends and run_ends[-1] == pos and depths[-1] == depth:
+                run_ends[-1] = next_pos
+            else:
+                run_starts.append(pos)
+                run_ends.append(next_pos)
+                depths.append(depth)
+        while i < len(starts) and starts[i] == next_pos:
+            depth += 1
+            i += 1
+        while j < len(ends) and ends[j] == next_pos:
+            depth -= 1
+            j += 1
+        pos = next_pos
+    return run_starts, run_ends, depths
+
+
+def cover_region(region):
+    '''
+    Return the depth runs of a region, a (contig, start, end) tuple, for each track: one unstranded track, or the
+    forward and reverse tracks of a stranded library.
+    '''
+    import pysam
+    bam_file, stranded, skip_duplicates, skip_secondary = _worker_data
+    contig, start, end = region
+    tracks = 1 if stranded == 'no' else len(STRANDS)
+    blocks = [(array('I'), array('I')) for _ in range(tracks)]
+    with pysam.AlignmentFile(bam_file, 'rb') as bam:
+        for read in bam.fetch(contig, start, end):
+            if read.is_unmapped or (skip_duplicates and read.is_duplicate):
+                continue
+            if skip_secondary and (read.is_secondary or read.is_supplementary):
+                continue
+            block_starts, block_ends = blocks[0 if tracks == 1 else _is_reverse(read, stranded)]
+            pos = read.reference_start
+            for op, length in read.cigartuples:
+                if op in ALIGNED_CIGAR_OPS:
+                    # reads overlapping the region are clipped to it, so every base is covered by one region
+                    block_start, block_end = max(pos, start), min(pos + length, end)
+                    if block_start < block_end:
+                        block_starts.append(block_start)
+                        block_ends.append(block_end)
+                if op in ALIGNED_CIGAR_OPS or op in REFERENCE_CIGAR_OPS:
+                    pos += length
+    return region, [depth_runs(block_starts, block_ends) for block_starts, block_ends in blocks]
+
+
+def _regions(bam, chroms):
+    # regions of the contigs with reads, in the order of the reference as bigWig entries have to be added
+    stats = {stat.contig: stat.total for stat in bam.get_index_statistics()}
+    regions = []
+    for chrom, length in chroms:
+        if stats.get(chrom, 0) > 0:
+            regions.extend((chrom, start, min(start + REGION_SIZE, length)) for start in range(0, length, REGION_SIZE))
+    return regions
+
+
+def out_files(bam_file, out_dir, stranded):
+    '''
+    Return the bigWig files written for bam_file: one, or the forward and reverse ones of a stranded library.
+    '''
+    prefix = os.path.join(out_dir, os.path.basename(bam_file)[:-len('.bam')] if bam_file.endswith('.bam') else os.path.basename(bam_file))
+    if stranded == 'no':
+        return [prefix + '.bw']
+    return ['%s.%s.bw' % (prefix, strand) for strand in STRANDS]
+
+
+def generate_coverage(bam_file, ref_file, out_dir, threads, stranded='no', skip_duplicates=False, skip_secondary=False):
+    '''
+    Write the coverage of bam_file as bigWig files into out_dir.
+    '''
+    pysam = _import_module('pysam')
+    pyBigWig = _import_module('pyBigWig')
+    chroms = read_fai(ref_file)
+    with pysam.AlignmentFile(bam_file, 'rb') as bam:
+        if not bam.has_index():
+            sys.exit('Error: the native bigwig engine requires an indexed BAM file: %s' % bam_file)
+        missing = set(bam.references) - set(chrom for chrom, _ in chroms)
+        if missing:
+            print('Warning: contigs not in %s are not covered: %s' % (ref_file, ', '.join(sorted(missing))), file=sys.stderr, flush=True)
+        regions = _regions(bam, chroms)
+
+    files = out_files(bam_file, out_dir, stranded)
+    bigwigs = []
+    try:
+        for out_file in files:
+            bigwig = pyBigWig.open(out_file + '.tmp', 'w')
+            bigwigs.append(bigwig)
+            bigwig.addHeader(chroms)
+
+        def write(region, track_runs):
+            for bigwig, (run_starts, run_ends, depths) in zip(bigwigs, track_runs):
+                if run_starts:
+                    bigwig.addEntries([region[0]] * len(run_starts), list(run_starts), ends=list(run_ends), values=list(depths))
+
+        print('covering %d regions of %s ...' % (len(regions), bam_file), file=sys.stderr, flush=True)
+        init_args = (bam_file, stranded, skip_duplicates, skip_secondary)
+        if threads > 1 and len(regions) > 1:
+            pool = multiprocessing.Pool(min(threads, len(regions)), _init_worker, init_args)
+            try:
+                # in order, so regions are written as soon as the ones before them are
+                for result in pool.imap(cover_region, regions):
+                    write(*result)
+            finally:
+                pool.terminate()
+        else:
+            _init_worker(*init_args)
+            for region in regions:
+                write(*cover_region(region))
+    finally:
+        for bigwig in bigwigs:
+            bigwig.close()
+    for out_file in files:
+        os.rename(out_file + '.tmp', out_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='run_cgprna.bigwig_engine',
+        description='Write the coverage of a coordinate sorted and indexed BAM file as bigWig files.')
+    parser.add_argument('-i', '--input', dest='input', metavar='FILE', required=True, help='Input BAM file.')
+    parser.add_argument('-r', '--reference', dest='ref', metavar='FASTA_FILE', required=True, help='FASTA file of the reference, with a samtools faidx index.')
+    parser.add_argument('-o', '--output-directory', dest='out_dir', metavar='DIR', required=True, help='Output directory.')
+    parser.add_argument('-t', '--threads', dest='threads', metavar='INT', type=int, default=1, help='Number of processes to use.')
+    parser.add_argument('--stranded', dest='stranded', choices=STRANDED_CHOICES, default='no', help='Strandedness of the library, as for htseq-count. Default: no.')
+    parser.add_argument('--skip-duplicates', dest='skip_duplicates', action='store_true', default=False, help='Do not count reads marked as duplicates.')
+    parser.add_argument('--skip-secondary', dest='skip_secondary', action='store_true', default=False, help='Do not count secondary and supplementary alignments.')
+    args = parser.parse_args()
+    generate_coverage(args.input, args.ref, args.out_dir, args.threads, args.stranded, args.skip_duplicates, args.skip_secondary)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+'''
+Progress markers for the steps of a subcommand, so that a rerun with --resume skips the steps already done.
+
+A marker records a fingerprint of the commands of a step and of the size and mtime of its input files, along
+with the size and mtime of its outputs. A step is skipped only if its fingerprint is unchanged and all its
+outputs are still as the step left them. As the outputs of a step are the inputs of the steps after it, a step
+which is run again causes the steps depending on it to be run again too.
+'''
+import os
+import json
+import hashlib
+from . import run_templates_in_shell, mkdir
+
+PROGRESS_DIR = '.run-cgprna_progress'
+# parameters which do not change the outputs of a step
+NEUTRAL_PARAMS = ('threads', 'qc_threads', 'markdup_threads', 'lane_threads')
+
+
+def _file_state(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime]
+
+
+def _marker_file(args, name):
+    return os.path.join(os.path.abspath(args.out_dir), PROGRESS_DIR, '%s.json' % name)
+
+
+def fingerprint(templates, mapping, inputs):
+    '''
+    Return a checksum of the commands of a step and of the state of its input files.
+    '''
+    neutral_mapping = dict(mapping)
+    neutral_mapping.update({key: '-' for key in NEUTRAL_PARAMS if key in mapping})
+    content = {
+        'commands': [template.substitute(neutral_mapping) for template in templates],
+        'inputs': [[os.path.abspath(path), _file_state(path)] for path in inputs]
+    }
+    return hashlib.md5(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def step_done(args, name, templates, mapping, inputs):
+    '''
+    Check if --resume is set and the step has been completed with the same commands and inputs, and its
+    outputs are intact.
+    '''
+    if not getattr(args, 'resume', False):
+        return False
+    try:
+        with open(_marker_file(args, name)) as f:
+            marker = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if marker.get('fingerprint') != fingerprint(templates, mapping, inputs):
+        return False
+    return all(_file_state(path) == state for path, state in marker['outputs'].items())
+
+
+def run_step(args, name, templates, mapping, inputs, outputs):
+    '''
+    Run the templates of a step, unless it can be skipped because it is done. A progress marker is written
+    once the step succeeds, whether --resume is set or not, so that any run can be resumed.
+    '''
+    if step_done(args, name, templates, mapping, inputs):
+        print('step %s is done, skipped.' % name, flush=True)
+        return
+    marker_file = _marker_file(args, name)
+    if os.path.exists(marker_file):
+        os.remove(marker_file)
+    step_fingerprint = fingerprint(templates, mapping, inputs)
+    run_templates_in_shell(templates, mapping, name)
+    missing = [path for path in outputs if not os.path.exists(path)]
+    if missing:
+        print('Warning: step %s did not create %s, it will not be skipped on resume.' % (name, ', '.join(missing)), flush=True)
+        return
+    mkdir(os.path.dirname(marker_file))
+    temp_file = '%s.%d' % (marker_file, os.getpid())
+    with open(temp_file, 'w') as f:
+        json.dump(
+            {
+                'fingerprint': step_fingerprint,
+                'outputs': {os.path.abspath(path): _file_state(path) for path in outputs}
+            },
+            f, indent=2)
+    os.rename(temp_file, marker_file)
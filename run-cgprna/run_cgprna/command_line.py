@@ -1,340 +1,761 @@
 """
 Handle the command line parsing and select the correct sub process.
+
+Subcommands are registered in SUBCOMMANDS with the function adding their arguments, the module and function
+running them and their line in the help. Only the arguments of the subcommand being run are set up and only its
+module is imported, and the version is looked up when it is asked for, so short invocations such as
+"run-cgprna --version" start quickly.
 """
 
 import argparse
+import os
 import sys
-import pkg_resources  # part of setuptools
+import time
+import signal
+import importlib
+from collections import OrderedDict
 
-from .map import map_seq_files
-from .mapping_stats import generate_stats
-from .htseq_count import count
-from .bigwig import generate_bigwig
-from .fusion_tools import tophat_fusion, star_fusion, defuse
+from . import set_log_dir, terminate_running_processes, LOG_DIR_NAME
+from .ref_cache import CACHE_DIR_ENV, CACHE_SIZE_ENV, DEFAULT_CACHE_SIZE
+from .run_report import write_report
+from .scratch import SCRATCH_DIR_ENV, remove_temp_dirs
+from .resources import threads_value, resolve_resources
 
-version = pkg_resources.require("run_cgprna")[0].version
+DISTRIBUTION = 'run-cgprna'
 
 
-def main():
-    """
-    Sets up the parser and handles triggereing of correct sub-command
-    """
+def get_version():
+    '''
+    Return the version of the installed run-cgprna distribution.
+    '''
+    try:
+        from importlib import metadata
+    except ImportError:
+        # python < 3.8 has no importlib.metadata
+        import pkg_resources
+        return pkg_resources.require(DISTRIBUTION)[0].version
+    try:
+        return metadata.version(DISTRIBUTION)
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+class _VersionAction(argparse.Action):
+    # as the "version" action, but the version is only looked up when the option is given
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS, help="show program's version number and exit"):
+        super(_VersionAction, self).__init__(option_strings=option_strings, dest=dest, default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        print('%s %s' % (parser.prog, get_version()))
+        parser.exit()
+
+
+def _terminate(signum, frame):
+    # raised in the main thread, so that temp data is removed and a shared STAR genome is released
+    sys.exit('Error: terminated by signal %d' % signum)
+
+
+def _parent_parsers():
     common_parser = argparse.ArgumentParser('parent', add_help=False)
-    common_parser.add_argument('-v', '--version',
-                               action='version',
-                               version='%(prog)s ' + version)
+    common_parser.add_argument('-v', '--version', action=_VersionAction)
+
+    # arguments of subcommands which accept a reference bundle
+    ref_cache_parser = argparse.ArgumentParser('ref_cache', add_help=False)
+    ref_cache_parser.add_argument(
+        '--reference-cache', dest='ref_cache',
+        metavar='DIR', default=os.environ.get(CACHE_DIR_ENV),
+        help='Directory to cache extracted reference bundles in, so that a bundle is only extracted once per node. Default: value of $%s, if not set, bundles are extracted into the output directory and removed afterwards.' % CACHE_DIR_ENV,
+        required=False)
+    ref_cache_parser.add_argument(
+        '--reference-cache-size', dest='ref_cache_size',
+        metavar='SIZE', default=os.environ.get(CACHE_SIZE_ENV, DEFAULT_CACHE_SIZE),
+        help='Size limit of the reference cache, e.g. 500G. Least recently used bundles are removed when it is exceeded. Default: value of $%s or %s.' % (CACHE_SIZE_ENV, DEFAULT_CACHE_SIZE),
+        required=False)
+
+    # arguments of subcommands which write temp data
+    scratch_parser = argparse.ArgumentParser('scratch', add_help=False)
+    scratch_parser.add_argument(
+        '--scratch-directory', dest='scratch_dir',
+        metavar='DIR', default=os.environ.get(SCRATCH_DIR_ENV),
+        help='Directory for temp data, e.g. on a node-local disk. Default: value of $%s, if not set, temp data is written into the output directory.' % SCRATCH_DIR_ENV,
+        required=False)
+
+    # arguments of subcommands with steps which can be resumed
+    resume_parser = argparse.ArgumentParser('resume', add_help=False)
+    resume_parser.add_argument(
+        '--resume', dest='resume',
+        action='store_true', default=False,
+        help='Skip the steps completed by a previous run in the same output directory, if their inputs and parameters are unchanged and their outputs are intact.',
+        required=False)
 
-    parser = argparse.ArgumentParser(prog='run-cgprna', parents=[common_parser])
+    # checks of the input FastQ and BAM files before they are mapped or searched for fusions
+    preflight_parser = argparse.ArgumentParser('preflight', add_help=False)
+    preflight_parser.add_argument(
+        '--preflight', dest='preflight',
+        choices=['off', 'sample', 'full'], default='off',
+        help='Check the input files before starting: the integrity of BGZF and gzip files, the FastQ records, the pairing of mates and the quality encoding. With "sample", the first 100000 records of a FastQ are parsed and the rest only checked for truncation, with "full" all of them. Default: off.',
+        required=False)
+    preflight_parser.add_argument(
+        '--preflight-cache', dest='preflight_cache',
+        metavar='DIR',
+        help='Directory to cache the results of the preflight in, so that unchanged input files are only checked once. Default: value of $CGPRNA_PREFLIGHT_CACHE, if not set, results are not cached.',
+        required=False)
 
-    subparsers = parser.add_subparsers(help='sub-command help')
+    # references of the stats, count and bigwig branches run after mapping
+    post_map_parser = argparse.ArgumentParser('post_map', add_help=False)
+    post_map_parser.add_argument(
+        '--stats-reference', dest='stats_ref',
+        metavar='TAR|PATH',
+        help='A reference bundle tar file or the path to reference root directory for generating mapping stats.',
+        required=False)
+    post_map_parser.add_argument(
+        '--count-reference', dest='count_ref',
+        metavar='GTF_FILE',
+        help='A reference GTF file for generating gene counts.',
+        required=False)
+    post_map_parser.add_argument(
+        '--bigwig-reference', dest='bigwig_ref',
+        metavar='FASTA_FILE',
+        help='FASTA file of the reference the reads are mapped to, for generating a bigwig file.',
+        required=False)
 
-    # mapping arguments
-    parser_a = subparsers.add_parser(
+    # QC tools of the stats and where the stats go, on their own or run after mapping
+    qc_engine_parser = argparse.ArgumentParser('qc_engine', add_help=False)
+    qc_engine_parser.add_argument(
+        '--qc-engine', dest='qc_engine',
+        choices=['rseqc', 'native'], default='rseqc',
+        help='Generate the rRNA, read distribution and gene body coverage stats with RSeQC, or natively in a single pass over the BAM file, which requires pysam. Default: rseqc.',
+        required=False)
+    qc_engine_parser.add_argument(
+        '-qs', '--qc-store', dest='qc_store',
+        metavar='DIR',
+        help='A QC store (see qc-store) to add the stats of the sample to, once they are generated.',
+        required=False)
+
+    # gene counting and where the counts go, on their own or run after mapping
+    count_engine_parser = argparse.ArgumentParser('count_engine', add_help=False)
+    count_engine_parser.add_argument(
+        '--count-engine', dest='count_engine',
+        choices=['htseq', 'native'], default='htseq',
+        help='Count genes with htseq-count on a copy of the BAM file collated by read name, or natively from the indexed BAM file in parallel, which requires pysam. The counts are the same. Default: htseq.',
+        required=False)
+    count_engine_parser.add_argument(
+        '-cm', '--count-matrix', dest='count_matrix',
+        metavar='DIR',
+        help='A count matrix (see count-matrix) to add the counts to, once they are generated, as a sample named after the output directory.',
+        required=False)
+
+    # bigwig generation, on its own or run after mapping
+    bigwig_engine_parser = argparse.ArgumentParser('bigwig_engine', add_help=False)
+    bigwig_engine_parser.add_argument(
+        '--bigwig-engine', dest='bigwig_engine',
+        choices=['bamtobw', 'native'], default='bamtobw',
+        help='Generate the bigwig file with bamToBw.pl, or natively from the indexed BAM file in parallel, which requires pysam and pyBigWig. Default: bamtobw.',
+        required=False)
+    bigwig_engine_parser.add_argument(
+        '--bigwig-stranded', dest='stranded',
+        choices=['no', 'yes', 'reverse'], default='no',
+        help='Strandedness of the library, as for htseq-count. With "yes" or "reverse", the native engine writes forward and reverse strand bigwig files. Default: no.',
+        required=False)
+    bigwig_engine_parser.add_argument(
+        '--bigwig-skip-duplicates', dest='skip_duplicates',
+        action='store_true', default=False,
+        help='With the native engine, do not count reads marked as duplicates in the bigwig file.',
+        required=False)
+    bigwig_engine_parser.add_argument(
+        '--bigwig-skip-secondary', dest='skip_secondary',
+        action='store_true', default=False,
+        help='With the native engine, do not count secondary and supplementary alignments in the bigwig file.',
+        required=False)
+
+    return argparse.Namespace(
+        common=common_parser, ref_cache=ref_cache_parser, scratch=scratch_parser, resume=resume_parser,
+        preflight=preflight_parser, post_map=post_map_parser, qc_engine=qc_engine_parser, count_engine=count_engine_parser,
+        bigwig_engine=bigwig_engine_parser)
+
+
+def _map_arguments(subparsers, parents):
+    parser = subparsers.add_parser(
         'map',
-        parents=[common_parser],
+        parents=[parents.common, parents.ref_cache, parents.scratch, parents.resume, parents.preflight, parents.post_map, parents.qc_engine, parents.count_engine, parents.bigwig_engine],
         description='Use STAR to map RNA-Seq reads to a reference genome',
         epilog='Input can be either bam or \'f(ast)?q(\.gz)?\'.')
-    parser_a.add_argument(
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument(
         '-i', '--input', dest='input',
         metavar='FILE',
         nargs='+',
-        help='An input raw bam file, or a pair of FastQ files split with spaces. (optionally gzip compressed).',
-        required=True)
-    parser_a.add_argument(
+        help='An input raw bam file, or a pair of FastQ files split with spaces. (optionally gzip compressed).')
+    inputs.add_argument(
+        '-l', '--lanes', dest='lanes',
+        metavar='TSV',
+        help='A tab separated file of the lanes of the sample, with a header line and the columns ID, input_1, input_2 (empty for a raw bam file) and optionally LB, DS, PL and PU. Each lane is mapped with the read group tags of its line, lanes are mapped at the same time within --threads, and merged in coordinate order into duplicate marking.')
+    parser.add_argument(
         '-r', '--reference', dest='ref',
         metavar='TAR|PATH',
         help='A reference bundle tar file or the path to reference root directory.',
         required=True)
-    parser_a.add_argument(
+    parser.add_argument(
         '-s', '--sample-name', dest='sample_name',
         metavar='STR',
         help='Sample name, which will used to prefix output file names and SM tag in the BAM file header.',
         required=True)
-    parser_a.add_argument(
+    parser.add_argument(
         '-sp', '--species', dest='species',
         metavar='STR',
         help='Species name. No need to set if using a pre-built reference bundle. If using a folder path as the value of \'--reference\', it\' be used to locate reference files.',
         required=False)
-    parser_a.add_argument(
+    parser.add_argument(
         '-rb', '--reference-build', dest='ref_build',
         metavar='STR',
         help='Reference build name. No need to set if using a pre-built reference bundle. If using a folder path as the value of \'--reference\', it\' be used to locate reference files.',
         required=False)
-    parser_a.add_argument(
+    parser.add_argument(
         '-gb', '--gene-build', dest='gene_build',
         metavar='STR',
         help='Gene build name. No need to set if using a pre-built reference bundle. If using a folder path as the value of \'--reference\', it\' be used to locate for GTF file.',
         required=False)
-    parser_a.add_argument(
+    parser.add_argument(
         '-gtf', '--gene-build-gtf-name', dest='gene_build_gtf_name',
         metavar='STR',
         help='File name of the gene build annotaion file. No need to set if using a pre-built reference bundle. If using a folder path as the value of \'--reference\', it\' be used to locate the GTF file.',
         required=False)
-    parser_a.add_argument(
+    parser.add_argument(
         '-od', '--output-directory', dest='out_dir',
         metavar='DIR', default='.',
         help='Output directory. Default: current directory.',
         required=False)
-    parser_a.add_argument(
+    parser.add_argument(
         '-op', '--output-file-prefix', dest='out_file_prefix',
         metavar='STR',
         help='Output file name prefix. Default: value of --sample-name.',
         required=False)
-    parser_a.add_argument(
+    parser.add_argument(
         '-t', '--threads', dest='threads',
-        metavar='INT', type=int, default=1,
-        help='Number of threads to use.',
+        metavar='INT|auto', type=threads_value, default=1,
+        help='Number of threads to use. "auto": the CPUs available to the run, within the limits of its container.',
         required=False)
-    parser_a.add_argument(
+    parser.add_argument(
+        '--markdup-threads', dest='markdup_threads',
+        metavar='INT', type=int,
+        help='Number of threads of each of the sorting and the duplicate marking of the genome BAM, which run at the same time as STAR. Default: a share of --threads, the rest of which goes to STAR.',
+        required=False)
+    parser.add_argument(
         '--rg-id-tag', dest='rg_id_tag',
         metavar='STR',
         help='Readgroup ID tag value in the output BAM. Default: "1" or taken from the first input raw BAM file.',
         required=False)
-    parser_a.add_argument(
+    parser.add_argument(
         '--lb-tag', dest='lb_tag',
         metavar='STR',
         help='Sequencing library tag value in the output BAM header. Default: None or taken from the input raw BAM file.',
         required=False)
-    parser_a.add_argument(
+    parser.add_argument(
         '--ds-tag', dest='ds_tag',
         metavar='STR',
         help='Description tag value in the output BAM header. Default: None or taken from the input raw BAM file.',
         required=False)
-    parser_a.add_argument(
+    parser.add_argument(
         '--pl-tag', dest='pl_tag',
         metavar='STR',
         help='Platform tag value in the output BAM header. Default: None or taken from the input raw BAM file.',
         required=False)
-    parser_a.add_argument(
+    parser.add_argument(
         '--pu-tag', dest='pu_tag',
         metavar='STR',
         help='Platform unit tag value in the output BAM header. Default: None or taken from the input raw BAM file.',
         required=False)
-    parser_a.set_defaults(func=map_seq_files)
+    parser.add_argument(
+        '--keep-unmarked-bam', dest='keep_unmarked',
+        action='store_true', default=False,
+        help='Also keep the genome BAM before duplicate marking, as <prefix>.star.Aligned.out.bam. By default it is only streamed into duplicate marking and never written.',
+        required=False)
+
+
+def _map_batch_arguments(subparsers, parents):
+    parser = subparsers.add_parser(
+        'map-batch',
+        parents=[parents.common, parents.ref_cache, parents.scratch, parents.resume, parents.preflight],
+        description='Use STAR to map the samples of a manifest, with the STAR genome loaded once into shared memory for all of them.',
+        epilog='Junctions of the GTF file are not inserted on the fly into a shared genome, they must have been built into the STAR index.')
+    parser.add_argument(
+        '-m', '--manifest', dest='manifest',
+        metavar='FILE',
+        help='A tab separated file with a line per sample: the sample name followed by its input raw bam file, or pair of FastQ files.',
+        required=True)
+    parser.add_argument(
+        '-r', '--reference', dest='ref',
+        metavar='TAR|PATH',
+        help='A reference bundle tar file or the path to reference root directory.',
+        required=True)
+    parser.add_argument(
+        '-sp', '--species', dest='species',
+        metavar='STR',
+        help='Species name. No need to set if using a pre-built reference bundle. If using a folder path as the value of \'--reference\', it\' be used to locate reference files.',
+        required=False)
+    parser.add_argument(
+        '-rb', '--reference-build', dest='ref_build',
+        metavar='STR',
+        help='Reference build name. No need to set if using a pre-built reference bundle. If using a folder path as the value of \'--reference\', it\' be used to locate reference files.',
+        required=False)
+    parser.add_argument(
+        '-gb', '--gene-build', dest='gene_build',
+        metavar='STR',
+        help='Gene build name. No need to set if using a pre-built reference bundle. If using a folder path as the value of \'--reference\', it\' be used to locate for GTF file.',
+        required=False)
+    parser.add_argument(
+        '-gtf', '--gene-build-gtf-name', dest='gene_build_gtf_name',
+        metavar='STR',
+        help='File name of the gene build annotaion file. No need to set if using a pre-built reference bundle. If using a folder path as the value of \'--reference\', it\' be used to locate the GTF file.',
+        required=False)
+    parser.add_argument(
+        '-od', '--output-directory', dest='out_dir',
+        metavar='DIR', default='.',
+        help='Output directory, outputs of each sample are written into a sub-directory named after it. Default: current directory.',
+        required=False)
+    parser.add_argument(
+        '-t', '--threads', dest='threads',
+        metavar='INT|auto', type=threads_value, default=1,
+        help='Number of threads to use for each sample. "auto": the CPUs available to the run, within the limits of its container, shared by the samples mapped at once.',
+        required=False)
+    parser.add_argument(
+        '-j', '--jobs', dest='jobs',
+        metavar='INT|auto', type=threads_value, default=1,
+        help='Number of samples to map at once. They share the one copy of the genome in memory. "auto": as many as the CPUs and memory available to the run allow.',
+        required=False)
+    parser.add_argument(
+        '--keep-unmarked-bam', dest='keep_unmarked',
+        action='store_true', default=False,
+        help='Also keep the genome BAM before duplicate marking of each sample, as <sample>.star.Aligned.out.bam.',
+        required=False)
+
 
-    # create the parser for "stats" command
-    parser_b = subparsers.add_parser(
+def _stats_arguments(subparsers, parents):
+    parser = subparsers.add_parser(
         'stats',
-        parents=[common_parser],
+        parents=[parents.common, parents.ref_cache, parents.scratch, parents.resume, parents.qc_engine],
         description='Generate mapping stats from a BAM file, with/without a BAM file in which reads were mapped to the transcriptome instead of genome.')
-    parser_b.add_argument(
+    parser.add_argument(
         '-i', '--input', dest='input',
         metavar='FILE',
         help='Input BAM file, in which reads are mapped to a reference genome (NOT transcriptome).',
         required=True)
-    parser_b.add_argument(
+    parser.add_argument(
         '-r', '--reference', dest='ref',
         metavar='TAR|PATH',
         help='A reference bundle tar file or the path to reference root directory.',
         required=True)
-    parser_b.add_argument(
+    parser.add_argument(
         '-tb', '--transcriptome-bam', dest='trans_bam',
         metavar='FILE',
         help='BAM file, in which reads are mapped to a reference transciptome (NOT genome).',
         required=False)
-    parser_b.add_argument(
+    parser.add_argument(
         '-od', '--output-directory', dest='out_dir',
         metavar='DIR', default='.',
         help='Output directory. Default: current directory.',
         required=False)
-    parser_b.set_defaults(func=generate_stats)
+    parser.add_argument(
+        '-t', '--threads', dest='threads',
+        metavar='INT|auto', type=threads_value, default=1,
+        help='Number of threads to use. Each QC tool uses one, up to five of them run at the same time. "auto": the CPUs available to the run, within the limits of its container.',
+        required=False)
+
 
-    # create the parser for "bigwig" command
-    parser_c = subparsers.add_parser(
+def _bigwig_arguments(subparsers, parents):
+    parser = subparsers.add_parser(
         'bigwig',
-        parents=[common_parser],
+        parents=[parents.common, parents.bigwig_engine],
         description='Generate bigwig file from a BAM file.')
-    parser_c.add_argument(
+    parser.add_argument(
         '-i', '--input', dest='input',
         metavar='FILE',
         help='Input BAM file, in which reads are mapped to a reference genome (NOT transcriptome).',
         required=True)
-    parser_c.add_argument(
+    parser.add_argument(
         '-r', '--reference', dest='ref',
         metavar='FASTA_FILE',
         help='FASTA file of a reference, which the input BAM file was mapped to.',
         required=True)
-    parser_c.add_argument(
+    parser.add_argument(
         '-od', '--output-directory', dest='out_dir',
         metavar='DIR', default='.',
         help='Output directory. Default: current directory.',
         required=False)
-    parser_c.add_argument(
+    parser.add_argument(
         '-t', '--threads', dest='threads',
-        metavar='INT', type=int, default=1,
-        help='Number of threads to use.',
+        metavar='INT|auto', type=threads_value, default=1,
+        help='Number of threads to use. "auto": the CPUs available to the run, within the limits of its container.',
         required=False)
-    parser_c.set_defaults(func=generate_bigwig)
 
-    # create the parser for "count" command
-    parser_d = subparsers.add_parser(
+
+def _count_arguments(subparsers, parents):
+    parser = subparsers.add_parser(
         'count',
-        parents=[common_parser],
+        parents=[parents.common, parents.scratch, parents.count_engine],
         description='Generate gene counts from a BAM file.')
-    parser_d.add_argument(
+    parser.add_argument(
         '-i', '--input', dest='input',
         metavar='FILE',
         help='Input BAM file, in which reads are mapped to a reference genome (NOT transcriptome).',
         required=True)
-    parser_d.add_argument(
+    parser.add_argument(
         '-r', '--reference', dest='ref',
         metavar='GTF_FILE',
         help='A reference GTF file.',
         required=True)
-    parser_d.add_argument(
+    parser.add_argument(
+        '-od', '--output-directory', dest='out_dir',
+        metavar='DIR', default='.',
+        help='Output directory. Default: current directory.',
+        required=False)
+    parser.add_argument(
+        '-t', '--threads', dest='threads',
+        metavar='INT|auto', type=threads_value, default=1,
+        help='Number of processes "--count-engine native" uses. htseq-count uses one. "auto": the CPUs available to the run, within the limits of its container.',
+        required=False)
+
+
+def _post_map_arguments(subparsers, parents):
+    parser = subparsers.add_parser(
+        'post-map',
+        parents=[parents.common, parents.ref_cache, parents.scratch, parents.resume, parents.post_map, parents.qc_engine, parents.count_engine, parents.bigwig_engine],
+        description='Generate mapping stats, gene counts and bigwig file from a BAM file concurrently. Only the ones with a reference given are generated.')
+    parser.add_argument(
+        '-i', '--input', dest='input',
+        metavar='FILE',
+        help='Input BAM file, in which reads are mapped to a reference genome (NOT transcriptome).',
+        required=True)
+    parser.add_argument(
+        '-tb', '--transcriptome-bam', dest='trans_bam',
+        metavar='FILE',
+        help='BAM file, in which reads were mapped to a reference transciptome (NOT genome), for mapping stats.',
+        required=False)
+    parser.add_argument(
         '-od', '--output-directory', dest='out_dir',
         metavar='DIR', default='.',
         help='Output directory. Default: current directory.',
         required=False)
-    parser_d.set_defaults(func=count)
+    parser.add_argument(
+        '-t', '--threads', dest='threads',
+        metavar='INT|auto', type=threads_value, default=1,
+        help='Total number of threads to use. "auto": the CPUs available to the run, within the limits of its container.',
+        required=False)
+
 
-    # create the parser for "tophat_fusion" command
-    parser_e = subparsers.add_parser(
+def _tophat_fusion_arguments(subparsers, parents):
+    parser = subparsers.add_parser(
         'tophat-fusion',
-        parents=[common_parser],
+        parents=[parents.common, parents.ref_cache, parents.scratch, parents.resume, parents.preflight],
         description='Use Tophat2 to identify gene fusion events.')
-    parser_e.add_argument(
+    parser.add_argument(
         '-i', '--input', dest='input',
         metavar='FILE',
         nargs='+',
         help='Input files, can be BAM files or FastQ files or a mixture of both. File names of FastQ files much have suffix of "_1" or "_2" immediately prior to ".f[ast]q".',
         required=True)
-    parser_e.add_argument(
+    parser.add_argument(
         '-s', '--sample-name', dest='sample_name',
         metavar='STR',
         help='Sample name, which will used to prefix output file names and SM tag in the BAM file header.',
         required=True)
-    parser_e.add_argument(
+    parser.add_argument(
         '-r', '--reference', dest='ref',
         metavar='TAR|PATH',
         help='A reference bundle tar file or the path to reference root directory.',
         required=True)
-    parser_e.add_argument(
+    parser.add_argument(
         '-od', '--output-directory', dest='out_dir',
         metavar='DIR', default='.',
         help='Output directory. Default: current directory.',
         required=False)
-    parser_e.add_argument(
+    parser.add_argument(
         '-sp', '--species', dest='species',
         metavar='STR',
         help='Species name. No need to set if using a pre-built reference bundle. If using a folder path as the value of \'--reference\', it should be the name of an existing folder containing one or more folders named with differenct reference builds in \'--reference\' folder.',
         required=False)
-    parser_e.add_argument(
+    parser.add_argument(
         '-rb', '--reference-build', dest='ref_build',
         metavar='STR',
         help='Reference build name. No need to set if using a pre-built reference bundle. If using a folder path as the value of \'--reference\', it should the name of an existing folder containing \'tophat\' folder for this reference build in \'--species\' folder.',
         required=False)
-    parser_e.add_argument(
+    parser.add_argument(
         '-gb', '--gene-build', dest='gene_build',
         metavar='STR',
         help='Gene build name. No need to set if using a pre-built reference bundle. If using a folder path as the value of \'--reference\', it should be the name of an existing folder containing transcriptome index files in \'tophat\' folder.',
         required=False)
-    parser_e.add_argument(
+    parser.add_argument(
         '-t', '--threads', dest='threads',
-        metavar='INT', type=int, default=1,
-        help='Number of threads to use.',
+        metavar='INT|auto', type=threads_value, default=1,
+        help='Number of threads to use. "auto": the CPUs available to the run, within the limits of its container.',
         required=False)
-    parser_e.set_defaults(func=tophat_fusion)
 
-    # create the parser for "star_fusion" command
-    parser_f = subparsers.add_parser(
+
+def _star_fusion_arguments(subparsers, parents):
+    parser = subparsers.add_parser(
         'star-fusion',
-        parents=[common_parser],
+        parents=[parents.common, parents.ref_cache, parents.scratch, parents.resume, parents.preflight],
         description='Use STAR to identify gene fusion events.')
-    parser_f.add_argument(
+    parser.add_argument(
         '-i', '--input', dest='input',
         metavar='FILE',
         nargs='+',
         help='Input files, can be BAM files or FastQ files or a mixture of both. File names of FastQ files much have suffix of "_1" or "_2" immediately prior to ".f[ast]q".',
         required=True)
-    parser_f.add_argument(
+    parser.add_argument(
         '-s', '--sample-name', dest='sample_name',
         metavar='STR',
         help='Sample name, which will used to prefix output file names and SM tag in the BAM file header.',
         required=True)
-    parser_f.add_argument(
+    parser.add_argument(
         '-r', '--reference', dest='ref',
         metavar='TAR|PATH',
         help='A reference bundle tar file or the path to reference root directory.',
         required=True)
-    parser_f.add_argument(
+    parser.add_argument(
         '-od', '--output-directory', dest='out_dir',
         metavar='DIR', default='.',
         help='Output directory. Default: current directory.',
         required=False)
-    parser_f.add_argument(
+    parser.add_argument(
         '-sp', '--species', dest='species',
         metavar='STR',
         help='Species name. No need to set if using a pre-built reference bundle. If using a folder path as the value of \'--reference\', it should be the name of an existing folder containing one or more folders named with differenct reference builds in \'--reference\' folder.',
         required=False)
-    parser_f.add_argument(
+    parser.add_argument(
         '-rb', '--reference-build', dest='ref_build',
         metavar='STR',
         help='Reference build name. No need to set if using a pre-built reference bundle. If using a folder path as the value of \'--reference\', it should the name of an existing folder containing \'star\' folder for this reference build in \'--species\' folder.',
         required=False)
-    parser_f.add_argument(
+    parser.add_argument(
         '-gb', '--gene-build', dest='gene_build',
         metavar='STR',
         help='Gene build name. No need to set if using a pre-built reference bundle. If using a folder path as the value of \'--reference\', it should be the name of an existing folder containing a GTF file in \'star\' folder.',
         required=False)
-    parser_f.add_argument(
+    parser.add_argument(
         '-t', '--threads', dest='threads',
-        metavar='INT', type=int, default=1,
-        help='Number of threads to use.',
+        metavar='INT|auto', type=threads_value, default=1,
+        help='Number of threads to use. "auto": the CPUs available to the run, within the limits of its container.',
         required=False)
-    parser_f.set_defaults(func=star_fusion)
 
 
-    # create the parser for "defuse" command
-    parser_g = subparsers.add_parser(
+def _defuse_arguments(subparsers, parents):
+    parser = subparsers.add_parser(
         'defuse',
-        parents=[common_parser],
+        parents=[parents.common, parents.ref_cache, parents.scratch, parents.resume, parents.preflight],
         description='Use Defuse to identify gene fusion events.')
-    parser_g.add_argument(
+    parser.add_argument(
         '-i', '--input', dest='input',
         metavar='FILE',
         nargs='+',
         help='Input files, can be BAM files or FastQ files or a mixture of both. File names of FastQ files much have suffix of "_1" or "_2" immediately prior to ".f[ast]q".',
         required=True)
-    parser_g.add_argument(
+    parser.add_argument(
         '-s', '--sample-name', dest='sample_name',
         metavar='STR',
         help='Sample name, which will used to prefix output file names and SM tag in the BAM file header.',
         required=True)
-    parser_g.add_argument(
+    parser.add_argument(
         '-r', '--reference', dest='ref',
         metavar='TAR|PATH',
         help='A reference bundle tar file or the path to reference root directory.',
         required=True)
-    parser_g.add_argument(
+    parser.add_argument(
         '-od', '--output-directory', dest='out_dir',
         metavar='DIR', default='.',
         help='Output directory. Default: current directory.',
         required=False)
-    parser_g.add_argument(
+    parser.add_argument(
         '-sp', '--species', dest='species',
         metavar='STR',
         help='Species name. No need to set if using a pre-built reference bundle. If using a folder path as the value of \'--reference\', it should be the name of an existing folder containing one or more folders named with differenct reference builds in \'--reference\' folder.',
         required=False)
-    parser_g.add_argument(
+    parser.add_argument(
         '-rb', '--reference-build', dest='ref_build',
         metavar='STR',
         help='Reference build name. No need to set if using a pre-built reference bundle. If using a folder path as the value of \'--reference\', it should the name of an existing folder containing \'defuse\' folder for this reference build in \'--species\' folder.',
         required=False)
-    parser_g.add_argument(
+    parser.add_argument(
         '-gb', '--gene-build', dest='gene_build',
         metavar='STR',
         help='Gene build name. No need to set if using a pre-built reference bundle. If using a folder path as the value of \'--reference\', it should be the name of an existing folder containing all Defuse index files in \'defuse\' folder.',
         required=False)
-    parser_g.add_argument(
+    parser.add_argument(
         '-t', '--threads', dest='threads',
-        metavar='INT', type=int, default=1,
-        help='Number of threads to use.',
+        metavar='INT|auto', type=threads_value, default=1,
+        help='Number of threads to use. "auto": the CPUs available to the run, within the limits of its container.',
+        required=False)
+
+
+def _index_gtf_arguments(subparsers, parents):
+    parser = subparsers.add_parser(
+        'index-gtf',
+        parents=[parents.common],
+        description='Compile the annotation index of a GTF file, which is written next to it. count and the fusion comparison use it, if it is up to date, rather than parse the GTF file.')
+    parser.add_argument(
+        '-r', '--reference', dest='ref',
+        metavar='GTF_FILE',
+        help='A reference GTF file.',
+        required=True)
+
+
+def _qc_store_arguments(subparsers, parents):
+    parser = subparsers.add_parser(
+        'qc-store',
+        parents=[parents.common],
+        description='Add the stats generated by stats for one or more samples to a columnar QC store, which is created if it does not exist. Samples already in the store are only added again if their stats files changed.')
+    parser.add_argument(
+        '-qs', '--qc-store', dest='qc_store',
+        metavar='DIR',
+        help='The QC store directory.',
+        required=True)
+    parser.add_argument(
+        '-i', '--input', dest='input', nargs='+',
+        metavar='FILE|DIR',
+        help='<sample>.bam.bas files written by stats, or directories to search for them. The other stats files of a sample are read from the same directory.',
+        required=True)
+
+
+def _qc_export_arguments(subparsers, parents):
+    parser = subparsers.add_parser(
+        'qc-export',
+        parents=[parents.common],
+        description='Export metrics of a QC store as TSV, a row per read group of each sample.')
+    parser.add_argument(
+        '-qs', '--qc-store', dest='qc_store',
+        metavar='DIR',
+        help='The QC store directory.',
+        required=True)
+    parser.add_argument(
+        '-c', '--columns', dest='columns', nargs='+',
+        metavar='STR',
+        help='Columns to export. Default: all columns.',
+        required=False)
+    parser.add_argument(
+        '-sn', '--sample-names', dest='sample_names', nargs='+',
+        metavar='STR',
+        help='Samples to export. Default: all samples.',
+        required=False)
+    parser.add_argument(
+        '-o', '--output', dest='output',
+        metavar='FILE', default='-',
+        help='Output TSV file. Default: stdout.',
+        required=False)
+
+
+def _count_matrix_arguments(subparsers, parents):
+    parser = subparsers.add_parser(
+        'count-matrix',
+        parents=[parents.common],
+        description='Add the gene counts generated by count for one or more samples to a gene by sample count matrix, which is created from the genes of a GTF file if it does not exist. Samples are named after the directory of their count file, and only added again if it changed.')
+    parser.add_argument(
+        '-cm', '--count-matrix', dest='count_matrix',
+        metavar='DIR',
+        help='The count matrix directory.',
+        required=True)
+    parser.add_argument(
+        '-i', '--input', dest='input', nargs='+',
+        metavar='FILE|DIR',
+        help='rna_htseqcount.gz files written by count, or directories to search for them.',
+        required=True)
+    parser.add_argument(
+        '-r', '--reference', dest='ref',
+        metavar='GTF_FILE',
+        help='The reference GTF file the samples were counted with, its gene ids are the rows of a new count matrix.',
+        required=False)
+
+
+def _count_export_arguments(subparsers, parents):
+    parser = subparsers.add_parser(
+        'count-export',
+        parents=[parents.common],
+        description='Export counts of a count matrix, a row per gene and a column per sample.')
+    parser.add_argument(
+        '-cm', '--count-matrix', dest='count_matrix',
+        metavar='DIR',
+        help='The count matrix directory.',
+        required=True)
+    parser.add_argument(
+        '-f', '--format', dest='format',
+        choices=['tsv', 'mtx'], default='tsv',
+        help='A TSV table, gzipped if the output file name ends with .gz, or a Matrix Market coordinate matrix <output>.mtx with the gene ids in <output>.genes.tsv and the samples in <output>.samples.tsv. Default: tsv.',
+        required=False)
+    parser.add_argument(
+        '-g', '--genes', dest='genes', nargs='+',
+        metavar='STR',
+        help='Gene ids to export. Default: all genes and the special counters.',
+        required=False)
+    parser.add_argument(
+        '-sn', '--sample-names', dest='sample_names', nargs='+',
+        metavar='STR',
+        help='Samples to export. Default: all samples.',
         required=False)
-    parser_g.set_defaults(func=defuse)
+    parser.add_argument(
+        '-o', '--output', dest='output',
+        metavar='FILE', default='-',
+        help='Output file, or the prefix of the output files of "--format mtx". Default: stdout.',
+        required=False)
+
+
+# the function adding the arguments of each subcommand, the module and function running it, and its line in the help
+SUBCOMMANDS = OrderedDict([
+    ('map', (_map_arguments, 'post_map:map_and_post_map', 'Map RNA-Seq reads to a reference genome with STAR.')),
+    ('map-batch', (_map_batch_arguments, 'map_batch:map_batch', 'Map the samples of a manifest with a STAR genome shared in memory.')),
+    ('stats', (_stats_arguments, 'mapping_stats:generate_stats', 'Generate mapping stats from a BAM file.')),
+    ('bigwig', (_bigwig_arguments, 'bigwig:generate_bigwig', 'Generate a bigwig file from a BAM file.')),
+    ('count', (_count_arguments, 'htseq_count:count', 'Generate gene counts from a BAM file.')),
+    ('post-map', (_post_map_arguments, 'post_map:post_map', 'Generate mapping stats, gene counts and a bigwig file from a BAM file concurrently.')),
+    ('tophat-fusion', (_tophat_fusion_arguments, 'fusion_tools:tophat_fusion', 'Identify gene fusions with Tophat2.')),
+    ('star-fusion', (_star_fusion_arguments, 'fusion_tools:star_fusion', 'Identify gene fusions with STAR.')),
+    ('defuse', (_defuse_arguments, 'fusion_tools:defuse', 'Identify gene fusions with Defuse.')),
+    ('index-gtf', (_index_gtf_arguments, 'annotation_index:index_annotation', 'Compile the annotation index of a GTF file.')),
+    ('qc-store', (_qc_store_arguments, 'qc_store:add_to_store', 'Add the stats of samples to a columnar QC store.')),
+    ('qc-export', (_qc_export_arguments, 'qc_store:export_store', 'Export metrics of a QC store as TSV.')),
+    ('count-matrix', (_count_matrix_arguments, 'count_matrix:build_matrix', 'Add the gene counts of samples to a count matrix.')),
+    ('count-export', (_count_export_arguments, 'count_matrix:export_matrix', 'Export counts of a count matrix.'))
+])
+
+
+def _selected_subcommand(argv):
+    # the top level parser has no options taking a value, so the first other argument is the subcommand
+    return next((arg for arg in argv if not arg.startswith('-')), None)
+
+
+def main():
+    """
+    Sets up the parser and handles triggereing of correct sub-command
+    """
+    parents = _parent_parsers()
+    parser = argparse.ArgumentParser(prog='run-cgprna', parents=[parents.common])
+
+    subparsers = parser.add_subparsers(dest='subcommand', help='sub-command help')
+    selected = _selected_subcommand(sys.argv[1:])
+    for name, (add_arguments, _, help_line) in SUBCOMMANDS.items():
+        if name == selected:
+            add_arguments(subparsers, parents)
+        else:
+            # listed in the help, its arguments are only needed when it is run
+            subparsers.add_parser(name, help=help_line)
 
     args = parser.parse_args()
-    if len(sys.argv) > 1:
-        args.func(args)
-    else:
+    if args.subcommand is None:
         sys.exit('\nError: missed required arguments.\n\tPlease run: run-cgprna --help\n')
+    resolve_resources(args)
+    module_name, function_name = SUBCOMMANDS[args.subcommand][1].split(':')
+    run = getattr(importlib.import_module('.' + module_name, __package__), function_name)
+    if getattr(args, 'out_dir', None):
+        set_log_dir(os.path.join(args.out_dir, LOG_DIR_NAME))
+    started = time.time()
+    succeeded = False
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        run(args)
+        succeeded = True
+    finally:
+        # commands run in sessions of their own, so they do not get the signals of run-cgprna
+        terminate_running_processes()
+        # temp data is removed however the run ends
+        remove_temp_dirs()
+        # the output dir may not exist if the run failed early
+        if os.path.isdir(getattr(args, 'out_dir', '')):
+            write_report(args.subcommand, get_version(), args.out_dir, started, succeeded)
@@ -0,0 +1,297 @@
+'''
+Native gene counting engine, an alternative to collating the BAM by read name with bamcollate2 and counting
+the collated copy with htseq-count.
+
+Counts are the ones "htseq-count --stranded=no --type=exon --idattr=gene_id --mode=union" gives, written to
+stdout in the same format. The coordinate sorted and indexed BAM is read directly, split into regions which
+are counted by worker processes. Mates are paired up within a region as they are read, so only the mates whose
+partner is yet to come are held in memory. The few whose partner is in another region are paired up once all
+regions are done.
+
+It requires pysam, and samtools for the unmapped reads without a position.
+'''
+import re
+import sys
+import bisect
+import argparse
+import subprocess
+import multiprocessing
+from collections import defaultdict
+from .annotation_index import load_index, NONE
+
+# htseq-count defaults
+MIN_ALIGNMENT_QUALITY = 10
+FEATURE_TYPE = 'exon'
+ID_ATTRIBUTE = 'gene_id'
+# BAM cigar operations of aligned bases, as listed by pysam: M, = and X
+ALIGNED_CIGAR_OPS = (0, 7, 8)
+# contigs are counted in regions of this size, so long contigs are shared between workers
+REGION_SIZE = 20000000
+# special counters in the order htseq-count writes them
+SPECIAL_COUNTERS = ['__no_feature', '__ambiguous', '__too_low_aQual', '__not_aligned', '__alignment_not_unique']
+UNPLACED_REGION = '*'
+NH_TAG_PATTERN = re.compile(r'\tNH:i:(-?\d+)')
+
+# exon index and BAM file for the worker processes, set by _init_worker
+_worker_data = None
+
+
+def _import_pysam():
+    try:
+        import pysam
+    except ImportError:
+        sys.exit('Error: the native count engine requires pysam, please install it or use "--count-engine htseq".')
+    return pysam
+
+
+def _gtf_exons(gtf_file):
+    attr_pattern = re.compile(r'(?:^|;)\s*%s\s+"?([^";]*)"?' % ID_ATTRIBUTE)
+    with open(gtf_file) as f:
+        for line in f:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) < 9 or fields[2] != FEATURE_TYPE:
+                continue
+            match = attr_pattern.search(fields[8])
+            if match is None:
+                sys.exit('Error: %s feature without a %s attribute in %s: %s' % (FEATURE_TYPE, ID_ATTRIBUTE, gtf_file, line.strip()))
+            yield fields[0], int(fields[3]) - 1, int(fields[4]), match.group(1)
+
+
+def _indexed_exons(annotation, gtf_file):
+    exons = annotation.exons
+    for i in range(len(exons['start'])):
+        if exons['gene_id'][i] == NONE:
+            sys.exit('Error: %s feature without a %s attribute in %s' % (FEATURE_TYPE, ID_ATTRIBUTE, gtf_file))
+        yield (
+            annotation.string(exons['chrom'][i]), exons['start'][i] - 1, exons['end'][i],
+            annotation.string(exons['gene_id'][i]))
+
+
+def exon_index(gtf_file):
+    '''
+    Return the genes of the exons in gtf_file, by chromosome, as a sorted list of step starts and the set of
+    genes each step overlaps, as an unstranded HTSeq GenomicArrayOfSets holds them. Also returns the ids of all
+    genes with exons. The exons are read from the compiled annotation index of gtf_file if there is one.
+    '''
+    annotation = load_index(gtf_file)
+    exons = _gtf_exons(gtf_file) if annotation is None else _indexed_exons(annotation, gtf_file)
+    events = defaultdict(list)
+    genes = set()
+    for chrom, start, end, gene in exons:
+        genes.add(gene)
+        events[chrom].append((start, 1, gene))
+        events[chrom].append((end, -1, gene))
+    index = {}
+    for chrom, chrom_events in events.items():
+        chrom_events.sort(key=lambda event: event[0])
+        starts, steps = [0], [frozenset()]
+        active = defaultdict(int)
+        for pos, change, gene in chrom_events:
+            active[gene] += change
+            if active[gene] == 0:
+                del active[gene]
+            step = frozenset(active)
+            if pos == starts[-1]:
+                steps[-1] = step
+            elif step != steps[-1]:
+                starts.append(pos)
+                steps.append(step)
+        index[chrom] = (starts, steps)
+    return index, genes
+
+
+def gene_ids(gtf_file):
+    '''
+    Return the ids of the genes with exons in gtf_file, in the order their counts are written, followed by the
+    special counters. They are read from the compiled annotation index of gtf_file if there is one.
+    '''
+    annotation = load_index(gtf_file)
+    exons = _gtf_exons(gtf_file) if annotation is None else _indexed_exons(annotation, gtf_file)
+    return sorted(set(gene for _, _, _, gene in exons)) + SPECIAL_COUNTERS
+
+
+def _genes_at(index, chrom, start, end):
+    starts, steps = index[chrom]
+    genes = set()
+    for i in range(max(0, bisect.bisect_right(starts, start) - 1), bisect.bisect_left(starts, end)):
+        genes.update(steps[i])
+    return genes
+
+
+def _read_summary(index, read):
+    # what htseq-count looks at of a read: (aligned, NH, MAPQ, genes it overlaps, on a chromosome without exons)
+    nh = read.get_tag('NH') if read.has_tag('NH') else None
+    if read.is_unmapped:
+        return (False, nh, read.mapping_quality, frozenset(), False)
+    if read.reference_name not in index:
+        return (True, nh, read.mapping_quality, frozenset(), True)
+    genes = set()
+    pos = read.reference_start
+    for op, length in read.cigartuples:
+        if op in ALIGNED_CIGAR_OPS and length > 0:
+            genes.update(_genes_at(index, read.reference_name, pos, pos + length))
+        if op in ALIGNED_CIGAR_OPS or op in (2, 3):
+            pos += length
+    return (True, nh, read.mapping_quality, frozenset(genes), False)
+
+
+def count_pair(counts, first, second):
+    '''
+    Count a pair of read summaries, or a single one with None for the other, as htseq-count counts them.
+    '''
+    if not (first is not None and first[0]) and not (second is not None and second[0]):
+        counts['__not_aligned'] += 1
+        return
+    # htseq-count stops checking NH at the first read without it
+    for read in (first, second):
+        if read is None:
+            continue
+        if read[1] is None:
+            break
+        if read[1] > 1:
+            counts['__alignment_not_unique'] += 1
+            return
+    if any(read is not None and read[2] < MIN_ALIGNMENT_QUALITY for read in (first, second)):
+        counts['__too_low_aQual'] += 1
+        return
+    aligned = [read for read in (first, second) if read is not None and read[0]]
+    if any(read[4] for read in aligned):
+        counts['__no_feature'] += 1
+        return
+    genes = set()
+    for read in aligned:
+        genes.update(read[3])
+    if not genes:
+        counts['__no_feature'] += 1
+    elif len(genes) > 1:
+        counts['__ambiguous'] += 1
+    else:
+        counts[genes.pop()] += 1
+
+
+def _add_read(counts, pending, name, which, summary):
+    # which is 0 or 1 for the first or second mate, None for an unpaired read
+    if which is None:
+        count_pair(counts, summary, None)
+    elif name in pending and pending[name][0] != which:
+        _, mate = pending.pop(name)
+        count_pair(counts, *((summary, mate) if which == 0 else (mate, summary)))
+    else:
+        pending[name] = (which, summary)
+
+
+def _init_worker(bam_file, index):
+    global _worker_data
+    _worker_data = (bam_file, index)
+
+
+def _count_unplaced(bam_file):
+    # unmapped reads without a position can only be not aligned, samtools reads them straight from the index
+    counts = defaultdict(int)
+    pending = {}
+    p = subprocess.Popen(['samtools', 'view', bam_file, UNPLACED_REGION], stdout=subprocess.PIPE, universal_newlines=True)
+    for line in p.stdout:
+        fields = line.split('\t', 5)
+        flag = int(fields[1])
+        nh = NH_TAG_PATTERN.search(line)
+        which = (0 if flag & 0x40 else 1) if flag & 0x1 else None
+        _add_read(counts, pending, fields[0], which, (False, int(nh.group(1)) if nh else None, int(fields[4]), frozenset(), False))
+    if p.wait() != 0:
+        sys.exit('Error: failed to read the unplaced reads of %s with samtools.' % bam_file)
+    return counts, pending
+
+
+def count_region(region):
+    '''
+    Count the reads starting in a region, a (contig, start, end) tuple. Returns the counts and the mates whose
+    partner is not in the region.
+    '''
+    bam_file, index = _worker_data
+    if region[0] == UNPLACED_REGION:
+        return _count_unplaced(bam_file)
+    pysam = _import_pysam()
+    contig, start, end = region
+    counts = defaultdict(int)
+    pending = {}
+    with pysam.AlignmentFile(bam_file, 'rb') as bam:
+        for read in bam.fetch(contig, start, end):
+            # reads overlapping the start of the region are counted with the region they start in
+            if read.reference_start < start or read.is_secondary or read.is_supplementary:
+                continue
+            which = (0 if read.is_read1 else 1) if read.is_paired else None
+            _add_read(counts, pending, read.query_name, which, _read_summary(index, read))
+    return counts, pending
+
+
+def _regions(bam):
+    # contigs with reads split into regions, largest contigs first, then the unplaced reads
+    stats = {stat.contig: stat.total for stat in bam.get_index_statistics()}
+    regions = []
+    for contig, length in sorted(zip(bam.references, bam.lengths), key=lambda contig: -contig[1]):
+        if stats.get(contig, 0) > 0:
+            regions.extend((contig, start, min(start + REGION_SIZE, length)) for start in range(0, length, REGION_SIZE))
+    if bam.nocoordinate > 0:
+        regions.append((UNPLACED_REGION, 0, 0))
+    return regions
+
+
+def count_genes(bam_file, gtf_file, threads, out=sys.stdout):
+    '''
+    Count the reads of bam_file by the genes of gtf_file and write the counts to out, as htseq-count does.
+    '''
+    pysam = _import_pysam()
+    print('building the exon index of %s ...' % gtf_file, file=sys.stderr, flush=True)
+    index, genes = exon_index(gtf_file)
+    with pysam.AlignmentFile(bam_file, 'rb') as bam:
+        if not bam.has_index():
+            sys.exit('Error: the native count engine requires an indexed BAM file: %s' % bam_file)
+        regions = _regions(bam)
+
+    counts = defaultdict(int)
+    pending = {}
+
+    def merge(region_counts, region_pending):
+        for key, value in region_counts.items():
+            counts[key] += value
+        for name, (which, summary) in region_pending.items():
+            _add_read(counts, pending, name, which, summary)
+
+    print('counting %d regions of %s ...' % (len(regions), bam_file), file=sys.stderr, flush=True)
+    _init_worker(bam_file, index)
+    if threads > 1 and len(regions) > 1:
+        # the workers are forked after the index is built, so they share it rather than get a copy each
+        pool = multiprocessing.Pool(min(threads, len(regions)))
+        try:
+            for result in pool.imap_unordered(count_region, regions):
+                merge(*result)
+        finally:
+            pool.terminate()
+    else:
+        for region in regions:
+            merge(*count_region(region))
+    # mates whose partner was never found are counted on their own, as htseq-count does
+    for which, summary in pending.values():
+        count_pair(counts, summary, None)
+
+    for gene in sorted(genes):
+        out.write('%s\t%d\n' % (gene, counts[gene]))
+    for counter in SPECIAL_COUNTERS:
+        out.write('%s\t%d\n' % (counter, counts[counter]))
+    out.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='run_cgprna.count_engine',
+        description='Count the reads of a coordinate sorted and indexed BAM file by gene, as htseq-count in union mode does.')
+    parser.add_argument('-i', '--input', dest='input', metavar='FILE', required=True, help='Input BAM file.')
+    parser.add_argument('-r', '--reference', dest='ref', metavar='GTF_FILE', required=True, help='A reference GTF file.')
+    parser.add_argument('-t', '--threads', dest='threads', metavar='INT', type=int, default=1, help='Number of processes to use.')
+    args = parser.parse_args()
+    count_genes(args.input, args.ref, args.threads)
+
+
+if __name__ == '__main__':
+    main()
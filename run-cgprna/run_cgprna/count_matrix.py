@@ -0,0 +1,469 @@
+'''
+A gene by sample count matrix of a cohort, built from the rna_htseqcount.gz files of count, which samples are added
+to as they are counted rather than merging every count file again.
+
+Its rows are the gene ids of the exons of the GTF file the samples were counted with, in the order count writes them,
+followed by the special counters of htseq-count. Its columns are the samples, named after the directory of their
+count file, in the order they were added.
+
+The matrix is a directory of:
+
+* manifest.json: the numbers of genes and columns, the chunk sizes and the file of each block
+* genes.txt: the gene index, a gene id per line
+* samples.tsv: the sample index, the column and a fingerprint of the count file of each sample
+* <file>.cm: a block of SAMPLE_BLOCK columns, split into chunks of GENE_CHUNK genes which are compressed with zlib
+  one by one. A block file has a header, the offsets of its chunks and the chunks, each of uint32 little endian
+  counts with the counts of a sample next to each other.
+
+A slice of the matrix only decompresses the chunks it needs, from memory mapped block files: the counts of a sample
+are in one block, the counts of a gene in a chunk of each block. Adding samples writes blocks of the new samples and
+rewrites the last block if it is not full, so it takes time in proportion to the new samples. It is done under a
+lock and the manifest is replaced before the sample index is appended to, as the QC store does, so an interrupted
+add leaves the matrix as it was. Readers hold a shared lock until they are closed, so that a rewritten block is not
+removed while they may still map it. A sample added again after its count file changed gets a new column.
+'''
+import os
+import sys
+import gzip
+import json
+import mmap
+import zlib
+import fcntl
+import shutil
+import struct
+import hashlib
+import tempfile
+from array import array
+from contextlib import contextmanager
+from collections import OrderedDict
+from . import mkdir
+
+MANIFEST = 'manifest.json'
+GENE_INDEX = 'genes.txt'
+SAMPLE_INDEX = 'samples.tsv'
+LOCK_FILE = '.lock'
+COUNT_FILE = 'rna_htseqcount.gz'
+FORMAT_VERSION = 1
+MAGIC = b'CGPRNACM'
+# magic, format version, number of genes, of samples and genes per chunk
+HEADER = struct.Struct('<8sIIII')
+SAMPLE_BLOCK = 64
+GENE_CHUNK = 1024
+COMPRESSION_LEVEL = 6
+
+
+@contextmanager
+def _flock(lock_file, mode):
+    with open(lock_file, 'a') as fh:
+        fcntl.flock(fh, mode)
+        try:
+            yield fh
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _shared_lock(lock_file):
+    # kept by a reader until it is closed, a matrix the reader can not write to is locked through a read only handle
+    try:
+        fh = open(lock_file, 'a')
+    except PermissionError:
+        fh = open(lock_file)
+    fcntl.flock(fh, fcntl.LOCK_SH)
+    return fh
+
+
+def _to_bytes(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(data):
+    values = array('I')
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def _block_file(matrix_dir, file_id):
+    return os.path.join(matrix_dir, '%d.cm' % file_id)
+
+
+def _chunks(n_genes, gene_chunk):
+    return [(start, min(start + gene_chunk, n_genes)) for start in range(0, n_genes, gene_chunk)]
+
+
+def write_block(path, columns, n_genes, gene_chunk=GENE_CHUNK):
+    '''
+    Write a block file of columns, arrays of the uint32 counts of n_genes genes.
+    '''
+    chunks = [
+        zlib.compress(b''.join(_to_bytes(column[start:end]) for column in columns), COMPRESSION_LEVEL)
+        for start, end in _chunks(n_genes, gene_chunk)]
+    offset = HEADER.size + 8 * (len(chunks) + 1)
+    offsets = [offset]
+    for chunk in chunks:
+        offsets.append(offsets[-1] + len(chunk))
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, n_genes, len(columns), gene_chunk))
+        f.write(struct.pack('<%dQ' % len(offsets), *offsets))
+        for chunk in chunks:
+            f.write(chunk)
+
+
+class _Block(object):
+    # a block file mapped into memory, chunks are decompressed when asked for
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.n_genes, self.n_samples, self.gene_chunk = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError('not a cgpRna count matrix block of version %d: %s' % (FORMAT_VERSION, path))
+        n_chunks = len(_chunks(self.n_genes, self.gene_chunk))
+        self._offsets = struct.unpack_from('<%dQ' % (n_chunks + 1), self._mmap, HEADER.size)
+
+    def chunk(self, c):
+        # the counts of chunk c, sample by sample
+        return _from_bytes(zlib.decompress(self._mmap[self._offsets[c]:self._offsets[c + 1]]))
+
+    def column(self, i):
+        columns = array('I')
+        for c, (start, end) in enumerate(_chunks(self.n_genes, self.gene_chunk)):
+            length = end - start
+            columns.extend(self.chunk(c)[i * length:(i + 1) * length])
+        return columns
+
+    def close(self):
+        self._mmap.close()
+
+
+def _read_manifest(matrix_dir):
+    with open(os.path.join(matrix_dir, MANIFEST)) as f:
+        manifest = json.load(f)
+    if manifest.get('format_version') != FORMAT_VERSION:
+        raise ValueError('not a cgpRna count matrix of version %d: %s' % (FORMAT_VERSION, matrix_dir))
+    return manifest
+
+
+def _read_genes(matrix_dir):
+    with open(os.path.join(matrix_dir, GENE_INDEX)) as f:
+        return f.read().splitlines()
+
+
+def _read_sample_index(matrix_dir, columns):
+    # the last entry of each sample, entries of columns beyond those in the manifest were not completed
+    samples = OrderedDict()
+    index_file = os.path.join(matrix_dir, SAMPLE_INDEX)
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == 3 and int(fields[1]) < columns:
+                    samples[fields[0]] = (int(fields[1]), fields[2])
+    return samples
+
+
+def _write_manifest(matrix_dir, manifest):
+    temp_file = os.path.join(matrix_dir, '%s.%d' % (MANIFEST, os.getpid()))
+    with open(temp_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.rename(temp_file, os.path.join(matrix_dir, MANIFEST))
+
+
+def _fingerprint(path):
+    stat = os.stat(path)
+    return hashlib.md5(repr((stat.st_size, stat.st_mtime_ns)).encode()).hexdigest()
+
+
+def read_counts(count_file, gene_rows):
+    '''
+    Return the counts of a count file as an array in the order of the gene index, gene_rows maps gene ids to rows.
+    '''
+    counts = array('I', bytes(4 * len(gene_rows)))
+    with gzip.open(count_file, 'rt') as f:
+        for line in f:
+            gene, count = line.rstrip('\n').split('\t')
+            if gene not in gene_rows:
+                sys.exit('Error: gene %s of %s is not in the gene index of the count matrix, it was counted with another GTF file.' % (gene, count_file))
+            counts[gene_rows[gene]] = int(count)
+    return counts
+
+
+def find_count_files(inputs):
+    '''
+    Return an OrderedDict of sample name to count file of the count files in inputs, which are count files or
+    directories searched for them. Samples are named after the directory of their count file.
+    '''
+    samples = OrderedDict()
+    for path in inputs:
+        if os.path.isdir(path):
+            file_names = sorted(os.path.join(root, COUNT_FILE) for root, _, names in os.walk(path) if COUNT_FILE in names)
+        else:
+            file_names = [path]
+        for file_name in file_names:
+            if not os.path.isfile(file_name):
+                sys.exit('Error: count file not found: %s' % file_name)
+            file_name = os.path.abspath(file_name)
+            samples[os.path.basename(os.path.dirname(file_name))] = file_name
+    return samples
+
+
+def create_matrix(matrix_dir, genes):
+    '''
+    Create an empty count matrix in matrix_dir, of the gene ids genes.
+    '''
+    mkdir(matrix_dir)
+    with open(os.path.join(matrix_dir, GENE_INDEX), 'w') as f:
+        f.write(''.join('%s\n' % gene for gene in genes))
+    _write_manifest(matrix_dir, {
+        'format_version': FORMAT_VERSION, 'genes': len(genes), 'columns': 0, 'gene_chunk': GENE_CHUNK,
+        'sample_block': SAMPLE_BLOCK, 'next_file': 0, 'blocks': []})
+
+
+def add_samples(matrix_dir, count_files):
+    '''
+    Add the count files of samples, an OrderedDict of sample name to count file, to the count matrix in matrix_dir.
+    Samples whose count file has not changed since they were added are skipped. Returns the names of the samples
+    added.
+    '''
+    with _flock(os.path.join(matrix_dir, LOCK_FILE), fcntl.LOCK_EX):
+        manifest = _read_manifest(matrix_dir)
+        index = _read_sample_index(matrix_dir, manifest['columns'])
+        new_samples = []
+        for sample, count_file in count_files.items():
+            fingerprint = _fingerprint(count_file)
+            if sample not in index or index[sample][1] != fingerprint:
+                new_samples.append((sample, count_file, fingerprint))
+        if not new_samples:
+            return []
+        gene_rows = dict((gene, row) for row, gene in enumerate(_read_genes(matrix_dir)))
+        n_genes, block_size = manifest['genes'], manifest['sample_block']
+        blocks = manifest['blocks']
+        replaced = []
+        # a block which is not full is written again with the new samples
+        columns = []
+        if blocks and blocks[-1]['samples'] < block_size:
+            replaced.append(blocks.pop())
+            block = _Block(_block_file(matrix_dir, replaced[-1]['file']))
+            columns = [block.column(i) for i in range(block.n_samples)]
+            block.close()
+        for i, (sample, count_file, _) in enumerate(new_samples):
+            columns.append(read_counts(count_file, gene_rows))
+            if len(columns) == block_size or i == len(new_samples) - 1:
+                write_block(_block_file(matrix_dir, manifest['next_file']), columns, n_genes, manifest['gene_chunk'])
+                blocks.append({'file': manifest['next_file'], 'samples': len(columns)})
+                manifest['next_file'] += 1
+                columns = []
+        first_column = manifest['columns']
+        manifest['columns'] += len(new_samples)
+        _write_manifest(matrix_dir, manifest)
+        for block in replaced:
+            os.remove(_block_file(matrix_dir, block['file']))
+        with open(os.path.join(matrix_dir, SAMPLE_INDEX), 'a') as f:
+            for column, (sample, _, fingerprint) in enumerate(new_samples, first_column):
+                f.write('%s\t%d\t%s\n' % (sample, column, fingerprint))
+    return [sample for sample, _, _ in new_samples]
+
+
+class CountMatrix(object):
+    '''
+    A count matrix, read from disk. matrix.sample_counts('PD1234a') is the counts of a sample and
+    matrix.gene_counts('ENSG00000141510') the counts of a gene in every sample, in the order of matrix.samples.
+    Adds to the matrix wait until it is closed, e.g. at the end of a with block.
+    '''
+    def __init__(self, matrix_dir):
+        self.path = matrix_dir
+        # block files are mapped when first read, an add removes the last block of the manifest read here if it
+        # rewrites it
+        self._lock = _shared_lock(os.path.join(matrix_dir, LOCK_FILE))
+        manifest = _read_manifest(matrix_dir)
+        self._gene_chunk, self._sample_block = manifest['gene_chunk'], manifest['sample_block']
+        self._block_files = [_block_file(matrix_dir, block['file']) for block in manifest['blocks']]
+        self._blocks = {}
+        self.genes = _read_genes(matrix_dir)
+        self._gene_rows = None
+        # sample name to column and fingerprint of its count file
+        self.samples = _read_sample_index(matrix_dir, manifest['columns'])
+
+    def _block(self, b):
+        if b not in self._blocks:
+            self._blocks[b] = _Block(self._block_files[b])
+        return self._blocks[b]
+
+    def _columns(self, samples):
+        if samples is None:
+            return [column for column, _ in self.samples.values()]
+        unknown = [sample for sample in samples if sample not in self.samples]
+        if unknown:
+            raise KeyError('samples not in the count matrix: %s' % ', '.join(unknown))
+        return [self.samples[sample][0] for sample in samples]
+
+    def _rows(self, genes):
+        if genes is None:
+            return list(range(len(self.genes)))
+        if self._gene_rows is None:
+            self._gene_rows = dict((gene, row) for row, gene in enumerate(self.genes))
+        unknown = [gene for gene in genes if gene not in self._gene_rows]
+        if unknown:
+            raise KeyError('genes not in the count matrix: %s' % ', '.join(unknown))
+        return [self._gene_rows[gene] for gene in genes]
+
+    def sample_counts(self, sample, genes=None):
+        '''
+        Return the counts of sample for genes, by default for all genes.
+        '''
+        column = self._columns([sample])[0]
+        counts = self._block(column // self._sample_block).column(column % self._sample_block)
+        return counts if genes is None else [counts[row] for row in self._rows(genes)]
+
+    def gene_counts(self, gene, samples=None):
+        '''
+        Return the counts of gene in samples, by default in all samples.
+        '''
+        return next(self.rows([gene], samples))[1]
+
+    def rows(self, genes=None, samples=None):
+        '''
+        Yield the gene id and the counts in samples, by default in all samples, of genes, by default of all genes.
+        Only a chunk of genes is decompressed at a time.
+        '''
+        rows = self._rows(genes)
+        columns = self._columns(samples)
+        by_chunk = OrderedDict()
+        for row in rows:
+            by_chunk.setdefault(row // self._gene_chunk, []).append(row)
+        for c, chunk_rows in by_chunk.items():
+            start = c * self._gene_chunk
+            length = min(start + self._gene_chunk, len(self.genes)) - start
+            chunks = {}
+            chunk_columns = []
+            for column in columns:
+                b = column // self._sample_block
+                if b not in chunks:
+                    chunks[b] = self._block(b).chunk(c)
+                i = column % self._sample_block
+                chunk_columns.append(chunks[b][i * length:(i + 1) * length])
+            for row in chunk_rows:
+                yield self.genes[row], [counts[row - start] for counts in chunk_columns]
+
+    def close(self):
+        for block in self._blocks.values():
+            block.close()
+        self._blocks = {}
+        self._lock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _open_output(file_name):
+    if file_name == '-':
+        return open(sys.stdout.fileno(), 'w', closefd=False)
+    return gzip.open(file_name, 'wt') if file_name.endswith('.gz') else open(file_name, 'w')
+
+
+def export_tsv(matrix, out, genes=None, samples=None):
+    '''
+    Write the counts of genes in samples, by default of all of them, as a TSV table of a row per gene into out.
+    '''
+    names = list(matrix.samples) if samples is None else samples
+    rows = matrix.rows(genes, names)
+    out.write('\t'.join(['gene_id'] + names) + '\n')
+    for gene, counts in rows:
+        out.write('%s\t%s\n' % (gene, '\t'.join(map(str, counts))))
+
+
+def export_mtx(matrix, prefix, genes=None, samples=None):
+    '''
+    Write the counts of genes in samples, by default of all of them, as a Matrix Market coordinate matrix of a row
+    per gene into <prefix>.mtx, with its gene ids in <prefix>.genes.tsv and samples in <prefix>.samples.tsv.
+    '''
+    names = list(matrix.samples) if samples is None else samples
+    rows = matrix.rows(genes, names)
+    gene_ids = []
+    nonzero = 0
+    # the entries go first into a temp file, the header needs their number
+    with tempfile.TemporaryFile('w+', dir=os.path.dirname(os.path.abspath(prefix))) as entries:
+        for row, (gene, counts) in enumerate(rows, 1):
+            gene_ids.append(gene)
+            for column, count in enumerate(counts, 1):
+                if count:
+                    entries.write('%d %d %d\n' % (row, column, count))
+                    nonzero += 1
+        entries.seek(0)
+        with open(prefix + '.mtx', 'w') as out:
+            out.write('%%%%MatrixMarket matrix coordinate integer general\n%d %d %d\n' % (len(gene_ids), len(names), nonzero))
+            shutil.copyfileobj(entries, out)
+    for file_name, values in ((prefix + '.genes.tsv', gene_ids), (prefix + '.samples.tsv', names)):
+        with open(file_name, 'w') as f:
+            f.write(''.join('%s\n' % value for value in values))
+
+
+def _gene_ids(gtf_file):
+    # the count engine module is only needed for the gene ids of a new matrix
+    from .count_engine import gene_ids
+    return gene_ids(gtf_file)
+
+
+def _has_gene_counts(count_file):
+    # the special counters of htseq-count start with "__", a count file of a failed count may have no genes
+    try:
+        with gzip.open(count_file, 'rt') as f:
+            return any(line.strip() and not line.startswith('__') for line in f)
+    except (OSError, EOFError):
+        return False
+
+
+def add_to_matrix(matrix_dir, count_files, gtf_file=None):
+    '''
+    Add the count files of samples to the count matrix in matrix_dir, which is created from the gene ids of
+    gtf_file if it does not exist. Count files without gene counts are refused rather than added as samples of
+    zeros.
+    '''
+    empty = [count_file for count_file in count_files.values() if not _has_gene_counts(count_file)]
+    if empty:
+        sys.exit('Error: no gene counts in %s, the counting of the sample may have failed.' % ', '.join(empty))
+    if not os.path.exists(os.path.join(matrix_dir, MANIFEST)):
+        if gtf_file is None:
+            sys.exit('Error: %s is not a count matrix, a GTF file is needed to create it.' % matrix_dir)
+        mkdir(matrix_dir)
+        with _flock(os.path.join(matrix_dir, LOCK_FILE), fcntl.LOCK_EX):
+            if not os.path.exists(os.path.join(matrix_dir, MANIFEST)):
+                print('creating the count matrix %s with the genes of %s ...' % (matrix_dir, gtf_file), flush=True)
+                create_matrix(matrix_dir, _gene_ids(gtf_file))
+    return add_samples(matrix_dir, count_files)
+
+
+def build_matrix(args):
+    '''
+    Top level entry point for adding the gene counts of samples to a count matrix.
+    '''
+    count_files = find_count_files(args.input)
+    if not count_files:
+        sys.exit('Error: no %s files found in: %s' % (COUNT_FILE, ', '.join(args.input)))
+    added = add_to_matrix(args.count_matrix, count_files, args.ref)
+    print('added %d samples to %s, %d were up to date.' % (len(added), args.count_matrix, len(count_files) - len(added)), flush=True)
+
+
+def export_matrix(args):
+    '''
+    Top level entry point for exporting counts of a count matrix.
+    '''
+    if not os.path.exists(os.path.join(args.count_matrix, MANIFEST)):
+        sys.exit('Error: not a count matrix: %s' % args.count_matrix)
+    if args.format == 'mtx' and args.output == '-':
+        sys.exit('Error: "--format mtx" writes files, please give their prefix with --output.')
+    try:
+        with CountMatrix(args.count_matrix) as matrix:
+            if args.format == 'mtx':
+                export_mtx(matrix, args.output, args.genes, args.sample_names)
+            else:
+                with _open_output(args.output) as out:
+                    export_tsv(matrix, out, args.genes, args.sample_names)
+    except KeyError as e:
+        sys.exit('Error: %s' % e.args[0])
@@ -0,0 +1,245 @@
+'''
+Asynchronous executor of the shell commands run by run-cgprna.
+
+Commands run as coroutines on an asyncio event loop in a thread of its own, so any number of them can run side
+by side, from whichever threads they are started. Their output, stdout and stderr together, is copied as bytes
+into a log file per command in the log directory of the run, <out_dir>/logs, rather than relayed line by line
+through print. Without a log directory it is copied to stdout, a line at a time so concurrent commands do not
+split each other's lines.
+
+The console gets the command lines, a summary of the commands still running at most every CONSOLE_INTERVAL
+seconds, and the last lines of the log of a command which failed. When a command of run_commands fails, the
+others are killed, and terminate_running_processes kills all running commands, e.g. when a concurrent step fails.
+'''
+import os
+import re
+import sys
+import time
+import signal
+import asyncio
+import threading
+from subprocess import Popen, PIPE, STDOUT
+from . import run_report, command_log_dir, PIPEFAIL_SHELL
+
+# seconds between summaries of the running commands on the console
+CONSOLE_INTERVAL = 60
+# lines of the log of a failed command shown on the console
+FAILED_LOG_LINES = 20
+# bytes of output kept in memory for the summaries and errors
+TAIL_SIZE = 4096
+
+_loop = None
+_loop_lock = threading.Lock()
+# number of the last log in each log directory, the logs of earlier runs in it included
+_log_counts = {}
+_log_lock = threading.Lock()
+# running commands by their process, so that they can be killed when a concurrent step fails
+_running = {}
+_process_lock = threading.Lock()
+_stopping = threading.Event()
+
+
+class _Command(object):
+    # a running command and what the console is told about it
+    def __init__(self, name, command, log_file):
+        self.name = name
+        self.command = command
+        self.log_file = log_file
+        self.started = time.time()
+        self.output_size = 0
+        self.tail = b''
+
+
+class _OutputProtocol(asyncio.Protocol):
+    # copies the output of a command into its log, whole lines at a time
+    def __init__(self, command, out, done):
+        self.command = command
+        self.out = out
+        self.done = done
+        self.partial = b''
+
+    def _write(self, data):
+        if self.command.log_file is None:
+            # text printed before must come out first
+            sys.stdout.flush()
+        self.out.write(data)
+        self.out.flush()
+
+    def data_received(self, data):
+        self.command.output_size += len(data)
+        self.command.tail = (self.command.tail + data)[-TAIL_SIZE:]
+        end = data.rfind(b'\n') + 1
+        if end:
+            self._write(self.partial + data[:end])
+            self.partial = data[end:]
+        else:
+            self.partial += data
+
+    def connection_lost(self, exc):
+        if self.partial:
+            self._write(self.partial + b'\n')
+        if not self.done.done():
+            self.done.set_result(None)
+
+
+def command_name(command):
+    '''
+    Return a name for the log of a command: the name of the program it runs, also of a pipeline run by pipefail.
+    '''
+    if command.startswith(PIPEFAIL_SHELL):
+        command = command[len(PIPEFAIL_SHELL):].lstrip("'")
+    words = command.split()
+    return os.path.basename(words[0]) if words else 'command'
+
+
+def _open_log(name):
+    log_dir = command_log_dir()
+    if log_dir is None:
+        return None, sys.stdout.buffer
+    with _log_lock:
+        os.makedirs(log_dir, exist_ok=True)
+        if log_dir not in _log_counts:
+            _log_counts[log_dir] = len(os.listdir(log_dir))
+        _log_counts[log_dir] += 1
+        log_file = os.path.join(log_dir, '%03d.%s.log' % (_log_counts[log_dir], re.sub(r'[^\w.-]', '_', name)))
+    return log_file, open(log_file, 'wb')
+
+
+def _console(message):
+    # a single write, so the line is not split by other output
+    sys.stdout.write(message + '\n')
+    sys.stdout.flush()
+
+
+def _tail_lines(command):
+    return command.tail.decode(errors='replace').splitlines()[-FAILED_LOG_LINES:]
+
+
+def _duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%dh%02dm%02ds' % (hours, minutes, seconds) if hours else '%dm%02ds' % (minutes, seconds)
+
+
+async def _summarise():
+    # a summary of the commands writing to log files, instead of their output
+    while True:
+        await asyncio.sleep(CONSOLE_INTERVAL)
+        with _process_lock:
+            commands = sorted((command for command in _running.values() if command.log_file), key=lambda command: command.started)
+        now = time.time()
+        for command in commands:
+            last_lines = _tail_lines(command)
+            _console('running %s for %s, %d bytes of output%s' % (
+                command.name, _duration(now - command.started), command.output_size,
+                ': ' + last_lines[-1] if last_lines else ''))
+
+
+def _event_loop():
+    # the loop runs in a daemon thread, started by the first command
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                loop.create_task(_summarise())
+                loop.run_forever()
+            threading.Thread(target=run, name='run-cgprna-executor', daemon=True).start()
+            ready.wait()
+            _loop = loop
+    return _loop
+
+
+async def _run(name, command_line, group):
+    loop = asyncio.get_event_loop()
+    if _stopping.is_set():
+        return 'Error: cancelled: %s' % command_line
+    log_file, out = _open_log(name)
+    try:
+        with _process_lock:
+            if _stopping.is_set():
+                return 'Error: cancelled: %s' % command_line
+            _console('+' + command_line + ('\n  log: %s' % log_file if log_file else ''))
+            command = _Command(name, command_line, log_file)
+            # a session of its own, so the whole pipeline can be killed
+            p = Popen(command_line, shell=True, stdout=PIPE, stderr=STDOUT, start_new_session=True)
+            _running[p] = command
+            group.add(p)
+        done = loop.create_future()
+        transport, _ = await loop.connect_read_pipe(lambda: _OutputProtocol(command, out, done), p.stdout)
+        try:
+            # reaped here rather than by asyncio, to get its resource usage
+            _, status, usage = await loop.run_in_executor(None, os.wait4, p.pid, 0)
+            await done
+        finally:
+            transport.close()
+        with _process_lock:
+            p.returncode = run_report.exit_code(status)
+            del _running[p]
+            group.discard(p)
+    finally:
+        if log_file:
+            out.close()
+    run_report.record_step(command_line, command.started, time.time(), usage, p.returncode, log_file)
+    if p.returncode == 0:
+        return None
+    if log_file:
+        _console('Error: %s failed with exit code %d, last lines of %s:\n%s' % (
+            name, p.returncode, log_file, '\n'.join('  ' + line for line in _tail_lines(command))))
+    return 'Exit code: %d' % p.returncode
+
+
+async def _run_all(commands):
+    # the error of the first command which failed, the others are killed once it has
+    group = set()
+    pending = [asyncio.ensure_future(_run(name, command, group)) for name, command in commands]
+    first_error = None
+    while pending:
+        finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in finished:
+            error = task.exception() or task.result()
+            if error and first_error is None:
+                first_error = error
+                with _process_lock:
+                    _kill(group)
+    return first_error
+
+
+def _kill(processes):
+    for p in processes:
+        try:
+            os.killpg(p.pid, signal.SIGTERM)
+        except OSError:
+            pass  # already finished
+
+
+def run_commands(commands):
+    '''
+    Run commands, a list of (name, shell command) tuples, at the same time. If one fails, the others are killed
+    and the error of the first failure is raised as SystemExit.
+    '''
+    error = asyncio.run_coroutine_threadsafe(_run_all(commands), _event_loop()).result()
+    if isinstance(error, BaseException):
+        raise error
+    if error:
+        sys.exit(error)
+
+
+def terminate_running_processes():
+    '''
+    Kill all running commands and stop any further ones from starting.
+    '''
+    with _process_lock:
+        _stopping.set()
+        _kill(_running)
+
+
+def allow_new_processes():
+    '''
+    Allow commands to be started again after terminate_running_processes was called.
+    '''
+    _stopping.clear()
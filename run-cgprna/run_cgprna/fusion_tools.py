@@ -1,11 +1,17 @@
 import os
 import sys
-import re
 import shutil
 import copy
+import functools
 from string import Template
-from . import run_templates_in_shell, untar, mkdir
-import gzip
+from . import mkdir
+from .ref_cache import stage_reference
+from .scheduler import run_steps
+from .checkpoint import step_done, run_step
+from .preflight import preflight_inputs, mate_pairs, FASTQ_NAME_PATTERN
+from .scratch import (
+    temp_dir_path, make_temp_dir, remove_temp_dir, file_size, bundle_space, check_space,
+    GZIP_EXPANSION, BAM_TO_GZIP_FASTQ_EXPANSION, BAM_TO_FASTQ_EXPANSION)
 
 BAM_TO_FASTQ = Template('bamtofastq exclude=SECONDARY,SUPPLEMENTARY T=$bam2fq_tmp S=$bam2fq_tmp_single_end O=$bam2fq_tmp_unmatched O2=$bam2fq_tmp_unmatched2 gz=1 level=1 F=$bam2fq_tmp_matched F2=$bam2fq_tmp_matched_2 filename=$in_bam')
 # Defuse and its wapper defuse_fusion.pl cannot handle gzipped file.
@@ -13,6 +19,8 @@ BAM_TO_FASTQ_FOR_DEFUSE = Template('bamtofastq exclude=SECONDARY,SUPPLEMENTARY T
 TOPHAT_FUSION = Template('tophat_fusion.pl -s $sample_name -o $out_dir -t $threads -r $reference_data_root -sp $species -rb $ref_build -gb $gene_build $input')
 STAR_FUSION = Template('star_fusion.pl -s $sample_name -o $out_dir -t $threads -r $reference_data_root -sp $species -rb $ref_build -gb $gene_build $input')
 DEFUSE_FUSION = Template('defuse_fusion.pl -s $sample_name -o $out_dir -t $threads -r $reference_data_root -sp $species -rb $ref_build -gb $gene_build $input')
+# Defuse reads its input more than once, so gzipped FastQs given to it still have to be decompressed into files.
+GUNZIP = Template('$decompressor -dc "$source_file" > "$dest_file"')
 DEFUSE_FILTER = Template('defuse_filters.pl -s $sample_name -o $out_dir -i $out_dir/${sample_name}.defuse-fusion.normals.filtered.txt')
 
 NORMAL_FUSION_ARG_NAME='-normals'
@@ -23,28 +31,31 @@ REF_RELATED_DEFAULTS = {
     'gene_build': 'ensembl'
 }
 
+# members of a reference bundle each fusion tool reads, the normal fusions list is under cgpRna
+TOPHAT_REF_MEMBERS = ['genome.*', 'tophat', 'cgpRna']
+STAR_REF_MEMBERS = ['star', 'cgpRna']
+DEFUSE_REF_MEMBERS = ['defuse', 'cgpRna']
+
 
 def validate_input_seq_files(file_names):
     '''
     Perl wrappers: tophat_fusion.pl, star_fusion.pl and defuse.pl all support multiple input files but are restricted into a single type, i.e either BAM or FastQ files. As we're converting BAMs to fastqs before passing them to the wappers, we can easily handle a mixture of BAM and FastQ files, but needs to validate the files before starting to convert BAM to FastQ, so we don't waste time and resources on splitting a BAM when some of the FastQ files are not following the Perl wrapper's file name conventions.
     '''
     pairs = {}
-    fq_name_pattern = re.compile(r'(.*)_([12])\.f(?:ast)?q(?:\.gz)?$')
     for a_file in file_names:
         if a_file.endswith('.bam'):
             continue
         if not os.path.exists(a_file):
             sys.exit('Error: can not find input file: %s' % a_file)
         a_file = os.path.abspath(a_file)
-        match = fq_name_pattern.match(os.path.basename(a_file))
-        if match.group(2):
-            # if same mate number been spotted before or already got both mates
-            pair_name, first_or_second_mate_in_a_pair = match.groups()
-            if pairs.get(pair_name, 0) == int(first_or_second_mate_in_a_pair) or pairs.get(pair_name, 0) == 3:
-                sys.exit('Error: Too many \'_%s\' mate files for prefix: %s. Possibly redundant file: %s' % (first_or_second_mate_in_a_pair, pair_name, a_file))
-            pairs[pair_name] = pairs.get(pair_name, 0) + int(first_or_second_mate_in_a_pair)
-        else:
-            sys.exit('Error: File name does not follow expected coventions: %s' % a_file)
+        match = FASTQ_NAME_PATTERN.match(os.path.basename(a_file))
+        if match is None:
+            sys.exit('Error: File name does not follow expected coventions, <prefix>_1.fq[.gz] or <prefix>_2.fq[.gz] (or .fastq): %s' % a_file)
+        # if same mate number been spotted before or already got both mates
+        pair_name, first_or_second_mate_in_a_pair = match.groups()
+        if pairs.get(pair_name, 0) == int(first_or_second_mate_in_a_pair) or pairs.get(pair_name, 0) == 3:
+            sys.exit('Error: Too many \'_%s\' mate files for prefix: %s. Possibly redundant file: %s' % (first_or_second_mate_in_a_pair, pair_name, a_file))
+        pairs[pair_name] = pairs.get(pair_name, 0) + int(first_or_second_mate_in_a_pair)
     for pair_name, sum_of_mate_numbers in pairs.items():
         # if both _1 and _2 of a pair of fastq files are given, value should be 3
         if sum_of_mate_numbers != 3:
@@ -55,28 +66,23 @@ def validate_input_seq_files(file_names):
             sys.exit('Error: Internal code logic error, sum of first and second mate number in a pair of fastq files is %d, which is not expected and not handled well in code.' % sum_of_mate_numbers)
 
 
-# NOTE: So far only used if Defuse is given a gzipped fastq file
-def gunzip(source_file, dest_file):
-    print('unzipping %s ...' % os.path.basename(source_file), flush=True)
-    with gzip.open(source_file, 'rb') as s_file, open(dest_file, 'wb') as d_file:
-        shutil.copyfileobj(s_file, d_file, 65536)
-    print('done.', flush=True)
-
-
-def run_fusion_wrapper(args, temp_dir_name, fusion_templates, no_gzip=False):
+def run_fusion_wrapper(args, temp_dir_name, fusion_templates, ref_bundle_members, no_gzip=False):
     # args to dict to allow updates later
     args_dict = copy.deepcopy(vars(args))
     # only use temp_dir when needed to extract reference files
-    temp_dir = os.path.join(os.path.abspath(args.out_dir), temp_dir_name)
-    mkdir(temp_dir)
+    temp_dir = make_temp_dir(temp_dir_path(args, temp_dir_name))
 
     # valide inputs before bamtofastq, otherwise it could be to late
     validate_input_seq_files(args.input)
+    preflight_inputs(args, args.input, mate_pairs(args.input))
 
     # prepare the output dir
     mkdir(args.out_dir)
 
     reference_data_root=os.path.abspath(args.ref)
+    bundle_decompress_path = None
+    # prefix of the names of progress markers
+    step_prefix = getattr(args, 'subcommand', temp_dir_name)
 
     # Anything not a file will be treated as a reference root folder
     if not os.path.isfile(reference_data_root):
@@ -99,9 +105,12 @@ def run_fusion_wrapper(args, temp_dir_name, fusion_templates, no_gzip=False):
                 args_dict[arg_name] = REF_RELATED_DEFAULTS[arg_name]
             if arg_name == 'gene_build':
                 print('Make sure a folder named "%s" exists in the ref bundle.' % args_dict[arg_name])
-        untar(args.ref, os.path.join(reference_data_root, args_dict['species'], args_dict['ref_build']))
+        bundle_decompress_path = os.path.join(reference_data_root, args_dict['species'], args_dict['ref_build'])
 
     input_fastqs = []
+    prepare_steps = []
+    # estimated size of the FastQs and the reference written into temp_dir
+    temp_space = bundle_space(args, args.ref)
     fq_lane_name_count = 1
 
     # dumb Defuse perl wrapper doesn't like gzipped, so: 
@@ -118,26 +127,47 @@ def run_fusion_wrapper(args, temp_dir_name, fusion_templates, no_gzip=False):
                     temp_dir,
                     os.path.basename(a_raw_file)[:-3]  # remove the last 3 chars from the base name, which should be '.gz' 
                 )
-                gunzip(a_raw_file, unzip_to)
+                gunzip_params = {
+                    'decompressor': shutil.which('pigz') or 'gzip',
+                    'source_file': os.path.abspath(a_raw_file),
+                    'dest_file': os.path.abspath(unzip_to)
+                }
+                step_name = '%s.gunzip.%s' % (step_prefix, os.path.basename(a_raw_file))
+                prepare_steps.append((
+                    step_name,
+                    functools.partial(
+                        run_step, args, step_name, [GUNZIP], gunzip_params,
+                        [gunzip_params['source_file']], [gunzip_params['dest_file']]),
+                    []))
                 input_fastqs.append(os.path.abspath(unzip_to))
+                temp_space += file_size([a_raw_file]) * GZIP_EXPANSION
             else:
                 input_fastqs.append(os.path.abspath(a_raw_file))
             continue
 
+        # lane numbers follow the input order, so output file names do not depend on which conversion finishes first.
+        # None of the fusion callers use unpaired or singleton reads, so they are discarded rather than written.
         bam2fq_params = {
             'bam2fq_tmp': os.path.join(temp_dir, '%s.%s' % (args.sample_name, fq_lane_name_count)),
-            'bam2fq_tmp_single_end': os.path.join(temp_dir, '%s.%s.s' % (args.sample_name, fq_lane_name_count)),
-            'bam2fq_tmp_unmatched': os.path.join(temp_dir, '%s.%s.o1' % (args.sample_name, fq_lane_name_count)),
-            'bam2fq_tmp_unmatched2': os.path.join(temp_dir, '%s.%s.o2' % (args.sample_name, fq_lane_name_count)),
+            'bam2fq_tmp_single_end': os.devnull,
+            'bam2fq_tmp_unmatched': os.devnull,
+            'bam2fq_tmp_unmatched2': os.devnull,
             'bam2fq_tmp_matched': os.path.join(temp_dir, '%s.%s_1.%s' % (args.sample_name, fq_lane_name_count, fq_suffix)),
             'bam2fq_tmp_matched_2': os.path.join(temp_dir, '%s.%s_2.%s' % (args.sample_name, fq_lane_name_count, fq_suffix)),
             'in_bam': os.path.abspath(a_raw_file)
         }
-        run_templates_in_shell([bam_to_fq_template], bam2fq_params)
+        step_name = '%s.bamtofastq.%d' % (step_prefix, fq_lane_name_count)
+        prepare_steps.append((
+            step_name,
+            functools.partial(
+                run_step, args, step_name, [bam_to_fq_template], bam2fq_params,
+                [bam2fq_params['in_bam']], [bam2fq_params['bam2fq_tmp_matched'], bam2fq_params['bam2fq_tmp_matched_2']]),
+            []))
         input_fastqs += [
             bam2fq_params['bam2fq_tmp_matched'],
             bam2fq_params['bam2fq_tmp_matched_2']
         ]
+        temp_space += file_size([a_raw_file]) * (BAM_TO_FASTQ_EXPANSION if no_gzip else BAM_TO_GZIP_FASTQ_EXPANSION)
         fq_lane_name_count += 1
 
     # gathering parameters
@@ -152,28 +182,57 @@ def run_fusion_wrapper(args, temp_dir_name, fusion_templates, no_gzip=False):
         'gene_build': args_dict['gene_build']
     }
 
-    run_templates_in_shell(fusion_templates, params)
+    # each fusion step reads the output of the one before it
+    out_prefix = os.path.join(params['out_dir'], args.sample_name)
+    caller_steps = []
+    step_inputs = [os.path.abspath(path) for path in args.input] + [os.path.abspath(args.ref)]
+    for step_name, template, output_ext in fusion_templates:
+        step_outputs = [out_prefix + output_ext]
+        caller_steps.append(('%s.%s' % (step_prefix, step_name), template, step_inputs, step_outputs))
+        step_inputs = step_outputs
+
+    # FastQs and the reference are only needed by the fusion callers, skip them if all of those are done
+    if not all(step_done(args, name, [template], params, inputs) for name, template, inputs, _ in caller_steps):
+        check_space(temp_dir, int(temp_space))
+        if bundle_decompress_path:
+            stage_reference(args, args.ref, bundle_decompress_path, ref_bundle_members)
+        # each bamtofastq or decompression uses about a single core, so run as many of them at once as the threads allow
+        if prepare_steps:
+            run_steps(prepare_steps, min(args.threads, len(prepare_steps)))
+
+    for name, template, inputs, outputs in caller_steps:
+        run_step(args, name, [template], params, inputs, outputs)
 
     # clean temp dir
-    shutil.rmtree(temp_dir)
+    remove_temp_dir(temp_dir)
 
 
 def tophat_fusion(args):
     '''
     Top level entry point for running tophat_fusion on RNA-Seq data.
     '''
-    run_fusion_wrapper(args, 'cgpRna_tophat-fusion_temp', [TOPHAT_FUSION])
+    run_fusion_wrapper(
+        args, 'cgpRna_tophat-fusion_temp', [('tophat', TOPHAT_FUSION, '.tophat-fusion.normals.filtered.txt')],
+        TOPHAT_REF_MEMBERS)
 
 
 def star_fusion(args):
     '''
     Top level entry point for running star_fusion on RNA-Seq data.
     '''
-    run_fusion_wrapper(args, 'cgpRna_star-fusion_temp', [STAR_FUSION])
+    run_fusion_wrapper(
+        args, 'cgpRna_star-fusion_temp', [('star', STAR_FUSION, '.star-fusion.normals.filtered.txt')],
+        STAR_REF_MEMBERS)
 
 
 def defuse(args):
     '''
     Top level entry point for running defuse_fusion on RNA-Seq data.
     '''
-    run_fusion_wrapper(args, 'cgpRna_defuse_temp', [DEFUSE_FUSION, DEFUSE_FILTER], True)
+    run_fusion_wrapper(
+        args, 'cgpRna_defuse_temp',
+        [
+            ('defuse', DEFUSE_FUSION, '.defuse-fusion.normals.filtered.txt'),
+            ('filter', DEFUSE_FILTER, '.defuse-fusion.normals.ext.filtered.txt')
+        ],
+        DEFUSE_REF_MEMBERS, True)
@@ -1,37 +1,58 @@
 import os
-import shutil
+import sys
+import importlib.util
 from string import Template
-from . import run_templates_in_shell, untar, mkdir
+from . import run_templates_in_shell, untar, mkdir, pipefail
+from .scratch import temp_dir_path, make_temp_dir, remove_temp_dir, file_size, check_space, COLLATED_BAM_EXPANSION
+from .count_matrix import add_to_matrix, COUNT_FILE
 
 BAMCLOLLATE_TEMPLATE = Template('bamcollate2 collate=1 filename=$input inputformat=bam outputformat=bam level=1 exclude=SECONDARY,SUPPLEMENTARY O=$temp_dir/tmpCollated.bam')
-HTSEQ_COUNT_TEMPLATE = Template('htseq-count --format=bam --order=name --stranded="no" --type="exon" --idattr="gene_id" --mode="union" --quiet $temp_dir/tmpCollated.bam $ref | bgzip -c > $out_dir/rna_htseqcount.gz')
+HTSEQ_COUNT_TEMPLATE = pipefail(Template('htseq-count --format=bam --order=name --stranded="no" --type="exon" --idattr="gene_id" --mode="union" --quiet $temp_dir/tmpCollated.bam $ref | bgzip -c > $out_dir/rna_htseqcount.gz'))
+NATIVE_COUNT_TEMPLATE = pipefail(Template('$python -m run_cgprna.count_engine -i $input -r $ref -t $threads | bgzip -c > $out_dir/rna_htseqcount.gz'))
 
 
 def count(args):
     '''
     Top level entry point for generating gene counts from mapped RNA-Seq sequence files.
     '''
+    native_count = getattr(args, 'count_engine', 'htseq') == 'native'
+    if native_count and importlib.util.find_spec('pysam') is None:
+        sys.exit('Error: "--count-engine native" requires pysam, please install it or use "--count-engine htseq".')
+
     # temp_dir is for the temp bam
-    temp_dir = os.path.join(os.path.abspath(args.out_dir), 'cgpRna_count_temp')
+    temp_dir = temp_dir_path(args, 'cgpRna_count_temp')
 
     # prepare the output dir and temp dir
     mkdir(args.out_dir)
-    mkdir(temp_dir)
     
     # gathering parameters
     params = {
         'input': os.path.abspath(args.input),
         'out_dir': os.path.abspath(args.out_dir),
         'ref': os.path.abspath(args.ref),
-        'temp_dir': temp_dir
+        'temp_dir': temp_dir,
+        'python': sys.executable,
+        'threads': getattr(args, 'threads', 1)
     }
 
-    run_templates_in_shell(
-        [
-            BAMCLOLLATE_TEMPLATE,
-            HTSEQ_COUNT_TEMPLATE
-        ],
-        params)
+    if native_count:
+        # counts the indexed BAM as it is, without a name collated copy of it
+        run_templates_in_shell([NATIVE_COUNT_TEMPLATE], params)
+    else:
+        make_temp_dir(temp_dir)
+        check_space(temp_dir, int(file_size([params['input']]) * COLLATED_BAM_EXPANSION))
+        run_templates_in_shell(
+            [
+                BAMCLOLLATE_TEMPLATE,
+                HTSEQ_COUNT_TEMPLATE
+            ],
+            params)
+
+        # clean temp dir
+        remove_temp_dir(temp_dir)
 
-    # clean temp dir
-    shutil.rmtree(temp_dir)
+    if getattr(args, 'count_matrix', None):
+        # the sample is named after the output directory, as count-matrix names it
+        sample_name = os.path.basename(params['out_dir'])
+        add_to_matrix(args.count_matrix, {sample_name: os.path.join(params['out_dir'], COUNT_FILE)}, params['ref'])
+        print('added the counts of %s to the count matrix %s.' % (sample_name, args.count_matrix), flush=True)
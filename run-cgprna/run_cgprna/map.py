@@ -1,16 +1,39 @@
 import os
 import sys
 import re
-import shutil
 import fnmatch
 import copy
+import functools
+from collections import OrderedDict
 from string import Template
-from . import run_templates_in_shell, untar, mkdir
+from . import run_templates_in_shell, mkdir, pipefail
+from .ref_cache import stage_reference
+from .checkpoint import step_done, run_step
+from .preflight import preflight_inputs, mate_pairs
+from .scheduler import run_steps
+from .scratch import temp_dir_path, make_temp_dir, remove_temp_dir, bundle_space, check_space, file_size, MAPPED_LANE_EXPANSION
+from .resources import map_threads, lane_resources
 
-STAR_MAP_TEMPLATE = Template('star_mapping.pl -s $sample_name -o $out_dir -t $threads -r $reference_data_root -sp $species -rb $ref_build -gb $gene_build -g $gene_build_gtf_name $other_options $raw_reads_string')
-MARK_DUPS_TEMPLATE = Template('bammarkduplicates2 I=$out_dir/$sample_name.star.Aligned.out.bam O=$out_dir/$sample_name.bam md5=1 index=1 markthreads=$threads md5filename=$out_dir/$sample_name.bam.md5 indexfilename=$out_dir/$sample_name.bam.bai M=$out_dir/$sample_name.bam.met tmpfile=$out_dir/biormdup')
+# star_mapping.pl pipes the genome BAM from STAR through sorting into bammarkduplicates2, which writes the BAM,
+# its index and md5 straight into out_dir
+STAR_MAP_TEMPLATE = Template('star_mapping.pl -s $sample_name -o $out_dir -t $threads -mt $markdup_threads -r $reference_data_root -sp $species -rb $ref_build -gb $gene_build -g $gene_build_gtf_name -markdup $other_options $raw_reads_string')
 BAM_INDEX_TEMPLATE = Template('bamindex < $out_dir/$sample_name.star.AlignedtoTranscriptome.out.bam > $out_dir/$sample_name.star.AlignedtoTranscriptome.out.bam.bai')
 RENAME_OUTPUT_TEMPLATE = Template('mv "$out_dir/${sample_name}.$file_ext" "$out_dir/${out_file_prefix}.$file_ext"')
+# with --lanes, star_mapping.pl maps and sorts each lane, and the sorted lane BAMs are merged in coordinate order
+# straight into bammarkduplicates2, without a merged BAM in between
+LANE_MAP_TEMPLATE = Template('star_mapping.pl -s $sample_name -o $lane_dir -t $lane_threads -r $reference_data_root -sp $species -rb $ref_build -gb $gene_build -g $gene_build_gtf_name $lane_options $lane_reads_string')
+MERGE_MARKDUP_TEMPLATE = pipefail(Template('bammerge $lane_bams level=$merge_level tmpfile=$lanes_dir/bammerge.genome | ${keep_unmarked_tee}bammarkduplicates2 O=$out_dir/$sample_name.bam md5=1 index=1 markthreads=$markdup_threads md5filename=$out_dir/$sample_name.bam.md5 indexfilename=$out_dir/$sample_name.bam.bai M=$out_dir/$sample_name.bam.met tmpfile=$lanes_dir/bammarkduplicates2'))
+MERGE_TRANSCRIPTOME_TEMPLATE = Template('bammerge $lane_transcriptome_bams level=1 tmpfile=$lanes_dir/bammerge.transcriptome > $out_dir/$sample_name.star.AlignedtoTranscriptome.out.bam')
+
+# read group tags: the map option setting them for a single lane, and the star_mapping.pl option they are passed by
+RG_TAG_OPTIONS = OrderedDict([
+    ('ID', ('rg_id_tag', '-lane-id')),
+    ('LB', ('lb_tag', '-library')),
+    ('DS', ('ds_tag', '-ds-tag')),
+    ('PL', ('pl_tag', '-machine-type')),
+    ('PU', ('pu_tag', '-npg-run'))
+])
+LANE_INPUT_COLUMNS = ['input_1', 'input_2']
 
 # only because star_mapping.pl will try to find files in a particular structure
 REF_RELATED_DEFAULTS = {
@@ -19,6 +42,86 @@ REF_RELATED_DEFAULTS = {
     'gene_build': 'ensembl',
     'gene_build_gtf_name': 'ensembl.gtf'
 }
+# star_mapping.pl only reads the STAR index and the GTF files next to it
+REF_BUNDLE_MEMBERS = ['star']
+# the files of the STAR index loaded into memory
+STAR_GENOME_FILES = ['Genome', 'SA', 'SAindex']
+
+
+def read_lanes(lanes_file):
+    '''
+    Return the (read group ID, input files, read group tags) of each lane of a lanes file, a tab separated file with
+    a header line. Its columns are ID, input_1 (a raw BAM or the first FastQ file of a pair), input_2 (the second
+    FastQ file, empty for a BAM) and optionally LB, DS, PL and PU, the other read group tags. Empty lines and lines
+    starting with "#" are skipped.
+    '''
+    with open(lanes_file) as f:
+        lines = [(line_number, line.rstrip('\n').split('\t')) for line_number, line in enumerate(f, 1)
+                 if line.strip() and not line.startswith('#')]
+    if not lines:
+        sys.exit('Error: no header line in %s' % lanes_file)
+    header = [column.strip() for column in lines[0][1]]
+    unknown = [column for column in header if column not in RG_TAG_OPTIONS and column not in LANE_INPUT_COLUMNS]
+    if unknown or 'ID' not in header or 'input_1' not in header:
+        sys.exit('Error: the columns of %s must be ID, input_1 and optionally input_2, %s, not: %s' % (
+            lanes_file, ', '.join(list(RG_TAG_OPTIONS)[1:]), ', '.join(header)))
+    lanes = []
+    for line_number, fields in lines[1:]:
+        row = {column: value.strip() for column, value in zip(header, fields) if value.strip()}
+        if 'ID' not in row or 'input_1' not in row:
+            sys.exit('Error: line %d of %s has no ID or input_1.' % (line_number, lanes_file))
+        inputs = [os.path.abspath(row[column]) for column in LANE_INPUT_COLUMNS if column in row]
+        missing = [path for path in inputs if not os.path.isfile(path)]
+        if missing:
+            sys.exit('Error: can not find the input files of lane %s: %s' % (row['ID'], ', '.join(missing)))
+        lanes.append((row['ID'], inputs, OrderedDict((tag, row[tag]) for tag in RG_TAG_OPTIONS if tag in row)))
+    if not lanes:
+        sys.exit('Error: no lanes in %s' % lanes_file)
+    ids = [lane_id for lane_id, _, _ in lanes]
+    duplicated = sorted(set(lane_id for lane_id in ids if ids.count(lane_id) > 1))
+    if duplicated:
+        sys.exit('Error: duplicated read group IDs in %s: %s' % (lanes_file, ', '.join(duplicated)))
+    return lanes
+
+
+def _rg_options(tags):
+    # star_mapping.pl options setting the read group tags
+    return ['%s "%s"' % (RG_TAG_OPTIONS[tag][1], value) for tag, value in tags.items() if value]
+
+
+def _lane_dir_name(lane_id):
+    return re.sub(r'[^\w.-]', '_', lane_id)
+
+
+def _map_lanes(args, params, lanes, merge_steps, inputs, merged):
+    # maps the lanes, a few at a time within the threads of the run, then merges them into the sample BAMs
+    if not merged:
+        star_index = os.path.join(params['reference_data_root'], params['species'], params['ref_build'], 'star')
+        jobs, lane_threads = lane_resources(
+            args, len(lanes), file_size([os.path.join(star_index, name) for name in STAR_GENOME_FILES]))
+        make_temp_dir(params['lanes_dir'])
+        check_space(params['lanes_dir'], int(file_size(inputs) * MAPPED_LANE_EXPANSION))
+        lane_steps = []
+        for lane_id, lane_inputs, tags in lanes:
+            lane_params = dict(params, **{
+                'lane_dir': os.path.join(params['lanes_dir'], _lane_dir_name(lane_id)),
+                'lane_threads': lane_threads,
+                'lane_options': ' '.join(_rg_options(tags) + params['shared_options']),
+                'lane_reads_string': ' '.join(lane_inputs)
+            })
+            mkdir(lane_params['lane_dir'])
+            lane_prefix = os.path.join(lane_params['lane_dir'], args.sample_name)
+            lane_outputs = [lane_prefix + '.star.Aligned.out.bam', lane_prefix + '.star.AlignedtoTranscriptome.out.bam']
+            name = 'map.lane.' + _lane_dir_name(lane_id)
+            lane_steps.append((name, functools.partial(
+                run_step, args, name, [LANE_MAP_TEMPLATE], lane_params, lane_inputs + [os.path.abspath(args.ref)],
+                lane_outputs), []))
+        run_steps(lane_steps, jobs)
+    run_steps(
+        [(name, functools.partial(run_step, args, name, templates, params, inputs, outputs), [])
+         for name, templates, outputs in merge_steps],
+        len(merge_steps))
+
 
 def map_seq_files(args):
     '''
@@ -28,25 +131,37 @@ def map_seq_files(args):
     args_dict = copy.deepcopy(vars(args))
 
     # only use temp_dir when needed to extract reference files
-    temp_dir = os.path.join(os.path.abspath(args.out_dir), 'cgpRna_map_temp')
+    temp_dir = temp_dir_path(args, 'cgpRna_map_temp')
     clean_temp = 0
 
-    other_options = []
-    if args.rg_id_tag:
-        other_options.append('-lane-id "%s"' % args.rg_id_tag)
-    if args.lb_tag:
-        other_options.append('-library "%s"' % args.lb_tag)
-    if args.ds_tag:
-        other_options.append('-ds-tag "%s"' % args.ds_tag)
-    if args.pl_tag:
-        other_options.append('-machine-type "%s"' % args.pl_tag)
-    if args.pu_tag:
-        other_options.append('-npg-run "%s"' % args.pu_tag)
+    lanes = read_lanes(args.lanes) if getattr(args, 'lanes', None) else None
+    rg_tags = OrderedDict((tag, args_dict[dest]) for tag, (dest, _) in RG_TAG_OPTIONS.items())
+    if lanes and any(rg_tags.values()):
+        sys.exit('Error: with "--lanes", the read group tags of each lane are taken from the lanes file.')
+    input_files = [path for _, lane_inputs, _ in lanes for path in lane_inputs] if lanes else args.input
+    # the lanes file pairs the FastQs of a lane, otherwise the mates are paired by their names
+    pairs = [tuple(lane_inputs) for _, lane_inputs, _ in lanes if len(lane_inputs) == 2] if lanes else mate_pairs(input_files)
+    preflight_inputs(args, input_files, pairs)
+
+    # options of star_mapping.pl for every lane
+    shared_options = []
+    # set by map-batch, to use a STAR genome loaded into shared memory
+    if getattr(args, 'genome_load', None):
+        shared_options.append('-genome-load %s' % args.genome_load)
+    other_options = _rg_options(rg_tags) + shared_options
+    keep_unmarked = getattr(args, 'keep_unmarked', False)
+    if keep_unmarked:
+        other_options.append('-keep-unmarked')
+
+    # STAR, bamsort and bammarkduplicates2 run at the same time, they share the threads of the run
+    threads, markdup_threads = map_threads(args.threads)
+    markdup_threads = getattr(args, 'markdup_threads', None) or markdup_threads
 
     # prepare the output dir
     mkdir(args.out_dir)
 
     reference_data_root = os.path.abspath(args.ref)
+    bundle_decompress_path = None
     # Anything not a file will be treated as a reference root folder
     if not os.path.isfile(reference_data_root):
         if not os.path.exists(reference_data_root):
@@ -61,7 +176,7 @@ def map_seq_files(args):
         sys.exit('Error: wrong input format. "--reference" can only be a tar.gz file or a folder.')
     else:
         # If a pre-built ref bundle tar file is supplied, prepare the reference
-        mkdir(temp_dir)
+        make_temp_dir(temp_dir)
         clean_temp = 1
 
         # use the tar file name as the ref_root_dir_name, so that in BAM header, people can tell which bundle file was used
@@ -80,15 +195,15 @@ def map_seq_files(args):
 
         # make the folder structure
         bundle_decompress_path = os.path.join(temp_dir, ref_root_dir_name, args_dict['species'], args_dict['ref_build'])
-        # dump reference bundle
-        untar(args.ref, bundle_decompress_path)
 
     # gathering parameters
     params = {
         **vars(args),
-        'raw_reads_string': ' '.join([os.path.abspath(path) for path in args.input]),
+        'raw_reads_string': ' '.join([os.path.abspath(path) for path in input_files]),
         'reference_data_root': reference_data_root,
         'other_options': ' '.join(other_options),
+        'threads': threads,
+        'markdup_threads': markdup_threads,
         'out_dir': os.path.abspath(args.out_dir),  # overwrite the value in args with absolute path
         'species': args_dict['species'],  # overwrite the value in args
         'ref_build': args_dict['ref_build'],  # overwrite the value in args
@@ -96,13 +211,51 @@ def map_seq_files(args):
         'gene_build_gtf_name': args_dict['gene_build_gtf_name']  # overwrite the value in args
     }
 
-    run_templates_in_shell(
-        [
-            STAR_MAP_TEMPLATE,
-            MARK_DUPS_TEMPLATE,
-            BAM_INDEX_TEMPLATE
-        ],
-        params)
+    out_prefix = os.path.join(params['out_dir'], args.sample_name)
+    star_inputs = [os.path.abspath(path) for path in input_files] + [os.path.abspath(args.ref)]
+    if os.path.isfile(args_dict['gene_build_gtf_name']):
+        star_inputs.append(os.path.abspath(args_dict['gene_build_gtf_name']))
+    trans_bam = out_prefix + '.star.AlignedtoTranscriptome.out.bam'
+    star_outputs = [out_prefix + ext for ext in ('.bam', '.bam.bai', '.bam.md5', '.bam.met')] + [trans_bam]
+    if keep_unmarked:
+        star_outputs.append(out_prefix + '.star.Aligned.out.bam')
+
+    if lanes:
+        # the lanes are temp data, the merge steps are done once the sample BAMs are
+        lanes_dir = os.path.join(temp_dir, 'lanes')
+        lane_prefixes = [os.path.join(lanes_dir, _lane_dir_name(lane_id), args.sample_name) for lane_id, _, _ in lanes]
+        params.update({
+            'lanes_dir': lanes_dir,
+            'shared_options': shared_options,
+            'lane_bams': ' '.join('I=%s.star.Aligned.out.bam' % prefix for prefix in lane_prefixes),
+            'lane_transcriptome_bams': ' '.join('I=%s.star.AlignedtoTranscriptome.out.bam' % prefix for prefix in lane_prefixes),
+            # the merged stream is only compressed if it is kept
+            'merge_level': 1 if keep_unmarked else 0,
+            # the merge runs once the lanes are done, with all the threads
+            'markdup_threads': getattr(args, 'markdup_threads', None) or args.threads,
+            'keep_unmarked_tee': 'tee %s.star.Aligned.out.bam | ' % out_prefix if keep_unmarked else ''
+        })
+        merge_steps = [
+            ('map.merge', [MERGE_MARKDUP_TEMPLATE], [path for path in star_outputs if path != trans_bam]),
+            ('map.merge_transcriptome', [MERGE_TRANSCRIPTOME_TEMPLATE], [trans_bam])
+        ]
+        star_done = all(step_done(args, name, templates, params, star_inputs) for name, templates, _ in merge_steps)
+    else:
+        star_done = step_done(args, 'map.star', [STAR_MAP_TEMPLATE], params, star_inputs)
+
+    # the reference is only needed by STAR, no need to dump it when resuming after STAR has finished
+    if bundle_decompress_path and not star_done:
+        # dump reference bundle
+        check_space(temp_dir, bundle_space(args, args.ref))
+        stage_reference(args, args.ref, bundle_decompress_path, REF_BUNDLE_MEMBERS)
+
+    if lanes:
+        make_temp_dir(temp_dir)
+        clean_temp = 1
+        _map_lanes(args, params, lanes, merge_steps, star_inputs, star_done)
+    else:
+        run_step(args, 'map.star', [STAR_MAP_TEMPLATE], params, star_inputs, star_outputs)
+    run_step(args, 'map.index', [BAM_INDEX_TEMPLATE], params, [trans_bam], [trans_bam + '.bai'])
 
     if args.out_file_prefix:
         to_rename = [
@@ -110,10 +263,11 @@ def map_seq_files(args):
             "bam.bai",
             "bam.md5",
             "bam.met",
-            "star.Aligned.out.bam",
             "star.AlignedtoTranscriptome.out.bam",
             "star.AlignedtoTranscriptome.out.bam.bai"
         ]
+        if keep_unmarked:
+            to_rename.append("star.Aligned.out.bam")
         for file_ext in to_rename:
             run_templates_in_shell(
                 [
@@ -129,4 +283,4 @@ def map_seq_files(args):
 
     # clean temp dir
     if clean_temp:
-        shutil.rmtree(temp_dir)
+        remove_temp_dir(temp_dir)
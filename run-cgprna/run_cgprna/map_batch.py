@@ -0,0 +1,130 @@
+'''
+Map the samples of a manifest one after another, or a few at a time, with the STAR genome loaded once into
+shared memory rather than by every STAR run.
+
+The genome is loaded with "STAR --genomeLoad LoadAndExit", each sample is mapped by star_mapping.pl with
+"--genomeLoad LoadAndKeep", and the genome is removed from shared memory with "STAR --genomeLoad Remove" once
+all samples are done, whether they succeeded or not. As STAR cannot insert junctions on the fly into a shared
+genome, the junctions of the GTF file must have been built into the STAR index.
+
+With "--jobs auto" the samples mapped at once are as many as the CPUs and the memory left by the shared genome
+allow, with "--threads auto" each gets a share of the CPUs.
+'''
+import os
+import re
+import sys
+import argparse
+import functools
+from string import Template
+from . import run_shell_command, allow_new_processes
+from .map import map_seq_files, REF_RELATED_DEFAULTS, REF_BUNDLE_MEMBERS, STAR_GENOME_FILES
+from .ref_cache import stage_reference
+from .scheduler import run_steps
+from .scratch import temp_dir_path, make_temp_dir, remove_temp_dir, bundle_space, check_space, file_size
+from .resources import batch_resources
+
+STAR_GENOME_LOAD_TEMPLATE = Template('STAR --genomeDir $star_index --genomeLoad $genome_load --outFileNamePrefix $temp_dir/$genome_load.')
+# the STAR --genomeLoad mode of the samples
+SAMPLE_GENOME_LOAD = 'LoadAndKeep'
+
+
+def read_manifest(manifest_file):
+    '''
+    Return the (sample name, input files) of each line of a manifest, a tab separated file of a sample name
+    followed by its input files. Empty lines and lines starting with "#" are skipped.
+    '''
+    samples = []
+    with open(manifest_file) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = [field.strip() for field in line.rstrip('\n').split('\t') if field.strip()]
+            if len(fields) < 2:
+                sys.exit('Error: line %d of %s has no input files.' % (line_number, manifest_file))
+            samples.append((fields[0], [os.path.abspath(path) for path in fields[1:]]))
+    names = [name for name, _ in samples]
+    duplicated = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicated:
+        sys.exit('Error: duplicated sample names in %s: %s' % (manifest_file, ', '.join(duplicated)))
+    if not samples:
+        sys.exit('Error: no samples in %s' % manifest_file)
+    return samples
+
+
+def _map_sample(args, sample_name, failed):
+    # a failed sample does not stop the others
+    try:
+        map_seq_files(args)
+    except SystemExit as e:
+        print('Error: mapping of sample %s failed: %s' % (sample_name, e), flush=True)
+        failed.append(sample_name)
+
+
+def map_batch(args):
+    '''
+    Top level entry point for mapping the samples of a manifest with a shared STAR genome.
+    '''
+    samples = read_manifest(args.manifest)
+    out_dir = os.path.abspath(args.out_dir)
+    temp_dir = make_temp_dir(temp_dir_path(args, 'cgpRna_map_batch_temp'))
+
+    args_dict = vars(args)
+    ref_related = {key: args_dict[key] for key in REF_RELATED_DEFAULTS}
+    reference_data_root = os.path.abspath(args.ref)
+    if os.path.isfile(reference_data_root):
+        if not reference_data_root.endswith('.tar.gz'):
+            sys.exit('Error: wrong input format. "--reference" can only be a tar.gz file or a folder.')
+        # extract the bundle once for all samples, in the layout star_mapping.pl expects
+        ref_related = {key: value or REF_RELATED_DEFAULTS[key] for key, value in ref_related.items()}
+        ref_root_dir_name = re.match(r'(.*)\.tar\.gz$', os.path.basename(reference_data_root)).group(1)
+        reference_data_root = os.path.join(temp_dir, ref_root_dir_name)
+        check_space(temp_dir, bundle_space(args, args.ref))
+        stage_reference(
+            args, args.ref, os.path.join(reference_data_root, ref_related['species'], ref_related['ref_build']),
+            REF_BUNDLE_MEMBERS)
+    elif any(value is None for value in ref_related.values()):
+        sys.exit(
+            'Error: missing required input. When "--reference" is not a reference bundle tar file, you have to provide: %s' % ', '.join(
+                ['--' + key.replace('_', '-') for key, value in ref_related.items() if value is None]))
+
+    params = {
+        'star_index': os.path.join(reference_data_root, ref_related['species'], ref_related['ref_build'], 'star'),
+        'temp_dir': temp_dir
+    }
+    jobs, threads = args.jobs, args.threads
+    if args.auto_resources:
+        genome_size = file_size([os.path.join(params['star_index'], name) for name in STAR_GENOME_FILES])
+        jobs, threads = batch_resources(args, len(samples), genome_size)
+    steps = []
+    failed = []
+    for sample_name, inputs in samples:
+        sample_args = argparse.Namespace(**args_dict)
+        vars(sample_args).update(ref_related)
+        vars(sample_args).update({
+            'input': inputs,
+            'sample_name': sample_name,
+            'out_dir': os.path.join(out_dir, sample_name),
+            'out_file_prefix': None,
+            'ref': reference_data_root,
+            'genome_load': SAMPLE_GENOME_LOAD,
+            'threads': threads,
+            # read group tags are taken from the input BAM files
+            'rg_id_tag': None, 'lb_tag': None, 'ds_tag': None, 'pl_tag': None, 'pu_tag': None
+        })
+        steps.append((sample_name, functools.partial(_map_sample, sample_args, sample_name, failed), []))
+
+    # SIGTERM is turned into SystemExit by main, so that the shared genome is still removed
+    try:
+        run_shell_command(STAR_GENOME_LOAD_TEMPLATE.substitute(params, genome_load='LoadAndExit'))
+        run_steps(steps, jobs)
+    finally:
+        # a failed or cancelled run stops new commands, removing the genome must still be possible
+        allow_new_processes()
+        try:
+            run_shell_command(STAR_GENOME_LOAD_TEMPLATE.substitute(params, genome_load='Remove'))
+        except SystemExit:
+            print('Warning: failed to remove the STAR genome %s from shared memory, check it with "ipcs -m".' % params['star_index'], flush=True)
+        remove_temp_dir(temp_dir)
+
+    if failed:
+        sys.exit('Error: mapping failed for %d of %d samples: %s' % (len(failed), len(samples), ', '.join(failed)))
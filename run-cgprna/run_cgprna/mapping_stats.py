@@ -1,15 +1,22 @@
 import os
 import sys
 import re
-import shutil
+import functools
+import importlib.util
 from string import Template
-from . import run_templates_in_shell, untar, mkdir
+from . import mkdir
+from .ref_cache import stage_reference
+from .checkpoint import run_step
+from .scheduler import run_steps
+from .scratch import temp_dir_path, make_temp_dir, remove_temp_dir
+from .qc_store import add_samples
 
 BAMSTAT_GENOME_TEMPLATE = Template('bam_stats  -r $fai_file -i $input -o $out_dir/$sample_name.bam.bas')
 BAMSTAT_TRANSCRIPTOME_TEMPLATE = Template('bam_stats  -i $trans_bam -o $out_dir/$sample_name.transcriptome.bas')
 RSEQC_RRNA_TEMPLATE = Template('split_bam.py -i $input -r $ribsomal_rna_bed -o $out_dir/$sample_name.rRNA > $out_dir/$sample_name.rrna.txt')
 RSEQC_GENE_COVERAGE_TEMPLATE = Template('geneBody_coverage.py -i $input -r $house_keeping_gene_bed -f png -o $out_dir/$sample_name')
 RSEQC_READ_DISTRIBUTION_TEMPLATE = Template('read_distribution.py -i $input -r $reference_bed > $out_dir/$sample_name.read_dist.txt')
+NATIVE_QC_TEMPLATE = Template('$python -m run_cgprna.qc_engine -i $input -o $out_dir/$sample_name --rrna-bed $ribsomal_rna_bed --gene-model $reference_bed --house-keeping-genes $house_keeping_gene_bed -t $qc_threads')
 PROCESS_RNA_LANE_STATS_TEMPLATE = Template('process_qcstats.pl -s $sample_name -i $out_dir -o $out_dir')
 COLLATE_RNA_LANE_STATS_TEMPLATE = Template('paste $out_dir/$sample_name.bam.bas $out_dir/$sample_name.insert.bas $out_dir/$sample_name.read.dist.bas $out_dir/$sample_name.rrna.bas $out_dir/$sample_name.gene.cov.bas > $out_dir/$sample_name.RNA.bas')
 
@@ -17,6 +24,8 @@ FAI_FILE='genome.fa.fai'
 RIBSOMAL_RNA_BED='rRNA.bed'
 HOUSE_KEEPING_GENE_BED='HouseKeepingGenes.bed'
 REFERENCE_BED='RefSeq.bed'
+# the only members of a reference bundle the stats need
+REF_BUNDLE_MEMBERS=[FAI_FILE, RIBSOMAL_RNA_BED, HOUSE_KEEPING_GENE_BED, REFERENCE_BED]
 
 
 def generate_stats(args):
@@ -24,7 +33,7 @@ def generate_stats(args):
     Top level entry point for generating stats from mapped RNA-Seq sequence files.
     '''
     # only use temp_dir when needed to extract reference files
-    temp_dir = os.path.join(os.path.abspath(args.out_dir), 'cgpRna_mappingStats_temp')
+    temp_dir = temp_dir_path(args, 'cgpRna_mappingStats_temp')
     clean_temp = 0
 
     # guess a sample name from input file name
@@ -32,6 +41,10 @@ def generate_stats(args):
     # NOTE: geneBody_coverage.py (from RSeQC) uses bam file name without extension as a variable name in its output r script, unless this is changed, there's no way to use other source as output file prefix.
     sample_name, _ = os.path.splitext(os.path.basename(args.input))
 
+    native_qc = getattr(args, 'qc_engine', 'rseqc') == 'native'
+    if native_qc and importlib.util.find_spec('pysam') is None:
+        sys.exit('Error: "--qc-engine native" requires pysam, please install it or use "--qc-engine rseqc".')
+
     # prepare the output dir
     mkdir(args.out_dir)
 
@@ -40,9 +53,11 @@ def generate_stats(args):
     # If a ref bundle tar file is supplied
     # Anything else will be treated as a reference folder
     if args.ref.endswith('.tar.gz'):
-        mkdir(temp_dir)
+        # only the FASTA index and BED files are extracted, no need to check the space for them
+        make_temp_dir(temp_dir)
+        clean_temp = 1
         reference_data_root=os.path.join(temp_dir, 'ref')
-        untar(args.ref, reference_data_root)
+        stage_reference(args, args.ref, reference_data_root, REF_BUNDLE_MEMBERS)
     
     # gathering parameters
     params = {
@@ -53,27 +68,57 @@ def generate_stats(args):
         'fai_file': os.path.join(reference_data_root, FAI_FILE),
         'ribsomal_rna_bed': os.path.join(reference_data_root, RIBSOMAL_RNA_BED),
         'house_keeping_gene_bed': os.path.join(reference_data_root, HOUSE_KEEPING_GENE_BED),
-        'reference_bed': os.path.join(reference_data_root, REFERENCE_BED)
+        'reference_bed': os.path.join(reference_data_root, REFERENCE_BED),
+        'python': sys.executable,
+        # bam_stats runs alongside the native QC engine
+        'qc_threads': max(1, args.threads - 1)
     }
 
-    run_templates_in_shell(
-        [
-            BAMSTAT_GENOME_TEMPLATE,
-            RSEQC_RRNA_TEMPLATE,
-            RSEQC_GENE_COVERAGE_TEMPLATE,
-            RSEQC_READ_DISTRIBUTION_TEMPLATE
-        ],
-        params)
+    out_prefix = os.path.join(params['out_dir'], sample_name)
+    inputs = [params['input'], os.path.abspath(args.ref)]
+    qc_steps = [
+        ('stats.bam_stats', BAMSTAT_GENOME_TEMPLATE, inputs, [out_prefix + '.bam.bas'])
+    ]
+    if native_qc:
+        # one pass over the BAM file instead of one per RSeQC tool
+        qc_steps.append((
+            'stats.native_qc', NATIVE_QC_TEMPLATE, inputs,
+            [out_prefix + ext for ext in ('.rrna.txt', '.geneBodyCoverage.r', '.read_dist.txt')]))
+    else:
+        qc_steps.extend([
+            ('stats.rrna', RSEQC_RRNA_TEMPLATE, inputs, [out_prefix + '.rrna.txt']),
+            ('stats.gene_coverage', RSEQC_GENE_COVERAGE_TEMPLATE, inputs, [out_prefix + '.geneBodyCoverage.r']),
+            ('stats.read_distribution', RSEQC_READ_DISTRIBUTION_TEMPLATE, inputs, [out_prefix + '.read_dist.txt'])
+        ])
+    if args.trans_bam is not None:
+        qc_steps.append(
+            ('stats.bam_stats_transcriptome', BAMSTAT_TRANSCRIPTOME_TEMPLATE, [params['trans_bam']], [out_prefix + '.transcriptome.bas']))
+    # none of the QC tools depends on another, process_qcstats.pl needs all of them and paste needs its outputs
+    steps = [
+        (name, functools.partial(run_step, args, name, [template], params, step_inputs, outputs), [])
+        for name, template, step_inputs, outputs in qc_steps]
 
     if args.trans_bam is not None:
-        run_templates_in_shell(
-            [
-                BAMSTAT_TRANSCRIPTOME_TEMPLATE, 
-                PROCESS_RNA_LANE_STATS_TEMPLATE,
-                COLLATE_RNA_LANE_STATS_TEMPLATE
-            ],
-            params)
+        qc_outputs = [
+            out_prefix + ext for ext in ('.bam.bas', '.transcriptome.bas', '.rrna.txt', '.geneBodyCoverage.r', '.read_dist.txt')]
+        lane_stats = [out_prefix + ext for ext in ('.insert.bas', '.read.dist.bas', '.rrna.bas', '.gene.cov.bas')]
+        steps.append((
+            'stats.process',
+            functools.partial(run_step, args, 'stats.process', [PROCESS_RNA_LANE_STATS_TEMPLATE], params, qc_outputs, lane_stats),
+            [name for name, _, _, _ in qc_steps]))
+        steps.append((
+            'stats.collate',
+            functools.partial(
+                run_step, args, 'stats.collate', [COLLATE_RNA_LANE_STATS_TEMPLATE], params,
+                [out_prefix + '.bam.bas'] + lane_stats, [out_prefix + '.RNA.bas']),
+            ['stats.process']))
+
+    run_steps(steps, args.threads)
+
+    if getattr(args, 'qc_store', None):
+        add_samples(args.qc_store, {sample_name: params['out_dir']})
+        print('added the stats of %s to the QC store %s.' % (sample_name, args.qc_store), flush=True)
 
     # clean temp dir
     if clean_temp:
-        shutil.rmtree(temp_dir)
+        remove_temp_dir(temp_dir)
@@ -0,0 +1,89 @@
+'''
+Run stats, count and bigwig on a mapped BAM concurrently, optionally after mapping the reads first.
+
+The --threads budget is split between them, count gets a single core, or an even share with the native engine,
+stats one per QC tool it runs at once and bigwig the rest. They run as independent branches, so the run takes
+as long as the slowest of them rather than all three in a row.
+'''
+import os
+import sys
+import argparse
+import functools
+from . import mkdir
+from .map import map_seq_files
+from .mapping_stats import generate_stats
+from .htseq_count import count
+from .bigwig import generate_bigwig
+from .scheduler import run_steps
+
+# the number of QC tools generate_stats can run at the same time
+STATS_MAX_THREADS = 5
+
+
+def _branch_args(args, **values):
+    # every branch gets its own copy of the arguments, so they do not see each other's input and reference
+    branch_args = argparse.Namespace(**vars(args))
+    vars(branch_args).update(values)
+    return branch_args
+
+
+def post_map_steps(args, bam, trans_bam, dependencies):
+    '''
+    Return the steps of the branches which have a reference given, for run_steps, and the number of workers to
+    run them with.
+    '''
+    steps = []
+    threads = args.threads
+    if args.count_ref:
+        # htseq-count uses one core, the native engine shares the rest with the other branches
+        count_threads = 1
+        if getattr(args, 'count_engine', 'htseq') == 'native':
+            count_threads = max(1, threads // (1 + bool(args.stats_ref) + bool(args.bigwig_ref)))
+        steps.append((
+            'count',
+            functools.partial(count, _branch_args(args, input=bam, ref=args.count_ref, threads=count_threads)),
+            dependencies))
+        threads = max(1, threads - count_threads)
+    if args.stats_ref:
+        # stats runs up to five QC tools at once, leave at least half of the rest to bigwig
+        stats_threads = max(1, min(STATS_MAX_THREADS, threads // 2)) if args.bigwig_ref else threads
+        steps.append((
+            'stats',
+            functools.partial(
+                generate_stats,
+                _branch_args(args, input=bam, trans_bam=trans_bam, ref=args.stats_ref, threads=stats_threads)),
+            dependencies))
+        threads = max(1, threads - stats_threads)
+    if args.bigwig_ref:
+        steps.append((
+            'bigwig',
+            functools.partial(generate_bigwig, _branch_args(args, input=bam, ref=args.bigwig_ref, threads=threads)),
+            dependencies))
+    return steps, max(1, min(len(steps), args.threads))
+
+
+def post_map(args):
+    '''
+    Top level entry point for generating stats, gene counts and bigwig files from a mapped RNA-Seq BAM file.
+    '''
+    if not (args.stats_ref or args.count_ref or args.bigwig_ref):
+        sys.exit('Error: missing required input. Provide at least one of: --stats-reference, --count-reference, --bigwig-reference')
+    mkdir(args.out_dir)
+    trans_bam = None if args.trans_bam is None else os.path.abspath(args.trans_bam)
+    steps, max_workers = post_map_steps(args, os.path.abspath(args.input), trans_bam, [])
+    run_steps(steps, max_workers)
+
+
+def map_and_post_map(args):
+    '''
+    Top level entry point for mapping RNA-Seq sequence files, followed by generating stats, gene counts and
+    bigwig files from the mapped BAM file if their references are given.
+    '''
+    if not (args.stats_ref or args.count_ref or args.bigwig_ref):
+        map_seq_files(args)
+        return
+    # file names map_seq_files gives to its outputs
+    prefix = os.path.join(os.path.abspath(args.out_dir), args.out_file_prefix or args.sample_name)
+    steps, max_workers = post_map_steps(
+        args, prefix + '.bam', prefix + '.star.AlignedtoTranscriptome.out.bam', ['map'])
+    run_steps([('map', functools.partial(map_seq_files, args), [])] + steps, max_workers)
@@ -0,0 +1,285 @@
+'''
+Preflight of the input FastQ and BAM files of map and of the fusion subcommands, so that broken inputs fail a run
+before alignment rather than hours later inside STAR, TopHat or deFuse.
+
+The files are scanned in parallel, a worker process per file:
+
+- BGZF files (BAM files and bgzipped FastQs) are walked block by block from the block headers, which finds a
+  truncated or corrupt file without decompressing it, and must end with the BGZF EOF marker.
+- FastQ records are parsed: each needs a header, a separator and as many qualities as bases. The record count, a
+  checksum of the read names and the range of the quality values are collected.
+- The mates of a pair must have as many records, with the same read names in the same order.
+- The quality encoding is detected from the range of the quality values, Phred+64 inputs are rejected.
+
+The preflight is off unless asked for. With "--preflight sample", the first SAMPLE_RECORDS records of a FastQ are
+parsed, and the rest of the file is only checked for truncation: a gzipped FastQ is decompressed to its end, which
+also checks its gzip checksums, and an uncompressed one must end with a complete record. With "--preflight full",
+all the records are parsed. Results are cached by the path, size and mtime of a file in the directory given by
+--preflight-cache or $CGPRNA_PREFLIGHT_CACHE, if any, so that runs on the same inputs do not scan them again.
+'''
+import os
+import re
+import sys
+import gzip
+import json
+import zlib
+import struct
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+
+CACHE_DIR_ENV = 'CGPRNA_PREFLIGHT_CACHE'
+SAMPLE, FULL, OFF = 'sample', 'full', 'off'
+MODES = [OFF, SAMPLE, FULL]
+# FastQ records parsed by a sampled preflight
+SAMPLE_RECORDS = 100000
+# decompressed data read at a time to reach the end of a gzipped FastQ, and the end of an uncompressed one read to
+# find its last record
+READ_SIZE = 1 << 20
+# changes with the checks, so results of older checks are not reused
+CHECKS_VERSION = 2
+# file names of the mates of a pair, as the Perl wrappers expect them
+FASTQ_NAME_PATTERN = re.compile(r'(.*)_([12])\.f(?:ast)?q(?:\.gz)?$')
+GZIP_MAGIC = b'\x1f\x8b'
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+BAM_MAGIC = b'BAM\x01'
+# quality characters only found with one of the encodings: below ";" (Phred+33 Q26) with Phred+33, above "K"
+# (Phred+33 Q42) with Phred+64
+PHRED33_ONLY_BELOW = 59
+PHRED64_ONLY_ABOVE = 75
+PHRED33, PHRED64 = 'Phred+33', 'Phred+64'
+
+
+def mate_pairs(files):
+    '''
+    Return the pairs of FastQ files in files, as (first mate, second mate) tuples, from their names: <prefix>_1.fq.gz
+    and <prefix>_2.fq.gz.
+    '''
+    mates = OrderedDict()
+    for path in files:
+        match = FASTQ_NAME_PATTERN.match(os.path.basename(path))
+        if match:
+            mates.setdefault(match.group(1), {})[match.group(2)] = path
+    return [(pair['1'], pair['2']) for pair in mates.values() if len(pair) == 2]
+
+
+def _compression(path):
+    with open(path, 'rb') as f:
+        header = f.read(18)
+    if not header.startswith(GZIP_MAGIC):
+        return None
+    # BGZF blocks are gzip members with a BC extra subfield
+    return 'bgzf' if header.startswith(BGZF_MAGIC) and header[12:14] == b'BC' else 'gzip'
+
+
+def check_bgzf(path, verify_data=False):
+    '''
+    Walk the BGZF blocks of a file from their headers. Returns an error message, or None if the blocks are intact
+    and end with the EOF marker, and the decompressed data of the first block. With verify_data, all blocks are
+    decompressed and their checksums verified.
+    '''
+    size = os.path.getsize(path)
+    first_data = None
+    with open(path, 'rb') as f:
+        offset = 0
+        while offset < size:
+            header = f.read(12)
+            if len(header) < 12 or not header.startswith(BGZF_MAGIC):
+                return 'no BGZF block at offset %d, the file is corrupt' % offset, first_data
+            extra = f.read(struct.unpack('<H', header[10:12])[0])
+            block_size = None
+            position = 0
+            while position + 4 <= len(extra):
+                field_size = struct.unpack('<H', extra[position + 2:position + 4])[0]
+                if extra[position:position + 2] == b'BC' and field_size == 2:
+                    block_size = struct.unpack('<H', extra[position + 4:position + 6])[0] + 1
+                position += 4 + field_size
+            if block_size is None:
+                return 'BGZF block without a block size at offset %d, the file is corrupt' % offset, first_data
+            if offset + block_size > size:
+                return 'BGZF block at offset %d ends after the end of the file, the file is truncated' % offset, first_data
+            if verify_data or first_data is None:
+                block = f.read(block_size - 12 - len(extra))
+                crc, data_size = struct.unpack('<II', block[-8:])
+                try:
+                    data = zlib.decompress(block[:-8], -zlib.MAX_WBITS)
+                except zlib.error as e:
+                    return 'BGZF block at offset %d does not decompress: %s' % (offset, e), first_data
+                if zlib.crc32(data) & 0xffffffff != crc or len(data) != data_size:
+                    return 'BGZF block at offset %d fails its checksum, the file is corrupt' % offset, first_data
+                if first_data is None:
+                    first_data = data
+            else:
+                f.seek(offset + block_size)
+            offset += block_size
+        f.seek(max(0, size - len(BGZF_EOF)))
+        if f.read() != BGZF_EOF:
+            return 'no BGZF EOF marker, the file is truncated', first_data
+    return None, first_data
+
+
+def scan_fastq(handle, max_records=None):
+    '''
+    Parse the FastQ records of a binary file handle, at most max_records of them. Returns the number of records,
+    an md5 of their read names without the /1 or /2 mate suffix, the lowest and highest quality characters, whether
+    the end of the file was reached and an error message or None.
+    '''
+    names = hashlib.md5()
+    records, lowest, highest = 0, 255, 0
+    while max_records is None or records < max_records:
+        header = handle.readline()
+        if not header:
+            break
+        sequence, separator, qualities = handle.readline().rstrip(b'\r\n'), handle.readline(), handle.readline().rstrip(b'\r\n')
+        records += 1
+        if not header.startswith(b'@') or not separator.startswith(b'+'):
+            return records, names.hexdigest(), lowest, highest, False, 'record %d is not a FastQ record' % records
+        if len(sequence) != len(qualities):
+            return records, names.hexdigest(), lowest, highest, False, 'record %d has %d bases and %d qualities, the file may be truncated' % (records, len(sequence), len(qualities))
+        name = header[1:].split(None, 1)[0] if header[1:].strip() else b''
+        if name.endswith((b'/1', b'/2')):
+            name = name[:-2]
+        names.update(name + b'\n')
+        if qualities:
+            lowest, highest = min(lowest, min(qualities)), max(highest, max(qualities))
+    complete = max_records is None or records < max_records or not handle.readline()
+    return records, names.hexdigest(), lowest, highest, complete, None
+
+
+def _last_record_error(path):
+    # a complete FastQ ends with the 4 lines of a record
+    with open(path, 'rb') as f:
+        f.seek(max(0, os.path.getsize(path) - READ_SIZE))
+        tail = f.read()
+    lines = tail.splitlines()[-4:]
+    if not tail.endswith(b'\n') or len(lines) < 4 or not lines[0].startswith(b'@') or not lines[2].startswith(b'+') or len(lines[1]) != len(lines[3]):
+        return 'the last record is incomplete, the file is truncated'
+    return None
+
+
+def check_file(path, mode=SAMPLE):
+    '''
+    Check a FastQ or BAM file, returns a dict of the results, with the error found in it or None.
+    '''
+    result = {'path': path, 'error': None}
+    try:
+        compression = _compression(path)
+        result['compression'] = compression
+        if compression == 'bgzf' or path.endswith('.bam'):
+            # the gzip reader of a full scan verifies the checksums of a FastQ itself
+            error, first_data = check_bgzf(path, verify_data=mode == FULL and path.endswith('.bam'))
+            if error is None and path.endswith('.bam') and not (first_data or b'').startswith(BAM_MAGIC):
+                error = 'not a BAM file'
+            if error or path.endswith('.bam'):
+                result['error'] = error
+                return result
+        opener = gzip.open if compression else open
+        with opener(path, 'rb') as handle:
+            records, names, lowest, highest, complete, error = scan_fastq(handle, None if mode == FULL else SAMPLE_RECORDS)
+            # the records after the sample are not parsed, a truncated file must still fail, BGZF files were walked
+            # to their EOF marker above
+            if error is None and not complete and compression == 'gzip':
+                while handle.read(READ_SIZE):
+                    pass
+        if error is None and not complete and compression is None:
+            error = _last_record_error(path)
+        result.update({'records': records, 'names': names, 'lowest': lowest, 'highest': highest, 'complete': complete, 'error': error})
+        if error is None and records == 0:
+            result['error'] = 'no FastQ records'
+    except (OSError, EOFError, zlib.error) as e:
+        result['error'] = 'could not be read, the file may be corrupt or truncated: %s' % e
+    return result
+
+
+def quality_encoding(result):
+    '''
+    Return the quality encoding of a FastQ from the range of its quality characters, None if the range fits both.
+    '''
+    if result['lowest'] < PHRED33_ONLY_BELOW:
+        return PHRED33
+    if result['highest'] > PHRED64_ONLY_ABOVE:
+        return PHRED64
+    return None
+
+
+def _cache_file(cache_dir, path, mode):
+    stat = os.stat(path)
+    key = json.dumps([os.path.abspath(path), stat.st_size, stat.st_mtime, stat.st_ino, mode, SAMPLE_RECORDS, CHECKS_VERSION])
+    return os.path.join(cache_dir, '%s.json' % hashlib.md5(key.encode()).hexdigest())
+
+
+def _cached_result(cache_dir, path, mode):
+    try:
+        with open(_cache_file(cache_dir, path, mode)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _cache_result(cache_dir, path, mode, result):
+    # a cache which can not be written only costs a scan next time
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_file = _cache_file(cache_dir, path, mode)
+        temp_file = '%s.%d' % (cache_file, os.getpid())
+        with open(temp_file, 'w') as f:
+            json.dump(result, f)
+        os.rename(temp_file, cache_file)
+    except OSError:
+        pass
+
+
+def _pair_errors(results, pairs):
+    errors = []
+    for first, second in pairs:
+        first_result, second_result = results[first], results[second]
+        if first_result['error'] or second_result['error']:
+            continue
+        if first_result['records'] != second_result['records']:
+            errors.append('%s and %s have %d and %d reads, the mates are not paired' % (first, second, first_result['records'], second_result['records']))
+        elif first_result['names'] != second_result['names']:
+            errors.append('%s and %s have different read names, the mates are not paired' % (first, second))
+    return errors
+
+
+def preflight_inputs(args, input_files, pairs):
+    '''
+    Check the input files of a run, with pairs the (first mate, second mate) tuples of the paired FastQs among them,
+    in parallel with up to --threads worker processes. Exits with an error listing the problems found.
+    '''
+    mode = getattr(args, 'preflight', OFF)
+    if mode == OFF or not input_files:
+        return
+    cache_dir = getattr(args, 'preflight_cache', None) or os.environ.get(CACHE_DIR_ENV)
+    cache_dir = os.path.expanduser(cache_dir) if cache_dir else None
+    input_files = list(OrderedDict.fromkeys(os.path.abspath(path) for path in input_files))
+    pairs = [(os.path.abspath(first), os.path.abspath(second)) for first, second in pairs]
+    missing = [path for path in input_files if not os.path.isfile(path)]
+    if missing:
+        sys.exit('Error: can not find input file: %s' % ', '.join(missing))
+
+    results = OrderedDict((path, _cached_result(cache_dir, path, mode) if cache_dir else None) for path in input_files)
+    to_scan = [path for path, result in results.items() if result is None]
+    print('preflight: checking %d input files (%s), %d checked before.' % (len(to_scan), mode, len(input_files) - len(to_scan)), flush=True)
+    if to_scan:
+        # spawned rather than forked, map-batch runs the preflight of a sample from a thread of its own while others
+        # run the executor
+        with multiprocessing.get_context('spawn').Pool(max(1, min(int(args.threads), len(to_scan)))) as pool:
+            scanned = pool.starmap(check_file, [(path, mode) for path in to_scan])
+        for path, result in zip(to_scan, scanned):
+            results[path] = result
+            if cache_dir and result['error'] is None:
+                _cache_result(cache_dir, path, mode, result)
+
+    errors = ['%s: %s' % (path, result['error']) for path, result in results.items() if result['error']]
+    errors += _pair_errors(results, pairs)
+    encodings = OrderedDict()
+    for path, result in results.items():
+        if not result['error'] and 'records' in result:
+            encodings.setdefault(quality_encoding(result), []).append(path)
+    if PHRED64 in encodings:
+        errors.append('%s: qualities are %s encoded, the aligners and fusion callers expect %s' % (', '.join(encodings[PHRED64]), PHRED64, PHRED33))
+    if errors:
+        sys.exit('Error: input preflight failed:\n  %s' % '\n  '.join(errors))
+    print('preflight: %d input files are fine.' % len(input_files), flush=True)
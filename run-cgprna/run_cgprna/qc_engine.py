@@ -0,0 +1,446 @@
+'''
+Native RNA-Seq QC engine, an alternative to running RSeQC split_bam.py, read_distribution.py and
+geneBody_coverage.py one after another.
+
+The BAM is read once, one contig per worker process, and every read is checked against interval lists built
+from the BED files up front. The rRNA read count, the read distribution and the gene body coverage are written
+in the same formats as the RSeQC tools write them, so process_qcstats.pl can read them as before:
+
+* <prefix>.rrna.txt - rRNA records, counted the way split_bam.py does, without writing the split BAM files
+* <prefix>.read_dist.txt - tags assigned by the midpoint of each aligned block, as read_distribution.py does
+* <prefix>.geneBodyCoverage.txt/.r - depth at the 100 percentile points of each house keeping gene, as
+  geneBody_coverage.py does, but counted from the aligned blocks of the reads rather than a pileup, so the
+  depth is not capped
+
+It requires pysam and a BAM index to read contigs in parallel, without an index the BAM is read by one process.
+'''
+import os
+import re
+import sys
+import math
+import bisect
+import shutil
+import argparse
+import subprocess
+import multiprocessing
+from collections import defaultdict
+
+# the regions of read_distribution.py, in the order a tag is assigned to them
+READ_DIST_GROUPS = [
+    'CDS_Exons', "5'UTR_Exons", "3'UTR_Exons", 'Introns',
+    'TSS_up_1kb', 'TSS_up_5kb', 'TSS_up_10kb', 'TES_down_1kb', 'TES_down_5kb', 'TES_down_10kb'
+]
+INTERGENIC_SIZES = [('1kb', 1000), ('5kb', 5000), ('10kb', 10000)]
+# genes with mRNA shorter than this are not used for gene body coverage
+MIN_MRNA_LENGTH = 100
+# BAM cigar operations of aligned bases, as listed by pysam: M, = and X
+ALIGNED_CIGAR_OPS = (0, 7, 8)
+REFERENCE_CIGAR_OPS = (2, 3)
+
+# interval lists for the worker processes, set by _init_worker
+_regions = None
+
+
+def _import_pysam():
+    try:
+        import pysam
+    except ImportError:
+        sys.exit('Error: the native QC engine requires pysam, please install it or use "--qc-engine rseqc".')
+    return pysam
+
+
+def _read_bed12(bed_file):
+    with open(bed_file) as f:
+        for line in f:
+            if line.startswith(('#', 'track', 'browser')) or not line.strip():
+                continue
+            fields = line.rstrip('\n').split('\t')
+            tx_start = int(fields[1])
+            exon_starts = [tx_start + int(i) for i in fields[11].rstrip(',').split(',')]
+            exon_ends = [start + int(i) for start, i in zip(exon_starts, fields[10].rstrip(',').split(','))]
+            yield {
+                'chrom': fields[0],
+                'tx_start': tx_start,
+                'tx_end': int(fields[2]),
+                'name': fields[3],
+                'strand': fields[5],
+                'cds_start': int(fields[6]),
+                'cds_end': int(fields[7]),
+                'exons': list(zip(exon_starts, exon_ends))
+            }
+
+
+def _union(intervals):
+    # intervals is a dict of chrom to a list of (start, end), returns them sorted and merged
+    merged = {}
+    for chrom, chrom_intervals in intervals.items():
+        result = []
+        for start, end in sorted(chrom_intervals):
+            if end <= start:
+                continue
+            if result and start <= result[-1][1]:
+                result[-1][1] = max(result[-1][1], end)
+            else:
+                result.append([start, end])
+        merged[chrom] = [tuple(interval) for interval in result]
+    return merged
+
+
+def _subtract(intervals, to_remove):
+    # both are merged interval lists, returns the parts of intervals not in to_remove
+    result = {}
+    for chrom, chrom_intervals in intervals.items():
+        removing = to_remove.get(chrom, [])
+        remaining = []
+        i = 0
+        for start, end in chrom_intervals:
+            while i < len(removing) and removing[i][1] <= start:
+                i += 1
+            j = i
+            while j < len(removing) and removing[j][0] < end:
+                if removing[j][0] > start:
+                    remaining.append((start, removing[j][0]))
+                start = max(start, removing[j][1])
+                j += 1
+            if start < end:
+                remaining.append((start, end))
+        result[chrom] = remaining
+    return result
+
+
+def _size(intervals):
+    return sum(end - start for chrom_intervals in intervals.values() for start, end in chrom_intervals)
+
+
+def _index(intervals):
+    # merged intervals to a pair of sorted start and end lists for lookups with bisect
+    return {
+        chrom: ([start for start, _ in chrom_intervals], [end for _, end in chrom_intervals])
+        for chrom, chrom_intervals in intervals.items()}
+
+
+def _contains(index, chrom, pos):
+    if chrom not in index:
+        return False
+    starts, ends = index[chrom]
+    i = bisect.bisect_right(starts, pos) - 1
+    return i >= 0 and pos < ends[i]
+
+
+def rrna_regions(bed_file):
+    '''
+    Return the rRNA intervals by upper case chromosome name.
+    '''
+    intervals = defaultdict(list)
+    with open(bed_file) as f:
+        for line in f:
+            if line.startswith(('#', 'track', 'browser')) or not line.strip():
+                continue
+            fields = line.split()
+            intervals[fields[0].upper()].append((int(fields[1]), int(fields[2])))
+    return _index(_union(intervals))
+
+
+def read_dist_regions(bed_file):
+    '''
+    Return the read distribution regions from a BED12 gene model, as read_distribution.py builds them, and
+    the number of bases in each of them.
+    '''
+    raw = {group: defaultdict(list) for group in READ_DIST_GROUPS}
+    for tx in _read_bed12(bed_file):
+        chrom = tx['chrom'].upper()
+        left_utr, right_utr = ("5'UTR_Exons", "3'UTR_Exons") if tx['strand'] != '-' else ("3'UTR_Exons", "5'UTR_Exons")
+        for start, end in tx['exons']:
+            if start < tx['cds_start']:
+                raw[left_utr][chrom].append((start, min(end, tx['cds_start'])))
+            if end > tx['cds_end']:
+                raw[right_utr][chrom].append((max(start, tx['cds_end']), end))
+            if end > tx['cds_start'] and start < tx['cds_end']:
+                raw['CDS_Exons'][chrom].append((max(start, tx['cds_start']), min(end, tx['cds_end'])))
+        for (_, intron_start), (intron_end, _) in zip(tx['exons'][:-1], tx['exons'][1:]):
+            raw['Introns'][chrom].append((intron_start, intron_end))
+        for label, size in INTERGENIC_SIZES:
+            upstream = (max(0, tx['tx_start'] - size), tx['tx_start'])
+            downstream = (tx['tx_end'], tx['tx_end'] + size)
+            if tx['strand'] == '-':
+                upstream, downstream = (tx['tx_end'], tx['tx_end'] + size), (max(0, tx['tx_start'] - size), tx['tx_start'])
+            raw['TSS_up_' + label][chrom].append(upstream)
+            raw['TES_down_' + label][chrom].append(downstream)
+
+    regions = {group: _union(intervals) for group, intervals in raw.items()}
+    # exons take precedence over UTRs, which take precedence over introns and then the flanking regions
+    for group in ("5'UTR_Exons", "3'UTR_Exons", 'Introns'):
+        regions[group] = _subtract(regions[group], regions['CDS_Exons'])
+    for group in ("5'UTR_Exons", "3'UTR_Exons"):
+        regions['Introns'] = _subtract(regions['Introns'], regions[group])
+    for group in READ_DIST_GROUPS[4:]:
+        for precedent in READ_DIST_GROUPS[:4]:
+            regions[group] = _subtract(regions[group], regions[precedent])
+    sizes = {group: _size(intervals) for group, intervals in regions.items()}
+    return {group: _index(intervals) for group, intervals in regions.items()}, sizes
+
+
+def _percentiles(positions):
+    # 100 points along a sorted list of positions, rounding as python 2 did, as in geneBody_coverage.py
+    points = []
+    for i in range(1, 101):
+        k = (len(positions) - 1) * i / 100.0
+        f = math.floor(k)
+        c = math.ceil(k)
+        if f == c:
+            points.append(int(positions[int(k)]))
+        else:
+            points.append(int(math.floor(positions[int(f)] * (c - k) + positions[int(c)] * (k - f) + 0.5)))
+    return points
+
+
+def gene_body_points(bed_file):
+    '''
+    Return the percentile points of the house keeping genes, by chromosome, as a sorted list of 0 based
+    positions and a list of (gene, slot) for each of them. Also returns the strand of each gene.
+    '''
+    points = defaultdict(list)
+    strands = []
+    for tx in _read_bed12(bed_file):
+        mrna = [pos for start, end in tx['exons'] for pos in range(start + 1, end + 1)]
+        if len(mrna) < MIN_MRNA_LENGTH:
+            continue
+        gene = len(strands)
+        strands.append(tx['strand'])
+        # duplicated points are only counted once, as geneBody_coverage.py keeps them in a dict
+        for slot, pos in enumerate(sorted(set(_percentiles(mrna)))):
+            points[tx['chrom']].append((pos - 1, gene, slot))
+    index = {}
+    for chrom, chrom_points in points.items():
+        chrom_points.sort()
+        index[chrom] = ([pos for pos, _, _ in chrom_points], [(gene, slot) for _, gene, slot in chrom_points])
+    return index, strands
+
+
+def _aligned_blocks(read):
+    # a block, a tag of read_distribution.py, per aligned cigar operation, as RSeQC's fetch_exon gives them: the
+    # blocks either side of an insertion are not merged
+    blocks = []
+    pos = read.reference_start
+    for op, length in read.cigartuples:
+        if op in ALIGNED_CIGAR_OPS:
+            blocks.append((pos, pos + length))
+            pos += length
+        elif op in REFERENCE_CIGAR_OPS:
+            pos += length
+    return blocks
+
+
+def _assign_tag(index, chrom, mid):
+    # returns the read distribution group a tag counts towards, or None if it is not assigned
+    for group in READ_DIST_GROUPS[:4]:
+        if _contains(index[group], chrom, mid):
+            if group in ("5'UTR_Exons", "3'UTR_Exons"):
+                other = "3'UTR_Exons" if group == "5'UTR_Exons" else "5'UTR_Exons"
+                if _contains(index[other], chrom, mid):
+                    return None
+            return group
+    if _contains(index['TSS_up_10kb'], chrom, mid) and _contains(index['TES_down_10kb'], chrom, mid):
+        return None
+    for group in READ_DIST_GROUPS[4:]:
+        if _contains(index[group], chrom, mid):
+            return group
+    return None
+
+
+def _new_counts():
+    return {
+        'rrna_total': 0, 'rrna_in': 0, 'rrna_ex': 0, 'rrna_junk': 0,
+        'total_reads': 0, 'total_tags': 0, 'unassigned_tags': 0,
+        'groups': defaultdict(int), 'depth': {}
+    }
+
+
+def _init_worker(bam_file, regions):
+    global _regions
+    _regions = (bam_file, regions)
+
+
+def scan_contig(contig):
+    '''
+    Count the reads of one contig, or of the whole BAM if contig is None.
+    '''
+    pysam = _import_pysam()
+    bam_file, (rrna_index, dist_index, gene_points) = _regions
+    counts = _new_counts()
+    depth = [0] * len(gene_points[contig][0]) if contig in gene_points else None
+    current_chrom = None
+    with pysam.AlignmentFile(bam_file, 'rb') as bam:
+        reads = bam.fetch(until_eof=True) if contig is None else bam.fetch(contig)
+        for read in reads:
+            counts['rrna_total'] += 1
+            if read.is_qcfail:
+                continue
+            if read.is_unmapped:
+                counts['rrna_junk'] += 1
+                continue
+            if contig is None and read.reference_name != current_chrom:
+                # reading the whole BAM, switch the coverage points to the contig of this read
+                current_chrom = read.reference_name
+                if current_chrom in gene_points:
+                    depth = counts['depth'].setdefault(current_chrom, [0] * len(gene_points[current_chrom][0]))
+                else:
+                    depth = None
+            chrom = read.reference_name.upper()
+
+            # rRNA, a pair is in if either end starts in a rRNA region, as split_bam.py does
+            in_rrna = _contains(rrna_index, chrom, read.reference_start)
+            if not in_rrna and not read.mate_is_unmapped:
+                in_rrna = _contains(rrna_index, chrom, read.next_reference_start)
+            counts['rrna_in' if in_rrna else 'rrna_ex'] += 1
+
+            if read.is_duplicate or read.is_secondary:
+                continue
+            blocks = _aligned_blocks(read)
+            counts['total_reads'] += 1
+            counts['total_tags'] += len(blocks)
+            for start, end in blocks:
+                group = _assign_tag(dist_index, chrom, start + (end - start) // 2)
+                if group is None:
+                    counts['unassigned_tags'] += 1
+                else:
+                    counts['groups'][group] += 1
+                if depth is not None:
+                    positions = gene_points[read.reference_name][0]
+                    for i in range(bisect.bisect_left(positions, start), bisect.bisect_left(positions, end)):
+                        depth[i] += 1
+    if contig is not None and depth is not None:
+        counts['depth'][contig] = depth
+    return counts
+
+
+def _merge(total, counts):
+    for key in ('rrna_total', 'rrna_in', 'rrna_ex', 'rrna_junk', 'total_reads', 'total_tags', 'unassigned_tags'):
+        total[key] += counts[key]
+    for group, count in counts['groups'].items():
+        total['groups'][group] += count
+    total['depth'].update(counts['depth'])
+
+
+def _r_name(name):
+    # a valid R variable name, as geneBody_coverage.py and process_qcstats.pl make it
+    name = re.sub(r'[^a-zA-Z0-9_.]', '_', name)
+    return 'V' + name if name[0].isdigit() else name
+
+
+def write_rrna(counts, rrna_prefix, out_file):
+    with open(out_file, 'w') as f:
+        f.write('%-55s%d\n' % ('Total records:', counts['rrna_total']))
+        f.write('%-55s%d\n' % (rrna_prefix + '.in.bam:', counts['rrna_in']))
+        f.write('%-55s%d\n' % (rrna_prefix + '.ex.bam:', counts['rrna_ex']))
+        f.write('%-55s%d\n' % (rrna_prefix + '.junk.bam:', counts['rrna_junk']))
+
+
+def write_read_dist(counts, sizes, out_file):
+    groups = dict(counts['groups'])
+    # a tag in a closer flanking region is also counted towards the wider ones
+    for direction in ('TSS_up_', 'TES_down_'):
+        groups[direction + '5kb'] = groups.get(direction + '5kb', 0) + groups.get(direction + '1kb', 0)
+        groups[direction + '10kb'] = groups.get(direction + '10kb', 0) + groups[direction + '5kb']
+    with open(out_file, 'w') as f:
+        f.write('%-30s%d\n' % ('Total Reads', counts['total_reads']))
+        f.write('%-30s%d\n' % ('Total Tags', counts['total_tags']))
+        f.write('%-30s%d\n' % ('Total Assigned Tags', counts['total_tags'] - counts['unassigned_tags']))
+        f.write('=' * 69 + '\n')
+        f.write('%-20s%-20s%-20s%-20s\n' % ('Group', 'Total_bases', 'Tag_count', 'Tags/Kb'))
+        for group in READ_DIST_GROUPS:
+            count = groups.get(group, 0)
+            f.write('%-20s%-20d%-20d%-18.2f\n' % (group, sizes[group], count, count * 1000.0 / (sizes[group] + 1)))
+        f.write('=' * 69 + '\n')
+
+
+def write_gene_body_coverage(counts, gene_points, strands, out_prefix):
+    coverage = defaultdict(int)
+    per_gene = defaultdict(list)
+    for chrom, depth in counts['depth'].items():
+        for (gene, slot), value in zip(gene_points[chrom][1], depth):
+            per_gene[gene].append((slot, value))
+    for gene, slots in per_gene.items():
+        values = [value for _, value in sorted(slots)]
+        if strands[gene] == '-':
+            values.reverse()
+        for i, value in enumerate(values):
+            coverage[i] += value
+    values = [coverage[i] for i in range(100)]
+    name = _r_name(os.path.basename(out_prefix))
+    with open(out_prefix + '.geneBodyCoverage.txt', 'w') as f:
+        f.write('Percentile\t' + '\t'.join(str(i) for i in range(1, 101)) + '\n')
+        f.write(name + '\t' + '\t'.join(str(value) for value in values) + '\n')
+    low, high = min(values), max(values)
+    scaled = [(value - low) / float(high - low) if high > low else 0.0 for value in values]
+    with open(out_prefix + '.geneBodyCoverage.r', 'w') as f:
+        f.write('%s <- c(%s)\n' % (name, ','.join(str(value) for value in scaled)))
+        f.write("png('%s')\n" % (out_prefix + '.geneBodyCoverage.curves.png'))
+        f.write('x=1:100\n')
+        f.write('icolor = colorRampPalette(c("#7fc97f","#beaed4","#fdc086","#ffff99","#386cb0","#f0027f"))(1)\n')
+        f.write("plot(x,%s,type='l',xlab=\"Gene body percentile (5'->3')\", ylab=\"Coverage\",lwd=0.8,col=icolor[1])\n" % name)
+        f.write('dev.off()\n')
+
+
+def run_qc(bam_file, out_prefix, rrna_bed, gene_model_bed, house_keeping_bed, threads):
+    '''
+    Scan bam_file once and write the rRNA, read distribution and gene body coverage outputs with out_prefix.
+    '''
+    pysam = _import_pysam()
+    print('building intervals from BED files ...', flush=True)
+    dist_index, sizes = read_dist_regions(gene_model_bed)
+    gene_points, strands = gene_body_points(house_keeping_bed)
+    regions = (rrna_regions(rrna_bed), dist_index, gene_points)
+
+    with pysam.AlignmentFile(bam_file, 'rb') as bam:
+        if bam.has_index():
+            # largest contigs first, so the slowest ones do not start last
+            stats = sorted(bam.get_index_statistics(), key=lambda stat: -stat.total)
+            contigs = [stat.contig for stat in stats if stat.total > 0]
+            unplaced = bam.nocoordinate
+        else:
+            print('no index found for %s, reading it with a single process.' % bam_file, flush=True)
+            contigs = [None]
+            unplaced = 0
+
+    counts = _new_counts()
+    counts['rrna_total'] += unplaced
+    counts['rrna_junk'] += unplaced
+    print('scanning %d contigs of %s ...' % (len(contigs), bam_file), flush=True)
+    if threads > 1 and len(contigs) > 1:
+        pool = multiprocessing.Pool(min(threads, len(contigs)), _init_worker, (bam_file, regions))
+        try:
+            for contig_counts in pool.imap_unordered(scan_contig, contigs):
+                _merge(counts, contig_counts)
+        finally:
+            pool.terminate()
+    else:
+        _init_worker(bam_file, regions)
+        for contig in contigs:
+            _merge(counts, scan_contig(contig))
+
+    write_rrna(counts, out_prefix + '.rRNA', out_prefix + '.rrna.txt')
+    write_read_dist(counts, sizes, out_prefix + '.read_dist.txt')
+    write_gene_body_coverage(counts, gene_points, strands, out_prefix)
+    # draw the coverage curves, as geneBody_coverage.py does
+    if shutil.which('Rscript'):
+        subprocess.call(['Rscript', out_prefix + '.geneBodyCoverage.r'])
+    print('Done.', flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='run_cgprna.qc_engine',
+        description='Generate rRNA, read distribution and gene body coverage stats from a BAM file in one pass.')
+    parser.add_argument('-i', '--input', dest='input', metavar='FILE', required=True, help='Input BAM file.')
+    parser.add_argument('-o', '--output-prefix', dest='out_prefix', metavar='PREFIX', required=True, help='Prefix of output files.')
+    parser.add_argument('--rrna-bed', dest='rrna_bed', metavar='FILE', required=True, help='BED file of rRNA regions.')
+    parser.add_argument('--gene-model', dest='gene_model', metavar='FILE', required=True, help='BED12 file of the gene model.')
+    parser.add_argument('--house-keeping-genes', dest='house_keeping', metavar='FILE', required=True, help='BED12 file of house keeping genes.')
+    parser.add_argument('-t', '--threads', dest='threads', metavar='INT', type=int, default=1, help='Number of processes to use.')
+    args = parser.parse_args()
+    run_qc(args.input, args.out_prefix, args.rrna_bed, args.gene_model, args.house_keeping, args.threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,427 @@
+'''
+A columnar store of the mapping stats of a cohort, so that cohort QC reads a few column files rather than parsing
+the .bas files of every sample.
+
+A sample is added from the outputs of stats: its <sample>.bam.bas, which has a row per read group, and the sample
+level metrics of <sample>.insert.bas (the transcriptome insert sizes), .read.dist.bas, .rrna.bas and .gene.cov.bas
+where they exist, which are repeated on each of its rows. Values are typed as integers, floats or strings. A column
+of integers becomes a column of floats, and a numeric column a string column, once a value needs it. Empty and NA
+values are missing.
+
+The store is a directory of:
+
+* manifest.json: the number of rows and the columns, with their type, file and, for strings, the size of their
+  string table
+* <file>.col: a column, of little endian int64 or float64 values, or of uint32 indexes of strings in <file>.str,
+  which has a string per line
+* samples.tsv: the sample index, the first row, number of rows and a fingerprint of the stats files of each sample
+
+Adding samples appends rows to the column files, replaces the manifest and then appends the samples to the index,
+under a lock, so concurrent runs of stats can add to the same store. Readers hold a shared lock until they are
+closed, so that the files of a converted column are not removed while they may still read them. Rows are only read through the index: a sample
+added again after its stats files changed has its new rows read, and the rows of an interrupted add are never read,
+the next add overwrites them.
+'''
+import os
+import sys
+import json
+import fcntl
+import hashlib
+from array import array
+from contextlib import contextmanager
+from collections import OrderedDict
+from . import mkdir
+
+MANIFEST = 'manifest.json'
+SAMPLE_INDEX = 'samples.tsv'
+LOCK_FILE = '.lock'
+FORMAT_VERSION = 1
+SAMPLE_COLUMN = 'sample_name'
+GENOME_STATS = '.bam.bas'
+# sample level stats written by process_qcstats.pl, a header and a row of values each
+SAMPLE_STATS = ['.insert.bas', '.read.dist.bas', '.rrna.bas', '.gene.cov.bas']
+MISSING_VALUES = ('', 'NA', 'NaN', 'nan')
+# column types, in the order a column is converted from one to the next
+INT, FLOAT, STRING = 'int', 'float', 'string'
+TYPES = [INT, FLOAT, STRING]
+TYPECODES = {INT: 'q', FLOAT: 'd', STRING: 'I'}
+MISSING_INT = -(1 << 63)
+MISSING_STRING = 0xffffffff
+
+
+@contextmanager
+def _flock(lock_file, mode):
+    with open(lock_file, 'a') as fh:
+        fcntl.flock(fh, mode)
+        try:
+            yield fh
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _shared_lock(lock_file):
+    # kept by a reader until it is closed, a store the reader can not write to is locked through a read only handle
+    try:
+        fh = open(lock_file, 'a')
+    except PermissionError:
+        fh = open(lock_file)
+    fcntl.flock(fh, fcntl.LOCK_SH)
+    return fh
+
+
+def _read_tsv(file_name):
+    # the header and rows of a .bas file
+    with open(file_name) as f:
+        lines = [line.rstrip('\n').split('\t') for line in f if line.strip()]
+    return (lines[0], lines[1:]) if lines else ([], [])
+
+
+def _typed(value):
+    if value in MISSING_VALUES:
+        return None
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+def _value_type(value):
+    return INT if isinstance(value, int) else FLOAT if isinstance(value, float) else STRING
+
+
+def stats_files(stats_dir, sample):
+    '''
+    Return the stats files of sample in stats_dir which exist, its .bam.bas file first.
+    '''
+    paths = [os.path.join(stats_dir, sample + ext) for ext in [GENOME_STATS] + SAMPLE_STATS]
+    return [path for path in paths if os.path.exists(path)]
+
+
+def read_sample(stats_dir, sample):
+    '''
+    Return the records of sample, an OrderedDict of typed values per read group of its .bam.bas file, each with the
+    sample level metrics.
+    '''
+    header, rows = _read_tsv(os.path.join(stats_dir, sample + GENOME_STATS))
+    sample_metrics = OrderedDict()
+    for path in stats_files(stats_dir, sample)[1:]:
+        names, values = _read_tsv(path)
+        if values:
+            sample_metrics.update(zip(names, [_typed(value) for value in values[0]]))
+    records = []
+    for row in rows or [[]]:
+        record = OrderedDict([(SAMPLE_COLUMN, sample)])
+        record.update(zip(header, [_typed(value) for value in row]))
+        record.update(sample_metrics)
+        records.append(record)
+    return records
+
+
+def find_samples(inputs):
+    '''
+    Return an OrderedDict of sample name to stats directory of the .bam.bas files in inputs, which are .bam.bas
+    files or directories searched for them.
+    '''
+    samples = OrderedDict()
+    for path in inputs:
+        if os.path.isdir(path):
+            file_names = sorted(
+                os.path.join(root, name) for root, _, names in os.walk(path) for name in names if name.endswith(GENOME_STATS))
+        else:
+            file_names = [path]
+        for file_name in file_names:
+            if not file_name.endswith(GENOME_STATS) or not os.path.isfile(file_name):
+                sys.exit('Error: not a %s file of stats: %s' % (GENOME_STATS, file_name))
+            samples[os.path.basename(file_name)[:-len(GENOME_STATS)]] = os.path.dirname(os.path.abspath(file_name))
+    return samples
+
+
+def _fingerprint(paths):
+    # a sample is added again if any of its stats files is added, removed or modified
+    states = [(os.path.basename(path), os.path.getsize(path), os.stat(path).st_mtime_ns) for path in paths]
+    return hashlib.md5(repr(states).encode()).hexdigest()
+
+
+def _to_bytes(values):
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def _from_bytes(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def _column_file(store_dir, column, ext='.col'):
+    return os.path.join(store_dir, '%d%s' % (column['file'], ext))
+
+
+def _read_column(store_dir, column, rows):
+    typecode = TYPECODES[column['type']]
+    with open(_column_file(store_dir, column), 'rb') as f:
+        return _from_bytes(typecode, f.read(rows * array(typecode).itemsize))
+
+
+def _read_strings(store_dir, column):
+    if not column['strings_size']:
+        return []
+    with open(_column_file(store_dir, column, '.str'), 'rb') as f:
+        return f.read(column['strings_size']).decode().split('\n')[:-1]
+
+
+def _read_manifest(store_dir):
+    manifest_file = os.path.join(store_dir, MANIFEST)
+    if not os.path.exists(manifest_file):
+        return {'format_version': FORMAT_VERSION, 'rows': 0, 'next_file': 0, 'columns': []}
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    if manifest.get('format_version') != FORMAT_VERSION:
+        raise ValueError('not a cgpRna QC store of version %d: %s' % (FORMAT_VERSION, store_dir))
+    return manifest
+
+
+def _read_sample_index(store_dir, rows):
+    # the last entry of each sample, entries of rows beyond those in the manifest were not completed
+    samples = OrderedDict()
+    index_file = os.path.join(store_dir, SAMPLE_INDEX)
+    if os.path.exists(index_file):
+        with open(index_file) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 4:
+                    continue
+                first, count = int(fields[1]), int(fields[2])
+                if first + count <= rows:
+                    samples[fields[0]] = (first, count, fields[3])
+    return samples
+
+
+def _decode(column, values, strings):
+    if column['type'] == INT:
+        return [None if value == MISSING_INT else value for value in values]
+    if column['type'] == FLOAT:
+        return [None if value != value else value for value in values]
+    return [None if value == MISSING_STRING else strings[value] for value in values]
+
+
+def _encode(column, values, strings):
+    # strings is a dict of the codes of the strings in the table, new strings are added to it
+    if column['type'] == INT:
+        return array('q', [MISSING_INT if value is None else value for value in values])
+    if column['type'] == FLOAT:
+        return array('d', [float('nan') if value is None else float(value) for value in values])
+    codes = array('I')
+    for value in values:
+        if value is None:
+            codes.append(MISSING_STRING)
+        else:
+            value = value if isinstance(value, str) else repr(value)
+            codes.append(strings.setdefault(value, len(strings)))
+    return codes
+
+
+def _write_column(store_dir, column, values, strings, first_string=0):
+    # appends to the files of the column, which hold the data of committed rows only
+    with open(_column_file(store_dir, column), 'ab') as f:
+        f.write(_to_bytes(values))
+    if column['type'] == STRING and len(strings) > first_string:
+        new_strings = ''.join('%s\n' % value for value in list(strings)[first_string:]).encode()
+        with open(_column_file(store_dir, column, '.str'), 'ab') as f:
+            f.write(new_strings)
+        column['strings_size'] += len(new_strings)
+
+
+def _truncate(store_dir, column, rows):
+    # drops the data of an interrupted add
+    column_size = rows * array(TYPECODES[column['type']]).itemsize
+    for path, size in ((_column_file(store_dir, column), column_size), (_column_file(store_dir, column, '.str'), column['strings_size'])):
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            os.truncate(path, size)
+
+
+def _remove_files(store_dir, column):
+    for ext in ('.col', '.str'):
+        if os.path.exists(_column_file(store_dir, column, ext)):
+            os.remove(_column_file(store_dir, column, ext))
+
+
+def _new_file(store_dir, manifest, column):
+    # files of a new or converted column, an interrupted add may have left files of the same name
+    column.update({'file': manifest['next_file'], 'strings_size': 0})
+    manifest['next_file'] += 1
+    _remove_files(store_dir, column)
+
+
+def add_samples(store_dir, samples):
+    '''
+    Add samples, an OrderedDict of sample name to stats directory, to the QC store in store_dir, which is created if
+    it does not exist. Samples whose stats files have not changed since they were added are skipped. Returns the
+    names of the samples added.
+    '''
+    mkdir(store_dir)
+    with _flock(os.path.join(store_dir, LOCK_FILE), fcntl.LOCK_EX):
+        manifest = _read_manifest(store_dir)
+        rows = manifest['rows']
+        index = _read_sample_index(store_dir, rows)
+        added = []
+        for sample, stats_dir in samples.items():
+            fingerprint = _fingerprint(stats_files(stats_dir, sample))
+            if sample not in index or index[sample][2] != fingerprint:
+                added.append((sample, fingerprint, read_sample(stats_dir, sample)))
+        if not added:
+            return []
+        records = [record for _, _, sample_records in added for record in sample_records]
+
+        columns = OrderedDict((column['name'], column) for column in manifest['columns'])
+        replaced = []
+        for column in columns.values():
+            _truncate(store_dir, column, rows)
+        for name in OrderedDict((name, None) for record in records for name in record):
+            value_types = set(_value_type(record[name]) for record in records if record.get(name) is not None)
+            column_type = max(value_types | {INT}, key=TYPES.index)
+            column = columns.get(name)
+            if column is None:
+                # a new column, missing in the rows already in the store
+                column = {'name': name, 'type': column_type}
+                _new_file(store_dir, manifest, column)
+                columns[name] = column
+                _write_column(store_dir, column, _encode(column, [None] * rows, {}), {})
+            elif TYPES.index(column_type) > TYPES.index(column['type']):
+                # converted into new files, the old ones are removed once the manifest no longer refers to them
+                values = _decode(column, _read_column(store_dir, column, rows), _read_strings(store_dir, column))
+                replaced.append(dict(column))
+                column['type'] = column_type
+                _new_file(store_dir, manifest, column)
+                strings = OrderedDict()
+                _write_column(store_dir, column, _encode(column, values, strings), strings)
+
+        for column in columns.values():
+            strings = OrderedDict((value, code) for code, value in enumerate(_read_strings(store_dir, column)))
+            first_string = len(strings)
+            values = _encode(column, [record.get(column['name']) for record in records], strings)
+            _write_column(store_dir, column, values, strings, first_string)
+
+        manifest['rows'] = rows + len(records)
+        manifest['columns'] = list(columns.values())
+        temp_file = os.path.join(store_dir, '%s.%d' % (MANIFEST, os.getpid()))
+        with open(temp_file, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.rename(temp_file, os.path.join(store_dir, MANIFEST))
+        for column in replaced:
+            _remove_files(store_dir, column)
+
+        with open(os.path.join(store_dir, SAMPLE_INDEX), 'a') as f:
+            for sample, fingerprint, sample_records in added:
+                f.write('%s\t%d\t%d\t%s\n' % (sample, rows, len(sample_records), fingerprint))
+                rows += len(sample_records)
+    return [sample for sample, _, _ in added]
+
+
+class QcStore(object):
+    '''
+    A QC store, read from disk. Only the columns asked for are read, e.g. store.column('#_mapped_reads') is the
+    values of a metric for every read group of every sample, in the order of store.samples. Adds to the store wait
+    until it is closed, e.g. at the end of a with block.
+    '''
+    def __init__(self, store_dir):
+        self.path = store_dir
+        # an add converting a column removes its old files, which the manifest read here refers to
+        self._lock = _shared_lock(os.path.join(store_dir, LOCK_FILE))
+        manifest = _read_manifest(store_dir)
+        self.rows = manifest['rows']
+        self._columns = OrderedDict((column['name'], column) for column in manifest['columns'])
+        # sample name to first row, number of rows and fingerprint
+        self.samples = _read_sample_index(store_dir, self.rows)
+
+    @property
+    def columns(self):
+        return list(self._columns)
+
+    def column_type(self, name):
+        return self._columns[name]['type']
+
+    def _rows(self, samples):
+        if samples is None:
+            samples = self.samples
+        unknown = [sample for sample in samples if sample not in self.samples]
+        if unknown:
+            raise KeyError('samples not in the QC store: %s' % ', '.join(unknown))
+        return [self.samples[sample][:2] for sample in samples]
+
+    def column(self, name, samples=None):
+        '''
+        Return the values of column name, None where missing, for the rows of samples, by default of all samples.
+        '''
+        if name not in self._columns:
+            raise KeyError('column not in the QC store: %s' % name)
+        column = self._columns[name]
+        values = _read_column(self.path, column, self.rows)
+        selected = values[:0]
+        for first, count in self._rows(samples):
+            selected.extend(values[first:first + count])
+        return _decode(column, selected, _read_strings(self.path, column))
+
+    def records(self, columns=None, samples=None):
+        '''
+        Return an iterator of an OrderedDict of the values of columns, by default of all columns, for each row of
+        samples, by default of all samples.
+        '''
+        names = self.columns if columns is None else columns
+        values = [self.column(name, samples) for name in names]
+        return (OrderedDict(zip(names, row)) for row in zip(*values))
+
+    def close(self):
+        self._lock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def export_tsv(store, out, columns=None, samples=None):
+    '''
+    Write the rows of samples of a QC store as TSV into out, with a header of its columns. Missing values are
+    written as NA.
+    '''
+    names = store.columns if columns is None else columns
+    records = store.records(names, samples)
+    out.write('\t'.join(names) + '\n')
+    for record in records:
+        out.write('\t'.join('NA' if value is None else str(value) for value in record.values()) + '\n')
+
+
+def add_to_store(args):
+    '''
+    Top level entry point for adding the stats of samples to a QC store.
+    '''
+    samples = find_samples(args.input)
+    if not samples:
+        sys.exit('Error: no %s files of stats found in: %s' % (GENOME_STATS, ', '.join(args.input)))
+    added = add_samples(args.qc_store, samples)
+    print('added %d samples to %s, %d were up to date.' % (len(added), args.qc_store, len(samples) - len(added)), flush=True)
+
+
+def export_store(args):
+    '''
+    Top level entry point for exporting metrics of a QC store as TSV.
+    '''
+    if not os.path.exists(os.path.join(args.qc_store, MANIFEST)):
+        sys.exit('Error: not a QC store: %s' % args.qc_store)
+    try:
+        with QcStore(args.qc_store) as store:
+            if args.output == '-':
+                export_tsv(store, sys.stdout, args.columns, args.sample_names)
+            else:
+                with open(args.output, 'w') as f:
+                    export_tsv(store, f, args.columns, args.sample_names)
+    except KeyError as e:
+        sys.exit('Error: %s' % e.args[0])
@@ -0,0 +1,234 @@
+'''
+Node-local cache of extracted reference bundles.
+
+Bundles are keyed by the md5 of the tar file, so each bundle is only extracted once per node no matter
+how many runs use it. Subcommands needing only part of a bundle get an entry holding just those members.
+Entries are built in a private temp dir and published with an atomic rename, runs hold a shared lock on
+the entry they use, and the least recently used entries that nobody holds are evicted once the cache
+grows beyond its size limit.
+'''
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+from contextlib import contextmanager
+from . import untar, mkdir
+
+CACHE_DIR_ENV = 'CGPRNA_REF_CACHE'
+CACHE_SIZE_ENV = 'CGPRNA_REF_CACHE_SIZE'
+DEFAULT_CACHE_SIZE = '200G'
+
+CACHE_LOCK = '.lock'
+CHECKSUM_FILE = '.checksums.json'
+ENTRY_META = 'cgpRna_cache.json'
+ENTRY_BUNDLE = 'bundle'
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+# file handles of shared locks on the entries used by this process, they are released on exit.
+_held_entries = {}
+
+
+def parse_size(size):
+    '''
+    Convert a size such as "500M" or "200G" into bytes.
+    '''
+    size = str(size).strip().upper().rstrip('B')
+    try:
+        if size and size[-1] in SIZE_UNITS:
+            return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+        return int(size)
+    except ValueError:
+        sys.exit('Error: invalid size value: %s' % size)
+
+
+@contextmanager
+def _flock(lock_file, mode):
+    with open(lock_file, 'a') as fh:
+        fcntl.flock(fh, mode)
+        try:
+            yield fh
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _md5(file_path):
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(4 * 1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def bundle_checksum(tar_file, cache_dir):
+    '''
+    Return the md5 of a bundle. Checksums are remembered by path, size and mtime, so an unchanged
+    bundle is only read once.
+    '''
+    tar_file = os.path.realpath(tar_file)
+    stat = os.stat(tar_file)
+    checksum_file = os.path.join(cache_dir, CHECKSUM_FILE)
+    with _flock(os.path.join(cache_dir, CACHE_LOCK), fcntl.LOCK_SH):
+        known = _read_json(checksum_file)
+    record = known.get(tar_file)
+    if record and record['size'] == stat.st_size and record['mtime'] == stat.st_mtime:
+        return record['md5']
+    print('calculating md5 of %s ...' % tar_file, flush=True)
+    digest = _md5(tar_file)
+    with _flock(os.path.join(cache_dir, CACHE_LOCK), fcntl.LOCK_EX):
+        known = _read_json(checksum_file)
+        known[tar_file] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'md5': digest}
+        _write_json(checksum_file, known)
+    return digest
+
+
+def _read_json(json_file):
+    try:
+        with open(json_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(json_file, content):
+    temp_file = '%s.%d' % (json_file, os.getpid())
+    with open(temp_file, 'w') as f:
+        json.dump(content, f, indent=2)
+    os.rename(temp_file, json_file)
+
+
+def _hold_entry(cache_dir, digest):
+    # a shared lock marks the entry as in use for the lifetime of this process
+    if digest not in _held_entries:
+        fh = open(os.path.join(cache_dir, '.%s.lock' % digest), 'a')
+        fcntl.flock(fh, fcntl.LOCK_SH)
+        _held_entries[digest] = fh
+
+
+def _list_entries(cache_dir):
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.startswith('.'):
+            continue
+        meta = _read_json(os.path.join(cache_dir, name, ENTRY_META))
+        if not meta:
+            continue
+        last_used = os.path.getmtime(os.path.join(cache_dir, name, ENTRY_META))
+        entries.append((last_used, name, meta.get('size', 0)))
+    return sorted(entries)
+
+
+def _remove_stale_builds(cache_dir):
+    for name in os.listdir(cache_dir):
+        if not name.startswith('.tmp.'):
+            continue
+        key = name[len('.tmp.'):].rsplit('.', 1)[0]
+        with open(os.path.join(cache_dir, '.%s.build.lock' % key), 'a') as fh:
+            try:
+                fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                continue  # still being built
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+
+
+def evict(cache_dir, size_limit):
+    '''
+    Remove least recently used entries, which are not in use by any run, until the cache fits in size_limit bytes.
+    '''
+    with _flock(os.path.join(cache_dir, CACHE_LOCK), fcntl.LOCK_EX):
+        _remove_stale_builds(cache_dir)
+        entries = _list_entries(cache_dir)
+        total = sum(size for _, _, size in entries)
+        for _, digest, size in entries:
+            if total <= size_limit:
+                break
+            with open(os.path.join(cache_dir, '.%s.lock' % digest), 'a') as fh:
+                try:
+                    fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # in use
+                print('evicting reference bundle %s from cache.' % digest, flush=True)
+                trash = os.path.join(cache_dir, '.trash.%s.%d' % (digest, os.getpid()))
+                os.rename(os.path.join(cache_dir, digest), trash)
+                shutil.rmtree(trash, ignore_errors=True)
+                total -= size
+
+
+def _entry_key(digest, members):
+    # a partial extraction is keyed by the bundle checksum plus the selection of members it holds
+    if members is None:
+        return digest
+    selection = hashlib.md5('\n'.join(sorted(members)).encode()).hexdigest()[:12]
+    return '%s.%s' % (digest, selection)
+
+
+def cached_bundle(tar_file, cache_dir, size_limit, members=None, threads=1):
+    '''
+    Return the path of the extracted content of tar_file in the cache, extracting it first if it has not been cached yet.
+    If members is given, only those members are extracted, unless the full bundle is already in the cache.
+    '''
+    mkdir(cache_dir)
+    digest = bundle_checksum(tar_file, cache_dir)
+    key = _entry_key(digest, members)
+    if members is not None and os.path.isdir(os.path.join(cache_dir, digest)):
+        key = digest
+    entry_dir = os.path.join(cache_dir, key)
+    _hold_entry(cache_dir, key)
+    # the full bundle may have been evicted since it was found, it is then built again in full, never from members
+    entry_members = None if key == digest else members
+    if not os.path.isdir(entry_dir):
+        with _flock(os.path.join(cache_dir, '.%s.build.lock' % key), fcntl.LOCK_EX):
+            # another run may have published it while we waited for the lock
+            if not os.path.isdir(entry_dir):
+                build_dir = tempfile.mkdtemp(prefix='.tmp.%s.' % key, dir=cache_dir)
+                os.chmod(build_dir, 0o755)
+                untar(tar_file, os.path.join(build_dir, ENTRY_BUNDLE), members=entry_members, threads=threads)
+                _write_json(
+                    os.path.join(build_dir, ENTRY_META),
+                    {
+                        'source': os.path.realpath(tar_file),
+                        'md5': digest,
+                        'members': entry_members,
+                        'size': _dir_size(build_dir),
+                        'created': time.strftime('%Y-%m-%dT%H:%M:%S')
+                    })
+                os.rename(build_dir, entry_dir)
+        evict(cache_dir, size_limit)
+    else:
+        print('using cached reference bundle %s.' % entry_dir, flush=True)
+    # mtime of the metadata file records when the entry was used last
+    os.utime(os.path.join(entry_dir, ENTRY_META))
+    return os.path.join(entry_dir, ENTRY_BUNDLE)
+
+
+def stage_reference(args, tar_file, dest, members=None):
+    '''
+    Make the content of a reference bundle available at dest. When a reference cache is configured, dest is
+    a symlink to the cached copy, otherwise the bundle is extracted to dest. If members is given, only those
+    files or directories of the bundle are staged.
+    '''
+    threads = getattr(args, 'threads', 1) or 1
+    cache_dir = getattr(args, 'ref_cache', None)
+    if not cache_dir:
+        untar(tar_file, dest, members=members, threads=threads)
+        return
+    bundle_dir = cached_bundle(
+        tar_file, os.path.abspath(cache_dir), parse_size(args.ref_cache_size), members=members, threads=threads)
+    mkdir(os.path.dirname(dest))
+    if os.path.lexists(dest):
+        os.remove(dest)
+    os.symlink(bundle_dir, dest)
@@ -0,0 +1,174 @@
+'''
+The CPUs and memory available to a run, for "--threads auto" and "--jobs auto".
+
+os.cpu_count() is the number of CPUs of the host, also in a container or a Slurm job. The CPUs a run may use are
+the ones it is pinned to, e.g. by a Slurm cpuset, within the CPU quota of its cgroup, e.g. the CPU limit of a
+Kubernetes container. Its memory is the memory of the host within the memory limit of its cgroup. Limits are
+read from cgroup v2 (cpu.max, memory.max) and v1 (cpu.cfs_quota_us, memory.limit_in_bytes), of the cgroup of the
+process and of its parents, the lowest limit applies.
+
+The threads of a run, given as a number or with "auto" the CPUs available to it, are split between the tools it
+runs at the same time, e.g. STAR and the sorting and duplicate marking it is piped into.
+'''
+import os
+import argparse
+from .scratch import format_size
+
+AUTO = 'auto'
+CGROUP_ROOT = '/sys/fs/cgroup'
+PROC_CGROUP = '/proc/self/cgroup'
+# star_mapping.pl runs STAR with at most 16 threads
+STAR_MAX_THREADS = 16
+# share of the threads of map for each of bamsort and bammarkduplicates2, which STAR is piped into
+MARKDUP_SHARE = 0.125
+# memory each STAR run needs besides the genome, for its buffers and the sorting of its BAM, and the threads it
+# gets at least when several run at once
+STAR_RUN_MEMORY = 4 << 30
+STAR_RUN_MIN_THREADS = 4
+
+
+def threads_value(value):
+    '''
+    Parse a number of threads or jobs, a positive number or "auto".
+    '''
+    if value == AUTO:
+        return value
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError('invalid value: %s, it must be a positive number or "%s"' % (value, AUTO))
+    return number
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _cgroup_dirs(controller=None):
+    # the cgroup directories of this process and of its parents, of a v1 controller or of v2 if controller is None
+    lines = (_read(PROC_CGROUP) or '').splitlines()
+    dirs = []
+    for line in lines:
+        fields = line.split(':', 2)
+        if len(fields) != 3:
+            continue
+        _, controllers, path = fields
+        if controller is None:
+            if controllers:
+                continue
+            mounts = [CGROUP_ROOT]
+        elif controller in controllers.split(','):
+            mounts = [os.path.join(CGROUP_ROOT, controllers), os.path.join(CGROUP_ROOT, controller)]
+        else:
+            continue
+        for mount in mounts:
+            # in a container the cgroup of the process is usually the root of the mount
+            path_dir = os.path.normpath(os.path.join(mount, path.lstrip('/')))
+            while path_dir.startswith(mount):
+                if os.path.isdir(path_dir) and path_dir not in dirs:
+                    dirs.append(path_dir)
+                path_dir = os.path.dirname(path_dir)
+    return dirs
+
+
+def cpu_limit():
+    '''
+    Return the number of CPUs this process may use: the CPUs it is pinned to, within the CPU quota of its cgroup.
+    '''
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    quotas = []
+    for cgroup_dir in _cgroup_dirs():
+        value = (_read(os.path.join(cgroup_dir, 'cpu.max')) or 'max').split()
+        if value[0] != 'max':
+            quotas.append(int(value[0]) / int(value[1] if len(value) > 1 else 100000))
+    for cgroup_dir in _cgroup_dirs('cpu'):
+        quota = _read(os.path.join(cgroup_dir, 'cpu.cfs_quota_us'))
+        period = _read(os.path.join(cgroup_dir, 'cpu.cfs_period_us'))
+        if quota and period and int(quota) > 0:
+            quotas.append(int(quota) / int(period))
+    if quotas:
+        # a part of a CPU is not worth a thread of its own
+        cpus = min(cpus, max(1, int(min(quotas))))
+    return cpus
+
+
+def memory_limit():
+    '''
+    Return the memory this process may use, in bytes: the memory of the host within the memory limit of its cgroup.
+    '''
+    limits = [os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')]
+    for cgroup_dir in _cgroup_dirs():
+        value = _read(os.path.join(cgroup_dir, 'memory.max'))
+        if value and value != 'max':
+            limits.append(int(value))
+    for cgroup_dir in _cgroup_dirs('memory'):
+        # without a limit, v1 reports a huge number
+        value = _read(os.path.join(cgroup_dir, 'memory.limit_in_bytes'))
+        if value:
+            limits.append(int(value))
+    return min(limits)
+
+
+def resolve_resources(args):
+    '''
+    Replace "--threads auto" by the number of CPUs available to the run, and note it in args.auto_threads.
+    args.auto_resources is set if threads or jobs are automatic, so that the samples of map-batch and the lanes of
+    map are run as many at once as the CPUs and the memory allow.
+    '''
+    args.auto_threads = getattr(args, 'threads', None) == AUTO
+    args.auto_resources = args.auto_threads or getattr(args, 'jobs', None) == AUTO
+    if not args.auto_resources:
+        return
+    args.cpus, args.memory = cpu_limit(), memory_limit()
+    print('resources: %d CPUs and %s of memory available.' % (args.cpus, format_size(args.memory)), flush=True)
+    if args.auto_threads:
+        args.threads = args.cpus
+
+
+def map_threads(threads):
+    '''
+    Split the threads of map between STAR and each of bamsort and bammarkduplicates2, which run at the same time.
+    Returns the threads of STAR and of the sorting and duplicate marking.
+    '''
+    markdup_threads = max(1, int(threads * MARKDUP_SHARE))
+    star_threads = min(STAR_MAX_THREADS, max(1, threads - 2 * markdup_threads))
+    # the threads STAR cannot use go to the sorting and duplicate marking
+    markdup_threads = max(markdup_threads, (threads - star_threads) // 2)
+    return star_threads, markdup_threads
+
+
+def batch_resources(args, samples, genome_size):
+    '''
+    Return the number of samples map-batch maps at once and the threads of each: explicit values are used as they
+    are, "auto" jobs are as many as the CPUs and the memory left by the shared genome of genome_size bytes allow,
+    "auto" threads are the CPUs shared by the jobs.
+    '''
+    jobs, threads = args.jobs, args.threads
+    if jobs == AUTO:
+        by_memory = max(1, (args.memory - genome_size) // STAR_RUN_MEMORY)
+        by_cpus = max(1, args.cpus // (STAR_RUN_MIN_THREADS if args.auto_threads else threads))
+        jobs = max(1, min(samples, by_memory, by_cpus))
+    if args.auto_threads:
+        threads = max(1, args.cpus // jobs)
+    print('map-batch: %d samples at once, %d threads each.' % (jobs, threads), flush=True)
+    return jobs, threads
+
+
+def lane_resources(args, lanes, genome_size):
+    '''
+    Return the number of lanes map aligns at once and the threads of each, within the threads of the run. Each lane
+    gets at least STAR_RUN_MIN_THREADS threads, and with automatic resources the STAR runs, each loading the genome
+    of genome_size bytes, must fit into the memory available.
+    '''
+    jobs = max(1, min(lanes, args.threads // STAR_RUN_MIN_THREADS))
+    if getattr(args, 'auto_resources', False):
+        jobs = max(1, min(jobs, args.memory // (genome_size + STAR_RUN_MEMORY)))
+    threads = max(1, args.threads // jobs)
+    print('map: %d lanes, %d at once, %d threads each.' % (lanes, jobs, threads), flush=True)
+    return jobs, threads
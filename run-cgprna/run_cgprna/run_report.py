@@ -0,0 +1,80 @@
+'''
+Resource usage of the commands run by run-cgprna, written to a JSON report at the end of a run.
+
+Usage of a command is taken from the rusage of its shell, which includes the commands the shell waited for.
+Read and written bytes are counted from block I/O, so reads served from the page cache are not included.
+'''
+import os
+import sys
+import json
+import time
+import threading
+
+REPORT_FILE = 'run-cgprna.%s.report.json'
+# ru_inblock and ru_oublock are counted in 512 byte blocks
+IO_BLOCK_SIZE = 512
+
+_steps = []
+_steps_lock = threading.Lock()
+
+
+def _timestamp(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(seconds))
+
+
+def exit_code(status):
+    '''
+    Convert a wait status into an exit code the same way subprocess does, i.e. negative if killed by a signal.
+    '''
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def record_step(command, started, finished, usage, code, log_file=None):
+    '''
+    Add the resource usage of a finished command to the report, with the log file of its output if it has one.
+    '''
+    step = {
+        'command': command,
+        'started': _timestamp(started),
+        'exit_code': code,
+        'wall_time_s': round(finished - started, 3),
+        'user_cpu_s': round(usage.ru_utime, 3),
+        'system_cpu_s': round(usage.ru_stime, 3),
+        'max_rss_kb': usage.ru_maxrss,
+        'read_bytes': usage.ru_inblock * IO_BLOCK_SIZE,
+        'written_bytes': usage.ru_oublock * IO_BLOCK_SIZE
+    }
+    if log_file:
+        step['log_file'] = log_file
+    with _steps_lock:
+        _steps.append(step)
+
+
+def write_report(subcommand, version, out_dir, started, succeeded):
+    '''
+    Write the usage of all commands run so far into the report file of the subcommand in out_dir.
+    '''
+    finished = time.time()
+    with _steps_lock:
+        steps = sorted(_steps, key=lambda step: step['started'])
+    report = {
+        'subcommand': subcommand,
+        'version': version,
+        'command_line': sys.argv,
+        'status': 'success' if succeeded else 'failed',
+        'started': _timestamp(started),
+        'finished': _timestamp(finished),
+        'wall_time_s': round(finished - started, 3),
+        'user_cpu_s': round(sum(step['user_cpu_s'] for step in steps), 3),
+        'system_cpu_s': round(sum(step['system_cpu_s'] for step in steps), 3),
+        'max_rss_kb': max([step['max_rss_kb'] for step in steps] or [0]),
+        'steps': steps
+    }
+    report_file = os.path.join(out_dir, REPORT_FILE % subcommand)
+    try:
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=2)
+    except OSError as e:
+        print('Warning: could not write the run report %s: %s' % (report_file, str(e)), flush=True)
@@ -0,0 +1,80 @@
+'''
+Run pipeline steps concurrently on a bounded pool of worker threads.
+
+A step is a (name, function, dependencies) tuple, a step is started once all the steps named in its
+dependencies have finished. If any step fails, the commands of the other running steps are killed, steps
+not started yet are dropped and the error of the first failed step is raised again.
+'''
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from . import terminate_running_processes, allow_new_processes
+
+# number of run_steps calls in progress, steps may run further steps of their own
+_active_runs = 0
+_active_runs_lock = threading.Lock()
+
+
+def _check_steps(steps):
+    names = [name for name, _, _ in steps]
+    duplicated = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicated:
+        sys.exit('Error: duplicated step names: %s' % ', '.join(duplicated))
+    for name, _, dependencies in steps:
+        unknown = [dep for dep in dependencies if dep not in names]
+        if unknown:
+            sys.exit('Error: step %s depends on unknown steps: %s' % (name, ', '.join(unknown)))
+
+
+def run_steps(steps, max_workers):
+    '''
+    Run steps, a list of (name, function, dependencies) tuples, using at most max_workers threads. Ready steps
+    are started in the order they are listed.
+    '''
+    global _active_runs
+    _check_steps(steps)
+    with _active_runs_lock:
+        # a nested run must not lift the stop set by a failure in the run it is part of
+        if _active_runs == 0:
+            allow_new_processes()
+        _active_runs += 1
+    try:
+        _run_steps(steps, max_workers)
+    finally:
+        with _active_runs_lock:
+            _active_runs -= 1
+
+
+def _run_steps(steps, max_workers):
+    pending = list(steps)
+    done = set()
+    running = {}
+    first_error = None
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        try:
+            while pending or running:
+                if first_error is None:
+                    for step in [step for step in pending if set(step[2]) <= done]:
+                        pending.remove(step)
+                        running[pool.submit(step[1])] = step[0]
+                if not running:
+                    if first_error is None:
+                        sys.exit('Error: circular dependencies between steps: %s' % ', '.join(
+                            name for name, _, _ in pending))
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    error = future.exception()
+                    if error is None:
+                        done.add(name)
+                    elif first_error is None:
+                        first_error = error
+                        print('Error: step %s failed, stopping the other steps.' % name, flush=True)
+                        terminate_running_processes()
+        except BaseException:
+            # e.g. KeyboardInterrupt while waiting, do not leave the workers waiting on their commands
+            terminate_running_processes()
+            raise
+    if first_error is not None:
+        raise first_error
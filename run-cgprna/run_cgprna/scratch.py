@@ -0,0 +1,113 @@
+'''
+Temp directories of the subcommands, under a scratch directory or the output directory.
+
+With --scratch-directory (or $CGPRNA_SCRATCH), e.g. a node-local disk, temp data is written there rather than
+into the output directory. A temp directory is named after the output directory, so that a rerun with --resume
+uses the same paths. Temp directories are registered when created and remove_temp_dirs removes those left at the
+end of a run, whether it succeeded, failed or was terminated.
+
+Before the heavy work of a step starts, check_space makes sure the temp directory has room for an estimate of the
+temp data, from the sizes of the inputs and of the reference bundle, so a run fails early rather than when the
+disk is full.
+'''
+import os
+import sys
+import shutil
+import hashlib
+import threading
+from . import mkdir
+
+SCRATCH_DIR_ENV = 'CGPRNA_SCRATCH'
+# estimated temp data relative to the size of the input it is made from
+BUNDLE_EXPANSION = 2.5  # extracted reference bundle, mostly the STAR index, to tar.gz
+GZIP_EXPANSION = 4  # FastQ to gzipped FastQ
+BAM_TO_GZIP_FASTQ_EXPANSION = 1.5  # gzipped FastQ at level 1 to BAM
+BAM_TO_FASTQ_EXPANSION = 5  # FastQ to BAM
+COLLATED_BAM_EXPANSION = 1.5  # BAM at level 1 to BAM
+MAPPED_LANE_EXPANSION = 3  # sorted genome and transcriptome BAMs of a lane, plus FastQ of a BAM lane, to its input
+
+_temp_dirs = set()
+_temp_dirs_lock = threading.Lock()
+
+
+def temp_dir_path(args, name):
+    '''
+    Return the path of the temp directory name of a run: in the scratch directory if one is given, otherwise in
+    the output directory.
+    '''
+    out_dir = os.path.abspath(args.out_dir)
+    scratch_dir = getattr(args, 'scratch_dir', None)
+    if not scratch_dir:
+        return os.path.join(out_dir, name)
+    # runs into different output directories can share the scratch directory
+    return os.path.join(os.path.abspath(scratch_dir), '%s.%s' % (name, hashlib.md5(out_dir.encode()).hexdigest()[:12]))
+
+
+def make_temp_dir(path):
+    '''
+    Create a temp directory and register it to be removed by remove_temp_dirs.
+    '''
+    mkdir(path)
+    with _temp_dirs_lock:
+        _temp_dirs.add(path)
+    return path
+
+
+def remove_temp_dir(path):
+    '''
+    Remove a temp directory.
+    '''
+    shutil.rmtree(path, ignore_errors=True)
+    with _temp_dirs_lock:
+        _temp_dirs.discard(path)
+
+
+def remove_temp_dirs():
+    '''
+    Remove the temp directories which are still there, at the end of a run.
+    '''
+    with _temp_dirs_lock:
+        paths = sorted(_temp_dirs)
+    for path in paths:
+        remove_temp_dir(path)
+
+
+def format_size(size):
+    '''
+    Format a number of bytes such as 1.5G.
+    '''
+    for unit in ('B', 'K', 'M', 'G'):
+        if size < 1024:
+            return '%.1f%s' % (size, unit)
+        size /= 1024
+    return '%.1fT' % size
+
+
+def file_size(paths):
+    '''
+    Return the total size of the files which exist in paths.
+    '''
+    return sum(os.path.getsize(path) for path in paths if os.path.isfile(path))
+
+
+def bundle_space(args, ref):
+    '''
+    Return the estimated temp space needed to extract the reference bundle ref: none if ref is a directory, or
+    if bundles are extracted into the reference cache.
+    '''
+    if getattr(args, 'ref_cache', None) or not os.path.isfile(ref):
+        return 0
+    return int(os.path.getsize(ref) * BUNDLE_EXPANSION)
+
+
+def check_space(path, required):
+    '''
+    Exit with an error if the file system of path has less than required bytes available.
+    '''
+    stat = os.statvfs(path)
+    available = stat.f_bavail * stat.f_frsize
+    print('temp data in %s: about %s needed, %s available.' % (path, format_size(required), format_size(available)), flush=True)
+    if required > available:
+        sys.exit(
+            'Error: not enough space for temp data in %s: about %s needed, %s available. Use --scratch-directory (or $%s) to write it elsewhere.' % (
+                path, format_size(required), format_size(available), SCRATCH_DIR_ENV))
@@ -13,6 +13,8 @@ config = {
     'python_requires': '>= 3.5',
     'setup_requires': ['pytest'],
     'install_requires': [],
+    # for the native engines: "--qc-engine native", "--count-engine native" and "--bigwig-engine native"
+    'extras_require': {'native': ['pysam', 'pyBigWig']},
     'packages': ['run_cgprna'],
     'package_data': {'run_cgprna': ['config/*.json']},
     'entry_points': {